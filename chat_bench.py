@@ -0,0 +1,787 @@
+"""Benchmarks for the chat server.
+
+    python chat_bench.py engines --connections 10000 --listeners 200 --messages 2000
+    python chat_bench.py protocol --rounds 200
+    python chat_bench.py history --messages 200000
+    python chat_bench.py cluster --workers 1 2 4
+    python chat_bench.py compression --messages 20000
+    python chat_bench.py search --messages 2000000
+    python chat_bench.py resume --clients 5000 --missed 20
+    python chat_bench.py restart --messages 1000000 --clients 1000
+
+engines starts chat_server.py in a subprocess for each engine, opens a pile of
+idle connections, then measures fan-out from one sender to a channel of
+listeners while the idle connections are held.
+
+protocol fuzzes the frame decoder with randomly split streams, plain and
+compressed, and measures encode/decode throughput.
+
+history measures append rate, replay-of-last-N and deep paging latency and
+restart recovery time for the history backends.
+
+cluster runs the server with each --workers count and drives several busy
+channels at once to show throughput scaling with worker processes.
+
+compression generates chat traffic and compares wire bytes and CPU for
+single broadcast frames and /join history pages, with and without the
+preset dictionary, at several deflate levels.
+
+search fills a SearchIndex with generated chat (Zipf-distributed words) and
+reports indexing rate, memory against the index's own estimate, and query
+latency for rare, common and multi-word queries with and without filters.
+
+resume joins a crowd of clients to a set of channels, drops them all, posts the
+messages they miss and reconnects them at once: with /resume and their last
+message id, and again the old way with /nick and /join. It reports the bytes
+the server sent to get everyone back and how long the storm took.
+
+restart times writing and loading a snapshot of a large history and search
+index against rebuilding the index from scratch, then hands a live server
+off to a successor (--handoff/--takeover) while a probe keeps connecting. It
+reports how long the old server stopped accepting, the longest connect and
+how long a crowd of CAP_RESUME clients took to resume.
+"""
+import argparse, asyncio, base64, gc, itertools, os, random, re, shutil, socket, subprocess, sys, tempfile, threading
+import time, zlib
+from chat_history import MemoryHistory, SegmentHistory
+from chat_headless import SERVER, UNLIMITED, HeadlessClient, free_port, percentile, rss_mb, spawn_server
+from chat_search import SearchIndex
+from chat_server import raise_fd_limit
+from chat_snapshot import read_snapshot, write_snapshot
+from chat_protocol import (CAP_RESUME, COMPRESS_DICT, FLAG_COMPRESSED, FLAG_ID, HEADER, HELLO, FrameDecoder,
+                           ProtocolError, compress_frames, compress_runs, encode_frame, encode_hello, inflate_frames,
+                           split_id_frame)
+
+BENCH_RE = re.compile(r"bench (\d+) (\d+);")
+PAGE_RE = re.compile(r"^History for '.*' from #(\d+): (\d+) messages$")
+PAUSE_RE = re.compile(r"base snapshot sent after (\d+) ms, then paused (\d+) ms")
+
+def start_server_process(engine, port, extra=(), stdout=subprocess.DEVNULL):
+    return spawn_server(port, ["--engine", engine] + UNLIMITED + list(extra), stdout=stdout)
+
+def open_client(port, timeout):
+    return HeadlessClient.connect("127.0.0.1", port, timeout=timeout)
+
+async def hold_connections(port, count, timeout, batch=500):
+    held = []
+    for start in range(0, count, batch):
+        results = await asyncio.gather(
+            *(open_client(port, timeout) for _ in range(min(batch, count - start))),
+            return_exceptions=True)
+        held.extend(r for r in results if not isinstance(r, BaseException))
+    return held
+
+async def listen(client, expected, received, done):
+    try:
+        while len(received) < expected:
+            message = await client.recv()
+            match = BENCH_RE.search(message)
+            if match:
+                received.append(time.perf_counter_ns() - int(match.group(2)))
+    except ConnectionError:
+        pass
+    done.set()
+
+async def fanout(port, listeners, messages, rate, timeout, stalled=0, size=0, channel="bench"):
+    sender = await open_client(port, timeout)
+    await sender.command(f"/create {channel}", "Channel")
+    # In cluster mode the create reaches other workers through the bus.
+    await asyncio.sleep(0.1)
+    await sender.command(f"/join {channel}", "Joined channel")
+    members = []
+    for _ in range(listeners):
+        member = await open_client(port, timeout)
+        await member.command(f"/join {channel}", "Joined channel")
+        members.append(member)
+    # Stalled members join but never read, so their socket buffers fill up.
+    sleepers = []
+    for _ in range(stalled):
+        member = await open_client(port, timeout)
+        await member.command(f"/join {channel}", "Joined channel")
+        sleepers.append(member)
+
+    latencies = [[] for _ in members]
+    events = [asyncio.Event() for _ in members]
+    tasks = [asyncio.create_task(listen(m, messages, latencies[i], events[i]))
+             for i, m in enumerate(members)]
+    interval = 1 / rate if rate else 0
+    padding = " " + "x" * size if size else ""
+    started = time.perf_counter()
+    for seq in range(messages):
+        sender.send(f"bench {seq} {time.perf_counter_ns()};{padding}")
+        await sender.writer.drain()
+        if interval:
+            await asyncio.sleep(interval)
+    try:
+        await asyncio.wait_for(asyncio.gather(*(e.wait() for e in events)), timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+    for task in tasks:
+        task.cancel()
+    flat = [lat for per in latencies for lat in per]
+    for client in members + sleepers + [sender]:
+        client.close()
+    return {
+        "deliveries": len(flat),
+        "expected": messages * listeners,
+        "deliveries_per_sec": len(flat) / elapsed if elapsed else 0,
+        "p50_ms": (percentile(flat, 50) or 0) / 1e6,
+        "p99_ms": (percentile(flat, 99) or 0) / 1e6,
+    }
+
+async def bench_engine(engine, args):
+    port = free_port()
+    proc = start_server_process(engine, port)
+    try:
+        base_rss = rss_mb(proc.pid)
+        started = time.perf_counter()
+        held = await hold_connections(port, args.connections, args.timeout)
+        connect_secs = time.perf_counter() - started
+        held_rss = rss_mb(proc.pid)
+        result = await fanout(port, args.listeners, args.messages, args.rate, args.timeout, args.stalled, args.size)
+        result.update({
+            "engine": engine,
+            "connections_held": len(held),
+            "connect_secs": connect_secs,
+            "rss_idle_mb": base_rss,
+            "rss_held_mb": held_rss,
+        })
+        for client in held:
+            client.close()
+        return result
+    finally:
+        proc.kill()
+        proc.wait()
+
+def cmd_engines(args):
+    raise_fd_limit()
+    print(f"{'engine':<10} {'held':>7} {'rss MiB':>8} {'deliv/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'lost':>6}")
+    for engine in args.engine:
+        r = asyncio.run(bench_engine(engine, args))
+        print(f"{r['engine']:<10} {r['connections_held']:>7} {r['rss_held_mb'] or 0:>8.1f} "
+              f"{r['deliveries_per_sec']:>10.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+              f"{r['expected'] - r['deliveries']:>6}")
+
+async def bench_cluster(workers, args):
+    port = free_port()
+    proc = start_server_process(args.engine, port, ["--workers", str(workers)])
+    try:
+        # Wait for every worker to bind, not just the first.
+        await asyncio.sleep(1 + 0.2 * workers)
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            fanout(port, args.listeners, args.messages, 0, args.timeout, channel=f"bench{i}")
+            for i in range(args.channels)))
+        elapsed = time.perf_counter() - started
+        flat_p99 = max(r["p99_ms"] for r in results)
+        delivered = sum(r["deliveries"] for r in results)
+        return {
+            "workers": workers,
+            "deliveries": delivered,
+            "expected": sum(r["expected"] for r in results),
+            "deliveries_per_sec": delivered / elapsed,
+            "p99_ms": flat_p99,
+        }
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def cmd_cluster(args):
+    print(f"{'workers':>7} {'deliv/s':>10} {'p99 ms':>8} {'lost':>6}")
+    for workers in args.workers:
+        r = asyncio.run(bench_cluster(workers, args))
+        print(f"{r['workers']:>7} {r['deliveries_per_sec']:>10.0f} {r['p99_ms']:>8.2f} "
+              f"{r['expected'] - r['deliveries']:>6}")
+
+def random_payload(rng):
+    kind = rng.random()
+    if kind < 0.6:
+        return "".join(rng.choice("abc xyz") for _ in range(rng.randint(0, 200))).encode()
+    if kind < 0.9:
+        # Multi-byte UTF-8 so splits land inside code points.
+        return "".join(rng.choice("héllo wörld 😀🔥 日本語") for _ in range(rng.randint(1, 300))).encode()
+    return ("/img fuzz 12:00 " + base64.b64encode(rng.randbytes(rng.randint(1000, 200000))).decode()).encode()
+
+def compressed_stream(rng, payloads):
+    """Frame payloads, wrapping random runs of them in compressed frames."""
+    parts = []
+    i = 0
+    while i < len(payloads):
+        run = rng.randint(1, 8)
+        data = b"".join(encode_frame(p) for p in payloads[i:i + run])
+        parts.append(compress_frames(data) if rng.random() < 0.5 else data)
+        i += run
+    return b"".join(parts)
+
+def fuzz_decoder(rounds, seed):
+    """Split random frame streams, some with compressed frames, at random offsets and
+    check they reassemble exactly; damaged compressed frames must raise ProtocolError."""
+    rng = random.Random(seed)
+    for _ in range(rounds):
+        payloads = [random_payload(rng) for _ in range(rng.randint(1, 50))]
+        if rng.random() < 0.5:
+            stream = compressed_stream(rng, payloads)
+        else:
+            stream = b"".join(encode_frame(p) for p in payloads)
+        decoder = FrameDecoder()
+        got = []
+        pos = 0
+        while pos < len(stream):
+            step = rng.choice((1, 2, 3, 7, 64, 4096, 65536))
+            got.extend(payload for _, payload in decoder.feed(stream[pos:pos + step]))
+            pos += step
+        if got != payloads or decoder.pending():
+            raise AssertionError(f"decoder mismatch with seed {seed}")
+        # Every frame must also decode as the UTF-8 it was built from.
+        for payload in got:
+            payload.decode("utf-8")
+        # Corrupt or cut a compressed frame: the decoder may only return frames or raise ProtocolError.
+        packed = compress_frames(b"".join(encode_frame(p) for p in payloads[:8]) + encode_frame(b"x" * 64))
+        body = bytearray(packed[HEADER.size:])
+        for _ in range(rng.randint(1, 4)):
+            body[rng.randrange(len(body))] = rng.randrange(256)
+        body = body[:rng.randint(0, len(body))]
+        try:
+            FrameDecoder().feed(HEADER.pack(len(body), FLAG_COMPRESSED) + bytes(body))
+        except ProtocolError:
+            pass
+    rejects = [
+        (FrameDecoder(max_frame_size=10), encode_frame(b"x" * 11), "oversized frame"),
+        (FrameDecoder(compressed=False), compress_frames(encode_frame(b"y" * 200)), "unnegotiated compressed frame"),
+        (FrameDecoder(max_frame_size=1000), compress_frames(encode_frame(b"z" * 5000)), "compression bomb"),
+    ]
+    nested = compress_frames(encode_frame(b"a" * 200))
+    inner = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=COMPRESS_DICT)
+    inner = inner.compress(nested) + inner.flush()
+    rejects.append((FrameDecoder(), HEADER.pack(len(inner), FLAG_COMPRESSED) + inner, "nested compressed frame"))
+    for decoder, data, what in rejects:
+        try:
+            decoder.feed(data)
+        except ProtocolError:
+            pass
+        else:
+            raise AssertionError(f"{what} was accepted")
+    # A page of large messages, compressible or not, must still fit a default decoder.
+    rng = random.Random(seed)
+    for body in (b"x" * 500000, rng.randbytes(500000)):
+        page = [encode_frame(b"[12:00 : fuzz] " + body) for _ in range(50)]
+        got = [payload for _, payload in FrameDecoder().feed(compress_runs(page))]
+        if len(got) != 50:
+            raise AssertionError("compressed page did not decode")
+
+def decoder_throughput(payload_size, total_mb, chunk=65536):
+    payload = b"x" * payload_size
+    frame = encode_frame(payload)
+    count = max(1, total_mb * 1024 * 1024 // len(frame))
+    started = time.perf_counter()
+    stream = b"".join(encode_frame(payload) for _ in range(count))
+    encoded = time.perf_counter()
+    decoder = FrameDecoder()
+    frames = 0
+    for pos in range(0, len(stream), chunk):
+        frames += len(decoder.feed(stream[pos:pos + chunk]))
+    decoded = time.perf_counter()
+    assert frames == count
+    mb = len(stream) / (1024 * 1024)
+    return {
+        "payload": payload_size,
+        "encode_mb_s": mb / (encoded - started),
+        "decode_mb_s": mb / (decoded - encoded),
+        "frames_s": frames / (decoded - encoded),
+    }
+
+def cmd_protocol(args):
+    started = time.perf_counter()
+    fuzz_decoder(args.rounds, args.seed)
+    print(f"fuzz: {args.rounds} rounds ok in {time.perf_counter() - started:.2f}s (seed {args.seed})")
+    print(f"{'payload':>8} {'enc MB/s':>10} {'dec MB/s':>10} {'frames/s':>12}")
+    for size in (32, 512, 8192, 1024 * 1024):
+        r = decoder_throughput(size, args.megabytes)
+        print(f"{r['payload']:>8} {r['encode_mb_s']:>10.0f} {r['decode_mb_s']:>10.0f} {r['frames_s']:>12.0f}")
+
+WORDS = ("the and you that is it to of in for on with this have be are was not what just like "
+         "deploy build test server channel message ok lol thanks yes no maybe later today tomorrow "
+         "meeting review merge branch fix bug release").split()
+
+def chat_corpus(count, seed, nicks=30):
+    """Channel lines the way the server formats them, with a few notices mixed in."""
+    rng = random.Random(seed)
+    names = [f"{rng.choice(['alice', 'bob', 'carol', 'dave', 'erin', 'frank'])}{i}" for i in range(nicks)]
+    lines = []
+    for i in range(count):
+        nick = rng.choice(names)
+        if rng.random() < 0.05:
+            lines.append(f"{nick} has {rng.choice(['joined', 'left'])} the channel.")
+        else:
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 18)))
+            lines.append(f"[{9 + i // 600 % 12:02d}:{i // 10 % 60:02d} : {nick}] {text}")
+    return lines
+
+def deflate(level, zdict):
+    """A compress function for one variant, framed like compress_frames output."""
+    def compress(data):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, **({"zdict": zdict} if zdict else {}))
+        packed = compressor.compress(data) + compressor.flush()
+        return HEADER.pack(len(packed), FLAG_COMPRESSED) + packed if len(packed) + HEADER.size < len(data) else data
+    return compress
+
+def bench_compression(lines, compress, zdict, page):
+    """Wire bytes and CPU per message when frames go out one at a time or page at a time."""
+    groups = [lines[i:i + page] for i in range(0, len(lines), page)]
+    raw = [b"".join(encode_frame(line) for line in group) for group in groups]
+    started = time.perf_counter()
+    packed = [compress(data) for data in raw]
+    compressed = time.perf_counter()
+    for data in packed:
+        if data[HEADER.size - 1] & FLAG_COMPRESSED:
+            if zdict:
+                inflate_frames(data[HEADER.size:])
+            else:
+                zlib.decompressobj(-15).decompress(data[HEADER.size:])
+    inflated = time.perf_counter()
+    raw_bytes = sum(len(data) for data in raw)
+    wire_bytes = sum(len(data) for data in packed)
+    return {
+        "raw_bytes": raw_bytes,
+        "wire_bytes": wire_bytes,
+        "saved_pct": 100 * (1 - wire_bytes / raw_bytes),
+        "compress_us": (compressed - started) / len(lines) * 1e6,
+        "inflate_us": (inflated - compressed) / len(lines) * 1e6,
+    }
+
+def cmd_compression(args):
+    lines = chat_corpus(args.messages, args.seed)
+    print("Per-message cost is paid once per broadcast, however many members receive it.")
+    print(f"{'shape':<10} {'variant':<14} {'raw KiB':>9} {'wire KiB':>9} {'saved':>7} "
+          f"{'deflate us/msg':>15} {'inflate us/msg':>15}")
+    variants = [(f"level {level}", deflate(level, None), None) for level in (1, 6, 9)]
+    variants += [(f"dict level {level}", deflate(level, COMPRESS_DICT), COMPRESS_DICT) for level in (1, 6, 9)]
+    variants.append(("protocol", compress_frames, COMPRESS_DICT))
+    for shape, page in (("broadcast", 1), (f"page {args.page}", args.page)):
+        for name, compress, zdict in variants:
+            r = bench_compression(lines, compress, zdict, page)
+            print(f"{shape:<10} {name:<14} {r['raw_bytes'] / 1024:>9.0f} {r['wire_bytes'] / 1024:>9.0f} "
+                  f"{r['saved_pct']:>6.1f}% {r['compress_us']:>15.2f} {r['inflate_us']:>15.2f}")
+
+def time_call(fn, repeats):
+    """Median wall time of fn() in microseconds."""
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return percentile(samples, 50)
+
+def bench_history(name, make_store, messages, size, repeats):
+    store = make_store()
+    store.create("bench")
+    text = "[12:00 : bench] " + "x" * max(0, size - 16)
+    started = time.perf_counter()
+    for _ in range(messages):
+        store.append("bench", text)
+    append_rate = messages / (time.perf_counter() - started)
+    result = {"backend": name, "appends_s": append_rate}
+    for count in (50, 1000):
+        result[f"last{count}_us"] = time_call(lambda: store.last("bench", count), repeats)
+    result["deep_page_us"] = time_call(lambda: store.before("bench", messages // 2, 50), repeats)
+    result["deep_page_n"] = len(store.before("bench", messages // 2, 50))
+    store.close()
+    started = time.perf_counter()
+    make_store().close()
+    result["recover_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+def cmd_history(args):
+    directory = tempfile.mkdtemp(prefix="chat-history-bench-")
+    try:
+        backends = [
+            ("memory", lambda: MemoryHistory(args.tail)),
+            ("segment", lambda: SegmentHistory(directory, tail_size=args.tail,
+                                               segment_bytes=args.segment_bytes)),
+        ]
+        print(f"{'backend':<8} {'append/s':>10} {'last50 us':>10} {'last1000 us':>12} "
+              f"{'page us':>9} {'recover ms':>11}")
+        for name, make_store in backends:
+            r = bench_history(name, make_store, args.messages, args.size, args.repeats)
+            print(f"{r['backend']:<8} {r['appends_s']:>10.0f} {r['last50_us']:>10.1f} "
+                  f"{r['last1000_us']:>12.1f} {r['deep_page_us']:>9.1f} {r['recover_ms']:>11.1f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def search_vocabulary(size, seed):
+    """WORDS followed by size generated words, most frequent first."""
+    rng = random.Random(seed)
+    return WORDS + [f"{rng.choice('bcdfghklmnprst')}{rng.choice('aeiou')}{i:x}" for i in range(size)]
+
+def search_corpus(count, seed, words, nicks=200):
+    """(timestamp, line) pairs, one a second, with Zipf-distributed words like real chat."""
+    rng = random.Random(seed)
+    cumulative = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    names = [f"user{i}" for i in range(nicks)]
+    start = time.time() - count
+    for i in range(count):
+        text = " ".join(rng.choices(words, cum_weights=cumulative, k=rng.randint(2, 18)))
+        yield start + i, f"[12:00 : {rng.choice(names)}] {text}"
+
+def cmd_search(args):
+    index = SearchIndex(args.max_bytes)
+    rss_before = rss_mb(os.getpid())
+    started = time.perf_counter()
+    words = search_vocabulary(args.vocabulary, args.seed)
+    for msg_id, (timestamp, line) in enumerate(search_corpus(args.messages, args.seed, words), 1):
+        index.add("bench", msg_id, timestamp, line)
+    elapsed = time.perf_counter() - started
+    stats = index.stats()
+    rss_after = rss_mb(os.getpid())
+    print(f"indexed {args.messages} messages in {elapsed:.1f}s ({args.messages / elapsed:.0f}/s, "
+          f"including corpus generation)")
+    print(f"searchable {stats['messages']} messages in {stats['blocks']} blocks, "
+          f"{stats['evicted_blocks']} evicted")
+    if rss_before is not None:
+        print(f"estimate {stats['bytes'] / 2 ** 20:.0f} MiB, process RSS grew {rss_after - rss_before:.0f} MiB")
+    now = time.time()
+    queries = [
+        ("common word", ["the"], {}),
+        ("rare word", [words[len(words) // 2]], {}),
+        ("two words", ["deploy", "release"], {}),
+        ("three words", ["merge", "branch", "tomorrow"], {}),
+        ("word + from", ["review"], {"author": "user7"}),
+        ("from only", [], {"author": "user7"}),
+        ("word, last hour", ["fix"], {"since": now - 3600}),
+        ("word, page 10", ["bug"], {"offset": 9 * 20}),
+    ]
+    print(f"{'query':<18} {'matches':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, terms, options in queries:
+        samples = []
+        for _ in range(args.repeats):
+            started = time.perf_counter()
+            ids, total = index.search("bench", terms, options.get("author"), options.get("since"),
+                                      None, 1, options.get("offset", 0), 20)
+            samples.append((time.perf_counter() - started) * 1000)
+        print(f"{name:<18} {total:>9} {percentile(samples, 50):>8.2f} {percentile(samples, 99):>8.2f}")
+
+async def read_until(client, expect, timeout):
+    """Read up to the reply starting with expect. Returns (bytes on the wire, history lines received)."""
+    received = lines = 0
+    while True:
+        flags, payload = await client.recv_frame(timeout)
+        received += HEADER.size + len(payload)
+        text = split_id_frame(payload)[1] if flags & FLAG_ID else payload.decode("utf-8", errors="replace")
+        match = PAGE_RE.match(text)
+        if match:
+            lines += int(match.group(2))
+        if text.startswith(expect):
+            return received, lines
+
+async def rejoin_storm(port, crowd, resume, timeout):
+    """Reconnect every (nick, channel, token, last id) of crowd at once; returns per-client (bytes, lines)."""
+    async def back(nick, channel, token, last_id):
+        client = await HeadlessClient.connect("127.0.0.1", port, CAP_RESUME if resume else 0, timeout)
+        try:
+            if resume:
+                client.send(f"/resume {token} {last_id} {channel}")
+                return await read_until(client, "Resume", timeout)
+            client.send(f"/nick {nick}")
+            client.send(f"/join {channel}")
+            return await read_until(client, "Joined channel", timeout)
+        finally:
+            client.close()
+    return await asyncio.gather(*(back(*member) for member in crowd), return_exceptions=True)
+
+async def join_crowd(port, number, channel, caps, timeout):
+    """A client named storm<number> in channel; returns (client, nick, channel, last id it has seen)."""
+    client = await HeadlessClient.connect("127.0.0.1", port, caps, timeout)
+    nick = await client.command(f"/nick storm{number}", "Nickname")
+    page = PAGE_RE.match(await client.command(f"/join {channel}", "History for", timeout))
+    await client.command("/list", "Available channels", timeout)
+    return client, nick.rsplit(" ", 1)[-1], channel, int(page.group(1)) + int(page.group(2)) - 1
+
+async def post(sender, channel, lines):
+    await sender.command(f"/join {channel}", "Joined channel")
+    for text in lines:
+        sender.send(text)
+    await sender.command("/list", "Available channels")
+
+async def bench_resume(resume, args):
+    port = free_port()
+    proc = start_server_process(args.engine, port, ["--resume-ttl", "600"])
+    try:
+        # Members are spread over channels: every /join is announced to the whole channel.
+        channels = [f"storm{i}" for i in range(args.channels)]
+        lines = chat_corpus(args.history + args.missed, args.seed)
+        sender = await open_client(port, args.timeout)
+        for channel in channels:
+            await sender.command(f"/create {channel}", "Channel")
+            await post(sender, channel, lines[:args.history])
+        crowd = []
+        caps = CAP_RESUME if resume else 0
+        for start in range(0, args.clients, 500):
+            crowd.extend(await asyncio.gather(*(
+                join_crowd(port, i, channels[i % len(channels)], caps, args.timeout)
+                for i in range(start, min(args.clients, start + 500)))))
+        # Everyone drops; the sender's messages are what they miss.
+        for client, nick, channel, last_id in crowd:
+            client.close()
+        await asyncio.sleep(0.5)
+        for channel in channels:
+            await post(sender, channel, lines[args.history:])
+        # Thousands of live client objects make every collection in this process
+        # slow; left alone, that is what the storm would measure.
+        gc.collect()
+        gc.freeze()
+        started = time.perf_counter()
+        results = await rejoin_storm(port, [(nick, channel, client.token, last_id)
+                                            for client, nick, channel, last_id in crowd], resume, args.timeout)
+        elapsed = time.perf_counter() - started
+        sender.close()
+        done = [r for r in results if not isinstance(r, BaseException)]
+        return {
+            "mode": "resume" if resume else "nick+join",
+            "clients": len(done),
+            "failed": len(results) - len(done),
+            "seconds": elapsed,
+            "bytes": sum(r[0] for r in done),
+            "lines": sum(r[1] for r in done),
+        }
+    finally:
+        gc.unfreeze()
+        proc.kill()
+        proc.wait()
+
+def cmd_resume(args):
+    raise_fd_limit()
+    print(f"{'mode':<10} {'clients':>7} {'failed':>6} {'secs':>7} {'KiB sent':>9} {'B/client':>9} {'lines/client':>12}")
+    for resume in (True, False):
+        r = asyncio.run(bench_resume(resume, args))
+        clients = max(1, r["clients"])
+        print(f"{r['mode']:<10} {r['clients']:>7} {r['failed']:>6} {r['seconds']:>7.2f} {r['bytes'] / 1024:>9.0f} "
+              f"{r['bytes'] / clients:>9.0f} {r['lines'] / clients:>12.1f}")
+
+def snapshot_timings(args, directory):
+    """Snapshot write and load against a cold index rebuild, for a memory history of args.messages."""
+    words = search_vocabulary(args.vocabulary, args.seed)
+    history = MemoryHistory(args.messages)
+    channels = [f"room{i}" for i in range(args.channels)]
+    for channel in channels:
+        history.create(channel)
+    for i, (timestamp, line) in enumerate(search_corpus(args.messages, args.seed, words)):
+        history.append(channels[i % len(channels)], line, timestamp)
+    def rebuild():
+        index = SearchIndex(1 << 40)
+        for channel in channels:
+            for msg_id, timestamp, text in history.records(channel):
+                index.add(channel, msg_id, timestamp, text)
+        return index
+    started = time.perf_counter()
+    index = rebuild()
+    rebuild_s = time.perf_counter() - started
+    histories = {channel: (history.latest_id(channel) + 1, history.records(channel)) for channel in channels}
+    path = os.path.join(directory, "bench.snap")
+    started = time.perf_counter()
+    size = write_snapshot(path, channels, [], histories, index.snapshot())
+    write_s = time.perf_counter() - started
+    started = time.perf_counter()
+    state = read_snapshot(path)
+    restored = SearchIndex(1 << 40)
+    restored.restore(state["index"])
+    for channel, (next_id, records) in state["histories"].items():
+        MemoryHistory(args.messages).restore(channel, next_id, records)
+    read_s = time.perf_counter() - started
+    return {"bytes": size, "write_s": write_s, "read_s": read_s, "rebuild_s": rebuild_s}
+
+def probe_connects(port, stop, timeout):
+    """Connect and handshake over and over until stop is set; returns (seconds per handshake, failures).
+
+    Runs on its own thread with blocking sockets, so the crowd's event loop does not delay it.
+    """
+    samples = []
+    failures = 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout) as sock:
+                sock.sendall(encode_hello())
+                received = b""
+                while len(received) < HELLO.size:
+                    data = sock.recv(HELLO.size - len(received))
+                    if not data:
+                        raise ConnectionError("closed during handshake")
+                    received += data
+        except OSError:
+            failures += 1
+            time.sleep(0.01)
+            continue
+        samples.append(time.perf_counter() - started)
+        time.sleep(0.005)
+    return samples, failures
+
+async def come_back(client, channel, port, timeout):
+    """Wait for the old server to close the connection, then resume on the new one."""
+    try:
+        while True:
+            await client.recv(timeout)
+    except ConnectionError:
+        pass
+    client.close()
+    back = await HeadlessClient.connect("127.0.0.1", port, CAP_RESUME, timeout)
+    try:
+        back.send(f"/resume {client.token} {client.last_id} {channel}")
+        return await read_until(back, "Resume", timeout)
+    finally:
+        back.close()
+
+async def bench_handoff(args, directory):
+    port = free_port()
+    handoff = os.path.join(directory, "handoff.sock")
+    extra = ["--resume-ttl", "600", "--handoff", handoff]
+    log = open(os.path.join(directory, "old.log"), "w+")
+    old = start_server_process(args.engine, port, extra, log)
+    new = None
+    try:
+        channels = [f"room{i}" for i in range(args.channels)]
+        lines = chat_corpus(args.history, args.seed)
+        sender = await open_client(port, args.timeout)
+        for channel in channels:
+            await sender.command(f"/create {channel}", "Channel")
+            await post(sender, channel, lines)
+        crowd = []
+        for start in range(0, args.clients, 500):
+            crowd.extend(await asyncio.gather(*(
+                join_crowd(port, i, channels[i % len(channels)], CAP_RESUME, args.timeout)
+                for i in range(start, min(args.clients, start + 500)))))
+        sender.close()
+        gc.collect()
+        gc.freeze()
+        stop = threading.Event()
+        probe = asyncio.ensure_future(asyncio.to_thread(probe_connects, port, stop, args.timeout))
+        await asyncio.sleep(0.2)
+        started = time.perf_counter()
+        new = subprocess.Popen([sys.executable, SERVER, "--host", "127.0.0.1", "--port", str(port),
+                                "--engine", args.engine, "--resume-ttl", "600",
+                                "--takeover", handoff] + UNLIMITED,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        results = await asyncio.gather(*(come_back(client, channel, port, args.timeout)
+                                         for client, nick, channel, last_id in crowd), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(0.2)
+        stop.set()
+        samples, failures = await probe
+        log.seek(0)
+        pause = PAUSE_RE.search(log.read())
+        return {
+            "base_ms": int(pause.group(1)) if pause else None,
+            "paused_ms": int(pause.group(2)) if pause else None,
+            "resumed": sum(1 for r in results if not isinstance(r, BaseException)),
+            "failed": sum(1 for r in results if isinstance(r, BaseException)),
+            "seconds": elapsed,
+            "old_exit": old.wait(args.timeout),
+            "probes": len(samples),
+            "probe_failures": failures,
+            "connect_p50_ms": percentile(samples, 50) * 1000 if samples else None,
+            "connect_max_ms": max(samples) * 1000 if samples else None,
+        }
+    finally:
+        gc.unfreeze()
+        for proc in (old, new):
+            if proc:
+                proc.kill()
+                proc.wait()
+        log.close()
+
+def cmd_restart(args):
+    raise_fd_limit()
+    directory = tempfile.mkdtemp(prefix="chat-restart-bench-")
+    try:
+        r = snapshot_timings(args, directory)
+        print(f"{args.messages} messages in {args.channels} channels: snapshot {r['bytes'] / 2 ** 20:.1f} MiB, "
+              f"write {r['write_s']:.2f}s, load {r['read_s']:.2f}s, cold index rebuild {r['rebuild_s']:.2f}s")
+        r = asyncio.run(bench_handoff(args, directory))
+        print(f"handoff ({args.engine}): {r['resumed']} clients resumed, {r['failed']} failed, "
+              f"in {r['seconds']:.2f}s; old server exited {r['old_exit']}")
+        if r["paused_ms"] is not None:
+            print(f"old server: base snapshot sent after {r['base_ms']} ms, accepting paused {r['paused_ms']} ms")
+        if r["probes"]:
+            print(f"probe: {r['probes']} connects, {r['probe_failures']} failed, "
+                  f"p50 {r['connect_p50_ms']:.1f} ms, max {r['connect_max_ms']:.1f} ms")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("engines", help="compare the threaded and asyncio server engines")
+    p.add_argument("--engine", nargs="+", default=["threaded", "asyncio"])
+    p.add_argument("--connections", type=int, default=2000, help="idle connections to hold")
+    p.add_argument("--listeners", type=int, default=100, help="channel members receiving the fan-out")
+    p.add_argument("--messages", type=int, default=500)
+    p.add_argument("--rate", type=float, default=500, help="messages/sec from the sender (0 = unpaced)")
+    p.add_argument("--stalled", type=int, default=0, help="channel members that never read")
+    p.add_argument("--size", type=int, default=0, help="pad each message to this many bytes")
+    p.add_argument("--timeout", type=float, default=30)
+    p.set_defaults(func=cmd_engines)
+
+    p = sub.add_parser("cluster", help="throughput scaling with --workers")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--engine", default="asyncio")
+    p.add_argument("--channels", type=int, default=8)
+    p.add_argument("--listeners", type=int, default=25, help="members per channel")
+    p.add_argument("--messages", type=int, default=300, help="messages per channel")
+    p.add_argument("--timeout", type=float, default=60)
+    p.set_defaults(func=cmd_cluster)
+
+    p = sub.add_parser("protocol", help="fuzz and time the frame decoder")
+    p.add_argument("--rounds", type=int, default=200)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--megabytes", type=int, default=64, help="stream size per throughput run")
+    p.set_defaults(func=cmd_protocol)
+
+    p = sub.add_parser("compression", help="bytes saved against CPU for compressed frames")
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--page", type=int, default=50, help="messages per history page")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=cmd_compression)
+
+    p = sub.add_parser("search", help="index size and query latency for /search")
+    p.add_argument("--messages", type=int, default=1000000)
+    p.add_argument("--vocabulary", type=int, default=50000, help="distinct generated words")
+    p.add_argument("--max-bytes", type=int, default=1 << 40, help="index memory bound (default: unbounded)")
+    p.add_argument("--repeats", type=int, default=50)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser("resume", help="a reconnect storm with /resume against /nick and /join")
+    p.add_argument("--engine", default="asyncio")
+    p.add_argument("--clients", type=int, default=2000)
+    p.add_argument("--channels", type=int, default=50, help="channels the clients are spread over")
+    p.add_argument("--history", type=int, default=200, help="messages in each channel before the drop")
+    p.add_argument("--missed", type=int, default=20, help="messages posted while the clients are away")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--timeout", type=float, default=60)
+    p.set_defaults(func=cmd_resume)
+
+    p = sub.add_parser("restart", help="snapshot restore against a cold start, and a live handoff")
+    p.add_argument("--messages", type=int, default=1000000, help="messages in the snapshot timing")
+    p.add_argument("--vocabulary", type=int, default=50000, help="distinct generated words")
+    p.add_argument("--engine", default="asyncio")
+    p.add_argument("--clients", type=int, default=1000, help="CAP_RESUME clients connected during the handoff")
+    p.add_argument("--channels", type=int, default=20)
+    p.add_argument("--history", type=int, default=200, help="messages in each channel before the handoff")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--timeout", type=float, default=60)
+    p.set_defaults(func=cmd_restart)
+
+    p = sub.add_parser("history", help="time the history backends")
+    p.add_argument("--messages", type=int, default=200000)
+    p.add_argument("--size", type=int, default=80, help="bytes per message")
+    p.add_argument("--tail", type=int, default=1000)
+    p.add_argument("--segment-bytes", type=int, default=4 * 1024 * 1024)
+    p.add_argument("--repeats", type=int, default=50)
+    p.set_defaults(func=cmd_history)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
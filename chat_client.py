@@ -1,7 +1,260 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext, filedialog
-import socket, threading, queue, datetime, base64, io
+import socket, threading, queue, datetime, base64, collections, hashlib, io, os, random, re
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageTk
+from chat_media import CacheBudget, MediaCache, MediaClient, MediaError, media_ref, parse_media_ref
+from chat_protocol import (CAP_COMPRESS, CAP_MEDIA, CAP_RESUME, FLAG_ID, FrameDecoder, ProtocolError,
+                           client_handshake, encode_frame, split_id_frame)
+
+# Header the server sends before a page of history lines.
+HISTORY_RE = re.compile(r"^History for '(.*)' from #(\d+): (\d+) messages$")
+HISTORY_PAGE = 50
+# Header the server sends before a page of /search results.
+SEARCH_RE = re.compile(r"^Search '(.*)' page (\d+) of (\d+): (\d+) of (\d+) matches$")
+MEDIA_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "borg-chat", "media")
+THUMB_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "borg-chat", "thumbs")
+MEDIA_CACHE_BYTES = 256 * 1024 * 1024
+THUMB_CACHE_BYTES = 64 * 1024 * 1024
+THUMB_WIDTH = 200
+DECODE_WORKERS = 2
+
+# Rendering limits. Logs can hold any number of messages; only a window of
+# each one is ever in a text widget.
+RENDER_WINDOW = 500    # entries rendered at the bottom of a channel
+RENDER_PAGE = 100      # entries added at a time when scrolling past the window
+RENDER_MAX = 1500      # the window never grows past this; the far end is trimmed
+CACHED_VIEWS = 4       # channel widgets kept alive so switching back is instant
+MAX_PHOTOS = 200       # decoded images kept besides those currently rendered
+QUEUE_BATCH = 2000     # messages handled per process_queue tick
+
+# Reconnect delays are drawn uniformly from zero up to a cap that doubles per
+# failed attempt, so clients dropped together spread their retries out.
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30
+
+
+def open_chat_socket(ip, port):
+    """Connect and handshake; returns the socket and the agreed capabilities."""
+    sock = socket.create_connection((ip, port))
+    try:
+        version, caps = client_handshake(sock, CAP_MEDIA | CAP_COMPRESS | CAP_RESUME)
+    except Exception:
+        sock.close()
+        raise
+    return sock, caps
+
+def load_thumbnail(key, data, media_cache, budget=None, directory=THUMB_CACHE_DIR):
+    """Decode and shrink an image for display; runs on the decode pool, never the UI thread.
+
+    data is raw bytes, a base64 string (inline images) or None to read the
+    media cache. Thumbnails are saved as <directory>/<key>.png, so an image
+    seen before is never decoded at full size again, and charged to budget
+    so the directory stays within its size. Returns None if there is no data
+    for key yet.
+    """
+    path = os.path.join(directory, key + ".png")
+    if os.path.exists(path):
+        image = Image.open(path)
+        image.load()
+        os.utime(path)
+        return image
+    if data is None and media_cache:
+        data = media_cache.get(key)
+    if data is None:
+        return None
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if image.width > THUMB_WIDTH:
+        height = max(1, int(image.height * THUMB_WIDTH / image.width))
+        image = image.convert("RGBA").resize((THUMB_WIDTH, height), Image.LANCZOS)
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    os.makedirs(directory, exist_ok=True)
+    tmp = path + ".tmp"
+    image.save(tmp, format="PNG")
+    os.replace(tmp, path)
+    if budget:
+        budget.charge(os.path.getsize(path))
+    return image
+
+def entry_lines(entry):
+    """Number of text lines a log entry takes in the chat widget."""
+    return entry.count("\n") + 1 if isinstance(entry, str) else 1
+
+class ChannelView:
+    """A text widget showing the window [start, end) of one channel's log.
+
+    Entries are strings, or ("img", key, data) for an image. New messages are
+    appended by flush() once per queue tick; scrolling past either edge of the
+    window renders the next page of the log and trims the far side.
+    """
+
+    def __init__(self, client, parent, channel):
+        self.client = client
+        self.channel = channel
+        self.text = scrolledtext.ScrolledText(parent, state="disabled")
+        self.text.configure(yscrollcommand=self.on_scroll)
+        self.start = self.end = 0
+        self.attached = True                 # The window reaches the end of the log.
+        self.lines = collections.deque()     # Text lines of each rendered entry.
+        self.images = collections.Counter()  # Image key -> times rendered here.
+        self.scheduled = False
+        self.render_latest()
+
+    @property
+    def log(self):
+        return self.client.chat_logs.setdefault(self.channel, [])
+
+    def insert(self, index, entries):
+        """Render entries at index in order, batching consecutive text into one insert."""
+        text = self.text
+        text.mark_set("render", index)
+        text.mark_gravity("render", tk.RIGHT)
+        chunk = []
+        for entry in entries:
+            if isinstance(entry, str):
+                chunk.append(entry + "\n")
+                continue
+            if chunk:
+                text.insert("render", "".join(chunk))
+                chunk = []
+            key = entry[1]
+            photo = self.client.photo_for(key, entry[2])
+            if photo is None:
+                text.insert("render", self.client.placeholder(key), f"img-{key}")
+            else:
+                text.image_create("render", image=photo)
+            text.insert("render", "\n")
+            self.images[key] += 1
+        if chunk:
+            text.insert("render", "".join(chunk))
+        return [entry_lines(entry) for entry in entries]
+
+    def release(self, entries):
+        for entry in entries:
+            if not isinstance(entry, str):
+                self.images[entry[1]] -= 1
+                if not self.images[entry[1]]:
+                    del self.images[entry[1]]
+
+    def render_latest(self):
+        """Show the newest RENDER_WINDOW entries, scrolled to the bottom."""
+        log = self.log
+        self.text.configure(state="normal")
+        self.text.delete("1.0", tk.END)
+        self.images.clear()
+        self.end = len(log)
+        self.start = max(0, self.end - RENDER_WINDOW)
+        self.lines = collections.deque(self.insert(tk.END, log[self.start:self.end]))
+        self.text.configure(state="disabled")
+        self.attached = True
+        self.text.see(tk.END)
+
+    def shift(self, count):
+        """count entries were inserted at the head of the log."""
+        self.start += count
+        self.end += count
+
+    def flush(self):
+        """Render entries appended to the log since the last tick."""
+        log = self.log
+        if not self.attached or self.end == len(log):
+            return
+        at_bottom = self.text.yview()[1] >= 1.0
+        self.text.configure(state="normal")
+        self.lines.extend(self.insert(tk.END, log[self.end:]))
+        self.end = len(log)
+        if at_bottom:
+            self.trim_top(self.end - self.start - RENDER_WINDOW)
+        else:
+            # Reading older messages: keep the view still and detach if it grows too big.
+            self.trim_bottom(self.end - self.start - RENDER_MAX)
+        self.text.configure(state="disabled")
+        if at_bottom:
+            self.text.see(tk.END)
+
+    def trim_top(self, count):
+        if count <= 0:
+            return 0
+        lines = sum(self.lines.popleft() for _ in range(count))
+        self.text.delete("1.0", f"{lines + 1}.0")
+        self.release(self.log[self.start:self.start + count])
+        self.start += count
+        return lines
+
+    def trim_bottom(self, count):
+        if count <= 0:
+            return
+        for _ in range(count):
+            self.lines.pop()
+        self.text.delete(f"{sum(self.lines) + 1}.0", tk.END)
+        self.release(self.log[self.end - count:self.end])
+        self.end -= count
+        self.attached = False
+
+    def on_scroll(self, first, last):
+        self.text.vbar.set(first, last)
+        if self.scheduled:
+            return
+        # Extend the window outside the scroll callback; it changes what is visible.
+        if float(first) <= 0.0:
+            self.scheduled = True
+            self.text.after_idle(self.extend_up)
+        elif float(last) >= 1.0 and not self.attached:
+            self.scheduled = True
+            self.text.after_idle(self.extend_down)
+
+    def extend_up(self):
+        self.scheduled = False
+        if not self.start:
+            # Everything local is rendered; ask the server for older messages.
+            self.client.request_older(self.channel)
+            return
+        count = min(RENDER_PAGE, self.start)
+        self.text.configure(state="normal")
+        added = self.insert("1.0", self.log[self.start - count:self.start])
+        self.lines.extendleft(reversed(added))
+        self.start -= count
+        self.trim_bottom(self.end - self.start - RENDER_MAX)
+        self.text.configure(state="disabled")
+        self.text.yview(f"{sum(added) + 1}.0")
+
+    def extend_down(self):
+        self.scheduled = False
+        log = self.log
+        count = min(RENDER_PAGE, len(log) - self.end)
+        if count <= 0:
+            self.attached = True
+            return
+        top = int(self.text.index("@0,0").split(".")[0])
+        self.text.configure(state="normal")
+        self.lines.extend(self.insert(tk.END, log[self.end:self.end + count]))
+        self.end += count
+        removed = self.trim_top(self.end - self.start - RENDER_MAX)
+        self.text.configure(state="disabled")
+        self.attached = self.end == len(log)
+        self.text.yview(f"{max(1, top - removed)}.0")
+
+    def fill_image(self, key, photo):
+        """Replace the placeholders for an image once it is decoded (or found unreadable)."""
+        ranges = self.text.tag_ranges(f"img-{key}")
+        if not ranges:
+            return
+        self.text.configure(state="normal")
+        for i in range(len(ranges) - 2, -1, -2):
+            self.text.delete(ranges[i], ranges[i + 1])
+            if photo is None:
+                self.text.insert(ranges[i], self.client.placeholder(key), f"img-{key}")
+            else:
+                self.text.image_create(ranges[i], image=photo)
+        self.text.configure(state="disabled")
+
+    def destroy(self):
+        self.text.frame.destroy()
+        self.images.clear()
 
 class ChatClient(tk.Tk):
     def __init__(self):
@@ -14,7 +267,30 @@ class ChatClient(tk.Tk):
         self.username = "You"  # Default username
         self.current_channel = None  # Currently active channel
         self.chat_logs = {}   # Separate chat logs per channel.
-        self.images = []      # To store image references for the chat display
+        self.views = collections.OrderedDict()   # Channel -> ChannelView, least recent first.
+        self.photos = collections.OrderedDict()  # Image key -> PhotoImage, least recent first.
+        self.bad_images = set()         # Keys whose data could not be decoded.
+        self.fetching = set()           # Digests being fetched from the server.
+        self.decoding = set()           # Keys on the decode pool.
+        self.decoder = ThreadPoolExecutor(max_workers=DECODE_WORKERS)
+        self.thumb_budget = CacheBudget(THUMB_CACHE_DIR, THUMB_CACHE_BYTES, ".png")
+        self.decoder.submit(self.thumb_budget.prune)
+        self.history_cursors = {}       # Oldest message id loaded per channel.
+        self.history_requested = set()  # Channels with an older page in flight.
+        self.history_batch = None       # History page currently being received.
+        self.search_batch = None        # Search results page currently being received.
+        self.search_query = None        # (channel, query) shown in the search window.
+        self.search_window = None
+        self.media = None               # MediaClient when the server has a media store.
+        self.server = None              # (ip, port) to reconnect to.
+        self.session_token = None       # Lets a reconnect pick the session up where it was.
+        self.resume_token = None        # Token sent with a /resume still waiting for its answer.
+        self.reconnecting = False       # Between a dropped connection and the session being back.
+        self.reconnect_attempt = 0
+        self.caps = 0                   # Capabilities agreed with the server on this connection.
+        self.last_ids = {}              # Newest message id seen per channel (kept current only with CAP_RESUME).
+        self.stream_channel = None      # Channel the server is sending channel messages for.
+        self.media_cache = None
 
         self.create_widgets()
         self.create_menu()
@@ -27,6 +303,12 @@ class ChatClient(tk.Tk):
         top_frame.pack(side=tk.TOP, fill=tk.X, padx=10, pady=5)
         self.node_info_label = ttk.Label(top_frame, text="Not connected")
         self.node_info_label.pack(side=tk.LEFT)
+        # Search box: results come from the server's index, not from loaded history.
+        self.search_button = ttk.Button(top_frame, text="[Search]", command=self.start_search)
+        self.search_button.pack(side=tk.RIGHT)
+        self.search_entry = ttk.Entry(top_frame, width=30)
+        self.search_entry.pack(side=tk.RIGHT, padx=5)
+        self.search_entry.bind("<Return>", lambda event: self.start_search())
 
         # Main frame: Channel list on left, chat area on right.
         main_frame = ttk.Frame(self)
@@ -44,8 +326,9 @@ class ChatClient(tk.Tk):
         # Right frame: Chat messages and message input.
         right_frame = ttk.Frame(main_frame)
         right_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
-        self.chat_text = scrolledtext.ScrolledText(right_frame, state="disabled")
-        self.chat_text.pack(fill=tk.BOTH, expand=True)
+        self.chat_area = ttk.Frame(right_frame)
+        self.chat_area.pack(fill=tk.BOTH, expand=True)
+        self.switch_channel(None)
 
         # Bottom frame: [Upload Image] [Message Entry] [Emoji] [Send]
         bottom_frame = ttk.Frame(right_frame)
@@ -74,10 +357,15 @@ class ChatClient(tk.Tk):
             "/nick <name>       : Set your nickname.\n"
             "/create <channel>  : Create a new channel.\n"
             "/join <channel>    : Join an existing channel.\n"
+            "/rejoin <id> <channel> : Join a channel, sending only the messages after id.\n"
             "/list              : List all available channels.\n"
             "/dm <nick> <msg>   : Send a direct message to a user.\n"
             "/status <state>    : Set your status (online, away, busy).\n"
-            "/history           : View message history.\n"
+            "/history [id] [n]  : View n messages before message id (scroll up to load more).\n"
+            "/search <channel> <words> [from:nick] [since:2h] [until:2024-05-01] [page:n]\n"
+            "                   : Search a channel's history.\n"
+            "/stats             : Server metrics (only from the server host).\n"
+            "/snapshot          : Save a server snapshot now (only from the server host).\n"
             "/file              : Send a file (feature not implemented).\n"
             "/img <username> <time> <base64> : Image message format (handled automatically).\n"
             "/quit              : Disconnect from the server.\n"
@@ -86,6 +374,7 @@ class ChatClient(tk.Tk):
             "Double-click a channel in the Channel List to join it.\n"
             "Click [Upload Image] to select and send an image.\n"
             "Click [Emoji] to add an emoji to your message.\n"
+            "Type in the box at the top and press Enter or click [Search] to search the current channel.\n"
         )
         messagebox.showinfo("Help", help_text)
 
@@ -114,106 +403,403 @@ class ChatClient(tk.Tk):
         dialog.wait_window()
 
     def start_connection(self, ip, port):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server = (ip, port)
         try:
-            self.socket.connect((ip, port))
+            sock, caps = open_chat_socket(ip, port)
         except Exception as e:
             messagebox.showerror("Connection Error", f"Could not connect to server: {e}")
             self.destroy()
             return
-        self.running = True
-        threading.Thread(target=self.receive_messages, daemon=True).start()
+        self.attach_socket(sock, caps)
         self.send_command("/list")
 
-    def receive_messages(self):
+    def attach_socket(self, sock, caps):
+        self.socket = sock
+        self.caps = caps
+        if caps & CAP_MEDIA and self.media is None:
+            # Images go over their own connection so transfers never hold up chat.
+            self.media = MediaClient(*self.server)
+            self.media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_BYTES)
+        self.running = True
+        threading.Thread(target=self.receive_messages, args=(sock,), daemon=True).start()
+
+    def receive_messages(self, sock):
+        decoder = FrameDecoder()
         while self.running:
             try:
-                message = self.socket.recv(4096).decode()
-                if message:
-                    self.msg_queue.put(message)
-                else:
+                data = sock.recv(65536)
+                if not data:
                     break
-            except Exception:
+                # Each frame is exactly one server message; compressed frames arrive already unwrapped.
+                for flags, payload in decoder.feed(data):
+                    if flags & FLAG_ID:
+                        self.msg_queue.put(("message",) + split_id_frame(payload))
+                    else:
+                        self.msg_queue.put(payload.decode("utf-8", errors="replace"))
+            except (OSError, ProtocolError):
                 break
-        if self.socket:
-            self.socket.close()
+        sock.close()
+        if self.running:
+            self.msg_queue.put(("disconnected", sock))
+
+    def schedule_reconnect(self):
+        delay = random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** self.reconnect_attempt))
+        self.reconnect_attempt += 1
+        self.after(int(delay * 1000), lambda: threading.Thread(target=self.reconnect, daemon=True).start())
+
+    def reconnect(self):
+        try:
+            sock, caps = open_chat_socket(*self.server)
+        except (OSError, ProtocolError):
+            self.msg_queue.put(("reconnect_failed",))
+            return
+        self.msg_queue.put(("reconnected", sock, caps))
+
+    def resume(self, caps):
+        """Pick the session up again: by token when the server still holds it, else by hand."""
+        channel = self.stream_channel
+        if self.session_token and caps & CAP_RESUME:
+            self.resume_token = self.session_token
+            command = f"/resume {self.session_token}"
+            if channel:
+                command += f" {self.last_ids.get(channel, 0)} {channel}"
+            self.send_command(command)
+        else:
+            self.restore_session()
+        self.send_command("/list")
+
+    def restore_session(self):
+        """Claim the nickname again and rejoin, asking only for what was missed."""
+        self.reconnecting = False
+        if self.username != "You":
+            self.send_command(f"/nick {self.username}")
+        if self.stream_channel:
+            self.send_command(self.join_command(self.stream_channel))
+
+    def join_command(self, channel):
+        """/rejoin when messages of channel were seen before, so only newer ones are sent.
+
+        Live messages carry their ids only on CAP_RESUME connections; without
+        it last_ids would be stale and the delta would repeat what is shown.
+        """
+        if channel in self.last_ids and self.caps & CAP_RESUME:
+            return f"/rejoin {self.last_ids[channel]} {channel}"
+        return f"/join {channel}"
 
     def process_queue(self):
-        while not self.msg_queue.empty():
-            message = self.msg_queue.get()
-            # Update channel list if applicable.
-            if message.startswith("Available channels:"):
-                channels_str = message.replace("Available channels:", "").strip()
-                channels = [ch.strip() for ch in channels_str.split(",") if ch.strip()]
-                self.update_channel_list(channels)
-            # Handle join confirmations.
-            elif message.startswith("Joined channel"):
-                try:
-                    channel = message.split("'")[1]
+        for _ in range(QUEUE_BATCH):
+            try:
+                message = self.msg_queue.get_nowait()
+            except queue.Empty:
+                break
+            # Tuples are results posted by background threads.
+            if isinstance(message, tuple):
+                self.handle_event(*message)
+            else:
+                self.handle_server_message(message)
+        # Everything that arrived this tick is rendered with one insert per view.
+        for view in self.views.values():
+            view.flush()
+        self.after(10 if not self.msg_queue.empty() else 100, self.process_queue)
+
+    def handle_server_message(self, message, channel=None):
+        """Act on one line from the server. channel is where a channel message belongs, when the
+        server said (CAP_RESUME); otherwise the channel on screen."""
+        channel = channel or self.current_channel
+        # Lines belonging to a history page are collected, then applied together.
+        if self.history_batch is not None:
+            self.history_batch["lines"].append(self.history_line(message))
+            if len(self.history_batch["lines"]) == self.history_batch["count"]:
+                self.apply_history(self.history_batch)
+                self.history_batch = None
+            return
+        if self.search_batch is not None:
+            self.search_batch["lines"].append(message)
+            if len(self.search_batch["lines"]) == self.search_batch["count"]:
+                self.show_search_results(self.search_batch)
+                self.search_batch = None
+            return
+        if message.startswith("Session token: "):
+            self.session_token = message.split(": ", 1)[1]
+            return
+        if message.startswith("Welcome!") and self.reconnecting:
+            return
+        if message.startswith("Resumed session as "):
+            self.session_token = self.resume_token
+            self.username = message.rsplit(" ", 1)[-1]
+            self.reconnecting = False
+            self.display_message("Reconnected.")
+            return
+        if message.startswith("Resume failed"):
+            self.restore_session()
+            return
+        match = SEARCH_RE.match(message)
+        if match:
+            batch = {"channel": match.group(1), "page": int(match.group(2)), "pages": int(match.group(3)),
+                     "count": int(match.group(4)), "total": int(match.group(5)), "lines": []}
+            if batch["count"]:
+                self.search_batch = batch
+            else:
+                self.show_search_results(batch)
+            return
+        match = HISTORY_RE.match(message)
+        if match:
+            batch = {"channel": match.group(1), "first_id": int(match.group(2)),
+                     "count": int(match.group(3)), "lines": []}
+            if batch["count"]:
+                self.history_batch = batch
+            else:
+                self.apply_history(batch)
+        # Update channel list if applicable.
+        elif message.startswith("Available channels:"):
+            channels_str = message.replace("Available channels:", "").strip()
+            channels = [ch.strip() for ch in channels_str.split(",") if ch.strip()]
+            self.update_channel_list(channels)
+        # Nicknames are unique, so only take the new name once the server accepts it.
+        elif message.startswith("Nickname changed from "):
+            self.username = message.rsplit(" to ", 1)[-1]
+            self.display_message(message)
+        # Handle join confirmations.
+        elif message.startswith("Joined channel"):
+            try:
+                channel = message.split("'")[1]
+                self.stream_channel = channel
+                if self.reconnecting or channel != self.current_channel:
                     self.switch_channel(channel)
+                if not self.reconnecting:
                     self.append_to_channel_log(channel, message)
-                except IndexError:
-                    self.display_message(message)
-            # Handle image messages.
-            elif message.startswith("/img "):
-                parts = message.split(" ", 3)
-                if len(parts) < 4:
-                    self.display_message(message)
-                else:
-                    sender = parts[1]
-                    time_str = parts[2]
-                    b64_data = parts[3]
-                    formatted_msg = f"[{time_str} : {sender}] sent an image:"
-                    self.append_to_channel_log(self.current_channel, formatted_msg)
-                    try:
-                        image_bytes = base64.b64decode(b64_data)
-                        self.display_image(image_bytes)
-                    except Exception as e:
-                        self.display_message("Failed to decode image.")
+            except IndexError:
+                self.display_message(message)
+        # Handle image messages.
+        elif message.startswith("/img "):
+            parts = message.split(" ", 3)
+            if len(parts) < 4:
+                self.display_message(message)
             else:
-                # Regular text message.
-                if self.current_channel:
-                    self.append_to_channel_log(self.current_channel, message)
+                sender = parts[1]
+                time_str = parts[2]
+                b64_data = parts[3]
+                formatted_msg = f"[{time_str} : {sender}] sent an image:"
+                self.append_to_channel_log(channel, formatted_msg)
+                digest = parse_media_ref(b64_data)
+                if digest:
+                    self.append_to_channel_log(channel, ("img", digest, None))
                 else:
-                    self.display_message(message)
-        self.after(100, self.process_queue)
+                    # Inline base64 is decoded on the decode pool along with the image.
+                    key = hashlib.sha256(b64_data.encode("utf-8")).hexdigest()
+                    self.append_to_channel_log(channel, ("img", key, b64_data))
+        else:
+            # Regular text message.
+            self.append_to_channel_log(channel, message)
 
-    def display_message(self, message):
-        self.chat_text.configure(state="normal")
-        self.chat_text.insert(tk.END, message + "\n")
-        self.chat_text.configure(state="disabled")
-        self.chat_text.see(tk.END)
+    def handle_event(self, kind, *args):
+        if kind == "send":
+            self.send_command(args[0])
+        elif kind == "media":
+            digest, image_bytes = args
+            self.fetching.discard(digest)
+            self.decode_image(digest, image_bytes)
+        elif kind == "thumb":
+            self.place_image(*args)
+        elif kind == "error":
+            self.display_message(args[0])
+        elif kind == "message":
+            # A channel message with its id; ids at or below the last seen are repeats.
+            msg_id, text = args
+            channel = self.stream_channel or self.current_channel
+            if msg_id > self.last_ids.get(channel, 0):
+                self.last_ids[channel] = msg_id
+                if text:
+                    self.handle_server_message(text, channel)
+        elif kind == "disconnected":
+            if args[0] is self.socket:
+                self.socket = None
+                # Pages cut off mid-way never complete; the new connection asks again.
+                self.history_batch = None
+                self.search_batch = None
+                self.history_requested.clear()
+                self.reconnecting = True
+                self.display_message("Connection lost. Reconnecting...")
+                self.schedule_reconnect()
+        elif kind == "reconnect_failed":
+            self.schedule_reconnect()
+        elif kind == "reconnected":
+            sock, caps = args
+            self.reconnect_attempt = 0
+            self.attach_socket(sock, caps)
+            self.resume(caps)
 
-    def display_image(self, image_bytes):
+    def photo_for(self, key, data):
+        """The PhotoImage for an image, or None while it is being prepared in the background."""
+        photo = self.photos.get(key)
+        if photo is not None:
+            self.photos.move_to_end(key)
+            return photo
+        if key not in self.bad_images and key not in self.fetching:
+            self.decode_image(key, data)
+        return None
+
+    def placeholder(self, key):
+        return "[unreadable image]" if key in self.bad_images else "[image]"
+
+    def decode_image(self, key, data):
+        """Queue an image for the decode pool; the result comes back through msg_queue."""
+        if key in self.decoding:
+            return
+        self.decoding.add(key)
+        future = self.decoder.submit(load_thumbnail, key, data, self.media_cache,
+                                    self.thumb_budget)
+        future.add_done_callback(lambda done: self.msg_queue.put(("thumb", key, done)))
+
+    def place_image(self, key, future):
+        """Turn a decoded thumbnail into a PhotoImage and put it in every placeholder."""
+        self.decoding.discard(key)
         try:
-            image = Image.open(io.BytesIO(image_bytes))
-        except Exception:
-            self.display_message("Error opening image.")
+            image = future.result()
+        except Exception as e:
+            print("Image decode error:", e)
+            self.bad_images.add(key)
+            image = None
+        if image is None:
+            if key not in self.bad_images:
+                self.request_media(key)
+                return
+            photo = None
+        else:
+            photo = self.photos[key] = ImageTk.PhotoImage(image)
+            self.evict_photos()
+        for view in self.views.values():
+            view.fill_image(key, photo)
+
+    def evict_photos(self):
+        """Drop the least recently used images that no view is showing."""
+        for key in list(self.photos)[:-1]:
+            if len(self.photos) <= MAX_PHOTOS:
+                break
+            if not any(view.images[key] for view in self.views.values()):
+                del self.photos[key]
+
+    def request_media(self, digest):
+        """Fetch a shared image in the background; it is placed when it arrives."""
+        if not self.media or digest in self.fetching:
             return
+        self.fetching.add(digest)
 
-        max_width = 200
-        if image.width > max_width:
-            ratio = max_width / image.width
-            new_size = (max_width, int(image.height * ratio))
+        def fetch():
             try:
-                resample_filter = Image.Resampling.LANCZOS
-            except AttributeError:
-                resample_filter = Image.ANTIALIAS
-            image = image.resize(new_size, resample_filter)
-        photo = ImageTk.PhotoImage(image)
-        self.chat_text.configure(state="normal")
-        self.chat_text.image_create(tk.END, image=photo)
-        self.chat_text.insert(tk.END, "\n")
-        self.chat_text.configure(state="disabled")
-        self.chat_text.see(tk.END)
-        self.images.append(photo)
+                found = self.media.fetch(digest, thumb=True)
+            except (OSError, MediaError, ProtocolError) as e:
+                self.msg_queue.put(("error", f"Failed to fetch image: {e}"))
+                return
+            if found is None:
+                self.msg_queue.put(("error", "Image no longer available."))
+                return
+            kind, data = found
+            self.media_cache.put(digest, kind, data)
+            self.msg_queue.put(("media", digest, data))
+
+        threading.Thread(target=fetch, daemon=True).start()
+
+    def history_line(self, message):
+        """Log text for a replayed line; images are summarised like live ones."""
+        if message.startswith("/img "):
+            parts = message.split(" ", 3)
+            if len(parts) == 4:
+                return f"[{parts[2]} : {parts[1]}] sent an image:"
+        return message
+
+    def apply_history(self, batch):
+        channel = batch["channel"]
+        lines = batch["lines"]
+        first_id = batch["first_id"]
+        view = self.views.get(channel)
+        if channel in self.history_requested:
+            # An older page: prepend it; a view at the top of the log renders it in place.
+            self.history_requested.discard(channel)
+            self.history_cursors[channel] = first_id
+            self.chat_logs.setdefault(channel, [])[:0] = lines
+            if view and lines:
+                view.shift(len(lines))
+                if view.start == len(lines):
+                    view.extend_up()
+            return
+        cursor = self.last_ids.get(channel)
+        if cursor is not None and first_id == cursor + 1 and self.caps & CAP_RESUME:
+            # A /rejoin answered with just the messages missed (maybe none): they follow
+            # what is loaded and views render them at the end of the tick.
+            self.chat_logs.setdefault(channel, []).extend(lines)
+        else:
+            # The page sent on /join is the server's view of the channel.
+            self.history_cursors[channel] = first_id
+            self.chat_logs[channel] = lines
+            if view:
+                view.render_latest()
+        # After a restart or on another worker the ids may be lower than any seen
+        # before, so the page's newest id replaces the old one rather than adding to it.
+        self.last_ids[channel] = first_id + len(lines) - 1 if lines else max(first_id - 1, 0)
+
+    def request_older(self, channel):
+        """Fetch the page before the oldest loaded message of a channel."""
+        if (channel and self.socket and channel not in self.history_requested
+                and self.history_cursors.get(channel, 0) > 1):
+            self.history_requested.add(channel)
+            self.send_command(f"/history {self.history_cursors[channel]} {HISTORY_PAGE}")
+
+    def start_search(self):
+        query = self.search_entry.get().strip()
+        if query and self.current_channel and self.socket:
+            self.search_query = (self.current_channel, query)
+            self.request_search(1)
+
+    def request_search(self, page):
+        channel, query = self.search_query
+        self.send_command(f"/search {channel} {query} page:{page}")
+
+    def show_search_results(self, batch):
+        """Show a page of search results in the search window, opening it if needed."""
+        if self.search_window is None or not self.search_window.winfo_exists():
+            self.search_window = tk.Toplevel(self)
+            self.search_window.title("Search")
+            self.search_label = ttk.Label(self.search_window)
+            self.search_label.pack(fill=tk.X, padx=5, pady=5)
+            self.search_results = scrolledtext.ScrolledText(self.search_window, state="disabled", height=20)
+            self.search_results.pack(fill=tk.BOTH, expand=True, padx=5)
+            nav = ttk.Frame(self.search_window)
+            nav.pack(fill=tk.X, padx=5, pady=5)
+            self.search_prev = ttk.Button(nav, text="[Previous]")
+            self.search_prev.pack(side=tk.LEFT)
+            self.search_next = ttk.Button(nav, text="[Next]")
+            self.search_next.pack(side=tk.RIGHT)
+        page, pages = batch["page"], batch["pages"]
+        query = self.search_query[1] if self.search_query else ""
+        self.search_label.config(text=f"'{query}' in {batch['channel']}: {batch['total']} matches, "
+                                      f"page {page} of {pages}")
+        self.search_prev.config(command=lambda: self.request_search(page - 1),
+                                state="normal" if page > 1 else "disabled")
+        self.search_next.config(command=lambda: self.request_search(page + 1),
+                                state="normal" if page < pages else "disabled")
+        lines = []
+        for line in batch["lines"]:
+            msg_id, _, text = line.partition(" ")
+            lines.append(f"{msg_id} {self.history_line(text)}")
+        self.search_results.config(state="normal")
+        self.search_results.delete("1.0", tk.END)
+        self.search_results.insert(tk.END, "\n".join(lines) if lines else "No matches.")
+        self.search_results.config(state="disabled")
+        self.search_window.lift()
+
+    def display_message(self, message):
+        self.append_to_channel_log(self.current_channel, message)
+
+    def display_image(self, image_bytes):
+        key = hashlib.sha256(image_bytes).hexdigest()
+        self.append_to_channel_log(self.current_channel, ("img", key, image_bytes))
 
     def append_to_channel_log(self, channel, message):
+        """Log a message; views render it at the end of the queue tick."""
         if channel not in self.chat_logs:
             self.chat_logs[channel] = []
         self.chat_logs[channel].append(message)
-        if self.current_channel == channel:
-            self.display_message(message)
 
     def update_channel_list(self, channels):
         self.channel_listbox.delete(0, tk.END)
@@ -221,39 +807,40 @@ class ChatClient(tk.Tk):
             self.channel_listbox.insert(tk.END, channel)
 
     def switch_channel(self, channel):
+        """Show a channel, reusing its cached view if it still has one."""
+        current = self.views.get(self.current_channel)
         self.current_channel = channel
         if channel not in self.chat_logs:
             self.chat_logs[channel] = []
-        self.chat_text.configure(state="normal")
-        self.chat_text.delete(1.0, tk.END)
-        for msg in self.chat_logs[channel]:
-            self.chat_text.insert(tk.END, msg + "\n")
-        self.chat_text.configure(state="disabled")
+        view = self.views.get(channel)
+        if view is None:
+            view = self.views[channel] = ChannelView(self, self.chat_area, channel)
+        else:
+            view.flush()
+        self.views.move_to_end(channel)
+        if current is not view:
+            if current is not None:
+                current.text.pack_forget()
+            view.text.pack(fill=tk.BOTH, expand=True)
+        while len(self.views) > CACHED_VIEWS:
+            self.views.popitem(last=False)[1].destroy()
 
     def join_channel_from_list(self, event):
         selection = self.channel_listbox.curselection()
         if selection:
             channel = self.channel_listbox.get(selection[0])
-            self.send_command(f"/join {channel}")
+            self.send_command(self.join_command(channel))
             self.switch_channel(channel)
 
     def send_message(self):
         msg = self.message_entry.get().strip()
         if msg and self.socket:
-            # Update username if using /nick.
-            if msg.startswith("/nick "):
-                parts = msg.split(" ", 1)
-                if len(parts) > 1:
-                    self.username = parts[1].strip()
             # Echo non-command messages locally with timestamp.
             if not msg.startswith("/"):
                 current_time = datetime.datetime.now().strftime('%H:%M')
                 formatted_msg = f"[{current_time} : {self.username}] {msg}"
-                if self.current_channel:
-                    self.append_to_channel_log(self.current_channel, formatted_msg)
-                else:
-                    self.display_message(formatted_msg)
-            self.socket.send(msg.encode())
+                self.append_to_channel_log(self.current_channel, formatted_msg)
+            self.send_command(msg)
             self.message_entry.delete(0, tk.END)
 
     def upload_image(self):
@@ -262,19 +849,31 @@ class ChatClient(tk.Tk):
             try:
                 with open(file_path, "rb") as f:
                     file_bytes = f.read()
-                b64_data = base64.b64encode(file_bytes).decode('utf-8')
                 current_time = datetime.datetime.now().strftime('%H:%M')
                 formatted_msg = f"[{current_time} : {self.username}] sent an image:"
-                if self.current_channel:
-                    self.append_to_channel_log(self.current_channel, formatted_msg)
-                else:
-                    self.display_message(formatted_msg)
+                self.append_to_channel_log(self.current_channel, formatted_msg)
                 self.display_image(file_bytes)
-                command = f"/img {self.username} {current_time} {b64_data}"
-                self.socket.send(command.encode())
+                if self.media:
+                    threading.Thread(target=self.send_media, args=(file_bytes, current_time),
+                                     daemon=True).start()
+                else:
+                    b64_data = base64.b64encode(file_bytes).decode('utf-8')
+                    command = f"/img {self.username} {current_time} {b64_data}"
+                    self.socket.sendall(encode_frame(command))
             except Exception as e:
                 messagebox.showerror("Image Error", f"Failed to send image: {e}")
 
+    def send_media(self, file_bytes, current_time):
+        """Upload an image on the media connection, then share its reference in the channel."""
+        try:
+            digest = self.media.upload(file_bytes)
+        except (OSError, MediaError, ProtocolError) as e:
+            self.msg_queue.put(("error", f"Failed to send image: {e}"))
+            return
+        self.media_cache.put(digest, "full", file_bytes)
+        # The chat socket belongs to the UI thread; hand the command back to it.
+        self.msg_queue.put(("send", f"/img {self.username} {current_time} {media_ref(digest)}"))
+
     def show_emoji_picker(self):
         picker = tk.Toplevel(self)
         picker.title("Emoji Picker")
@@ -288,12 +887,18 @@ class ChatClient(tk.Tk):
     
     def send_command(self, command):
         if self.socket:
-            self.socket.send(command.encode())
+            try:
+                self.socket.sendall(encode_frame(command))
+            except OSError:
+                pass   # The receive thread reports the lost connection.
 
     def on_closing(self):
+        self.decoder.shutdown(wait=False)
+        if self.media:
+            self.media.close()
         if self.socket:
             try:
-                self.socket.send("/quit".encode())
+                self.socket.sendall(encode_frame("/quit"))
             except:
                 pass
         self.running = False
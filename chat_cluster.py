@@ -0,0 +1,250 @@
+"""Multi-worker mode: several server processes on one port behind a local bus.
+
+    python chat_server.py --workers 4
+
+The supervisor runs a Broker on a Unix socket and starts the workers. Each
+worker is an ordinary server process that binds the same port with
+SO_REUSEPORT, so the kernel spreads connections across them. Workers publish
+cluster-wide events (channel creates, nickname claims and releases, channel
+messages, DMs) to the broker. The broker relays every event to every worker,
+including the one that sent it, in one global order. Every process applies
+the same events in the same order, so channel lists and nickname owners agree
+everywhere.
+
+The broker also numbers channel messages, so a message has the same history
+id on every worker, and keeps the last REPLAY_MESSAGES of each channel. A new
+or restarted worker reports the newest id it holds per channel in its hello
+and gets what it missed along with the state. If the broker no longer has
+all of it, the worker's history for that channel restarts at the replayed
+messages, so ids still agree but it holds less than the others.
+
+Nickname claims are optimistic: a worker checks its replica, answers the
+client at once and publishes the claim. If two workers claim the same name
+concurrently, the claim the broker ordered first wins everywhere; the loser
+is told the name is taken and keeps its old one.
+
+Resume tokens name the worker that issued them. A client that reconnects to
+another worker has that worker publish a "resume" request; the owner detaches
+the session and answers with a "handover" that moves its nickname to the
+requester in the same global order as every other claim.
+
+Events are JSON objects sent in protocol frames over the Unix socket.
+"""
+import asyncio, collections, json, os, signal, socket, subprocess, sys, tempfile, threading, time
+from chat_protocol import FrameDecoder, encode_frame
+
+REPLAY_MESSAGES = 1000
+
+def encode_event(event):
+    return encode_frame(json.dumps(event, separators=(",", ":")))
+
+def apply_state(state, event):
+    """Update replicated cluster state. Returns False if event is a losing nickname claim."""
+    op = event["op"]
+    owners = state["owners"]
+    if op == "create":
+        if event["channel"] not in state["channels"]:
+            state["channels"].append(event["channel"])
+    elif op == "nick":
+        worker = event["worker"]
+        if owners.get(event["nick"], worker) != worker:
+            return False
+        owners[event["nick"]] = worker
+        old = event.get("old")
+        if old and owners.get(old) == worker:
+            del owners[old]
+    elif op == "release":
+        if owners.get(event["nick"]) == event["worker"]:
+            del owners[event["nick"]]
+    elif op == "handover":
+        # A resumed session moving to the worker its client reconnected to.
+        if event["nick"] and owners.get(event["nick"]) == event["worker"]:
+            owners[event["nick"]] = event["to"]
+    return True
+
+def new_state():
+    return {"channels": [], "owners": {}}
+
+class Broker:
+    """Sequences events from all workers and fans them back out."""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = new_state()
+        self.workers = {}   # StreamWriter -> worker id
+        self.next_ids = {}  # channel -> id of its next message
+        self.recent = {}    # channel -> deque of (id, timestamp, text)
+
+    def number(self, event):
+        """Give a channel message its cluster-wide id and timestamp."""
+        channel = event["channel"]
+        msg_id = self.next_ids.get(channel, 1)
+        self.next_ids[channel] = msg_id + 1
+        event["id"] = msg_id
+        event["ts"] = time.time()
+        recent = self.recent.setdefault(channel, collections.deque(maxlen=REPLAY_MESSAGES))
+        recent.append((msg_id, event["ts"], event["text"]))
+
+    def hello_state(self, latest):
+        """State for a joining worker plus the messages it is missing."""
+        for channel, last_id in latest.items():
+            # After a broker restart, carry on from the ids workers already stored.
+            self.next_ids[channel] = max(self.next_ids.get(channel, 1), last_id + 1)
+        replay = {channel: [r for r in recent if r[0] > latest.get(channel, 0)]
+                  for channel, recent in self.recent.items()}
+        return {"op": "state", **self.state, "replay": replay}
+
+    async def handle_worker(self, reader, writer):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for flags, payload in decoder.feed(data):
+                    event = json.loads(payload)
+                    if event["op"] == "hello":
+                        # Bring a new or restarted worker up to date before it sees live events.
+                        writer.write(encode_event(self.hello_state(event.get("latest", {}))))
+                        self.workers[writer] = event["worker"]
+                        continue
+                    if event["op"] == "message":
+                        self.number(event)
+                    apply_state(self.state, event)
+                    frame = encode_event(event)
+                    for worker in list(self.workers):
+                        worker.write(frame)
+        except (ConnectionError, ValueError) as e:
+            print("Broker worker error:", e)
+        worker_id = self.workers.pop(writer, None)
+        if worker_id is not None:
+            self.release_worker(worker_id)
+        writer.close()
+
+    def release_worker(self, worker_id):
+        """Free every nickname a worker held once it is gone."""
+        for nick, owner in list(self.state["owners"].items()):
+            if owner == worker_id:
+                event = {"op": "release", "nick": nick, "worker": worker_id}
+                apply_state(self.state, event)
+                frame = encode_event(event)
+                for worker in list(self.workers):
+                    worker.write(frame)
+
+    async def serve(self, ready=None):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle_worker, self.path)
+        if ready:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+class ClusterBus:
+    """A worker's connection to the broker."""
+
+    def __init__(self, path, worker_id):
+        self.path = path
+        self.worker_id = worker_id
+        self.state = new_state()
+        self.lock = threading.Lock()
+        self.handler = None
+        self.dispatch = lambda fn, event: fn(event)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.decoder = FrameDecoder()
+
+    def connect(self, handler, latest=None, timeout=10):
+        """Connect, load the current cluster state and start applying events with handler.
+
+        latest maps channels to the newest message id this worker holds; the
+        messages it missed reach handler as "message" events before live ones.
+        Every relayed event is applied to self.state first; handler then gets it
+        with "accepted" set to False for a nickname claim that lost.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.sock.connect(self.path)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.handler = handler
+        self.sock.sendall(encode_event({"op": "hello", "worker": self.worker_id, "latest": latest or {}}))
+        frames = []
+        while not frames:
+            frames = self.decoder.feed(self.sock.recv(65536))
+        state = json.loads(frames.pop(0)[1])
+        self.state = {"channels": state["channels"], "owners": state["owners"]}
+        for channel, records in state["replay"].items():
+            for msg_id, ts, text in records:
+                self.dispatch(handler, {"op": "message", "channel": channel, "text": text,
+                                        "id": msg_id, "ts": ts, "worker": None})
+        threading.Thread(target=self._read_loop, args=(frames,), daemon=True).start()
+
+    def publish(self, event):
+        event["worker"] = self.worker_id
+        frame = encode_event(event)
+        with self.lock:
+            self.sock.sendall(frame)
+
+    def owner(self, nick):
+        return self.state["owners"].get(nick)
+
+    def _read_loop(self, frames):
+        while True:
+            for flags, payload in frames:
+                event = json.loads(payload)
+                event["accepted"] = apply_state(self.state, event)
+                self.dispatch(self.handler, event)
+            data = self.sock.recv(65536)
+            if not data:
+                print("Lost connection to cluster broker")
+                os._exit(1)
+            frames = self.decoder.feed(data)
+
+def worker_argv(argv, worker_id, bus_path):
+    """Command line for a worker: the supervisor's own arguments minus --workers."""
+    args = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "--workers":
+            skip = True
+        elif not arg.startswith("--workers="):
+            args.append(arg)
+    return args + ["--worker-id", str(worker_id), "--bus", bus_path]
+
+def run_cluster(script, argv, workers, bus_path=None):
+    """Run the broker and keep the worker processes running until interrupted."""
+    bus_path = bus_path or os.path.join(tempfile.gettempdir(), f"borg-chat-{os.getpid()}.sock")
+    broker = Broker(bus_path)
+    ready = threading.Event()
+    threading.Thread(target=lambda: asyncio.run(broker.serve(ready)), daemon=True).start()
+    ready.wait()
+
+    def spawn(worker_id):
+        return subprocess.Popen([sys.executable, script] + worker_argv(argv, worker_id, bus_path))
+
+    # Stop the workers too when the supervisor is terminated.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    procs = {i: spawn(i) for i in range(workers)}
+    print(f"Started {workers} workers on bus {bus_path}")
+    try:
+        while True:
+            time.sleep(1)
+            for worker_id, proc in list(procs.items()):
+                if proc.poll() is not None:
+                    print(f"Worker {worker_id} exited with {proc.returncode}; restarting")
+                    procs[worker_id] = spawn(worker_id)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs.values():
+            proc.send_signal(signal.SIGTERM)
+        for proc in procs.values():
+            proc.wait()
+        if os.path.exists(bus_path):
+            os.unlink(bus_path)
@@ -0,0 +1,280 @@
+"""Client connections with bounded outbound queues.
+
+Handlers never write to a socket directly. sendall() only appends an already
+framed message to the connection's queue and a per-connection writer drains
+it, so one slow reader cannot stall the sender or the rest of a channel.
+
+When a queue is full the slow-consumer policy decides what happens:
+
+    drop-oldest  discard the oldest queued frames to make room
+    disconnect   close the connection
+    coalesce     merge everything queued into one buffer (frames concatenate
+                 cleanly); disconnect if the byte limit is still exceeded
+
+Writers send everything queued in one system call (sendmsg with one buffer
+per frame, or one transport write on asyncio). A frame that finds the
+writer idle is sent at once. While a burst is under way (the last flush was
+less than batch_window_us ago) the threaded writer waits out the window
+first so more frames can join the batch; the asyncio writer yields one loop
+iteration. Sockets get TCP_NODELAY, because the writers already coalesce
+and Nagle's algorithm would only hold back the last frame of a burst.
+"""
+import asyncio, collections, socket, threading, time
+from chat_metrics import metrics
+
+POLICIES = ("drop-oldest", "disconnect", "coalesce")
+
+# Defaults used for new connections; start_server overrides them from the command line.
+outbound_config = {
+    "policy": "drop-oldest",
+    "max_frames": 4096,
+    "max_bytes": 32 * 1024 * 1024,
+    "batch_window_us": 250,          # 0 sends every batch as soon as the writer wakes
+    "batch_max_bytes": 256 * 1024,   # largest single write
+}
+
+# Buffers passed to one sendmsg; Linux rejects more than IOV_MAX (1024).
+MAX_IOV = 1024
+
+# Server-wide counters for slow-consumer handling.
+outbound_stats = {
+    "dropped_frames": 0,
+    "dropped_bytes": 0,
+    "coalesced": 0,
+    "slow_disconnects": 0,
+    "flushes": 0,       # writes to client sockets
+    "frames_sent": 0,   # frames those writes carried
+}
+
+def set_nodelay(sock):
+    """Turn off Nagle's algorithm on a TCP socket; the writers batch frames themselves."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+class Connection:
+    """Queueing logic shared by the threaded and asyncio connections."""
+
+    def __init__(self, policy=None, max_frames=None, max_bytes=None):
+        self.policy = policy or outbound_config["policy"]
+        self.max_frames = max_frames or outbound_config["max_frames"]
+        self.max_bytes = max_bytes or outbound_config["max_bytes"]
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.closing = False
+        self.closed = False
+        self.compress = False   # Set by the server when the client negotiated CAP_COMPRESS.
+        self.resume = False     # Set by the server when the client negotiated CAP_RESUME.
+        self.window = outbound_config["batch_window_us"] / 1e6
+        self.last_flush = 0.0
+
+    def depth(self):
+        return len(self.queue)
+
+    def bursting(self, now):
+        """True when the previous flush was recent enough that more frames are likely on the way."""
+        return self.window and now - self.last_flush < self.window
+
+    def _take_batch(self):
+        """Pop queued frames for one write, up to MAX_IOV frames and batch_max_bytes."""
+        batch = []
+        size = 0
+        limit = outbound_config["batch_max_bytes"]
+        while self.queue and len(batch) < MAX_IOV and (not batch or size + len(self.queue[0]) <= limit):
+            data = self.queue.popleft()
+            batch.append(data)
+            size += len(data)
+        self.queued_bytes -= size
+        outbound_stats["flushes"] += 1
+        outbound_stats["frames_sent"] += len(batch)
+        if metrics.enabled:
+            metrics.inc("chat_bytes_out_total", size)
+        return batch
+
+    def _enqueue(self, data):
+        """Queue data, applying the slow-consumer policy. Returns False if the connection must drop."""
+        if self.closing:
+            return True
+        size = len(data)
+        if len(self.queue) < self.max_frames and self.queued_bytes + size <= self.max_bytes:
+            self.queue.append(data)
+            self.queued_bytes += size
+            return True
+
+        if self.policy == "drop-oldest":
+            while self.queue and (len(self.queue) >= self.max_frames or self.queued_bytes + size > self.max_bytes):
+                old = self.queue.popleft()
+                self.queued_bytes -= len(old)
+                self.dropped += 1
+                outbound_stats["dropped_frames"] += 1
+                outbound_stats["dropped_bytes"] += len(old)
+            self.queue.append(data)
+            self.queued_bytes += size
+            return True
+
+        if self.policy == "coalesce" and self.queued_bytes + size <= self.max_bytes:
+            self.queue.append(data)
+            merged = b"".join(self.queue)
+            self.queue.clear()
+            self.queue.append(merged)
+            self.queued_bytes = len(merged)
+            outbound_stats["coalesced"] += 1
+            return True
+
+        outbound_stats["slow_disconnects"] += 1
+        return False
+
+class ThreadedConnection(Connection):
+    """Blocking socket drained by a dedicated writer thread.
+
+    With the server's reader thread that makes two OS threads, and two
+    stacks, per client; a server expecting thousands of connections should
+    use the asyncio engine instead.
+    """
+
+    def __init__(self, sock, **limits):
+        super().__init__(**limits)
+        self.sock = sock
+        self.cond = threading.Condition()
+        self.idle = False   # The writer is waiting for frames and needs a notify.
+        set_nodelay(sock)
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def sendall(self, data):
+        with self.cond:
+            if self._enqueue(data):
+                # A busy writer picks the frame up on its next batch without a wakeup.
+                if self.idle:
+                    self.cond.notify()
+                return
+        self.abort()
+
+    def _write_loop(self):
+        while True:
+            with self.cond:
+                self.idle = True
+                while not self.queue and not self.closing:
+                    self.cond.wait()
+                self.idle = False
+                if not self.queue:
+                    break
+                if len(self.queue) < MAX_IOV and not self.closing and self.bursting(time.monotonic()):
+                    self.cond.wait(self.window)
+                batch = self._take_batch()
+            try:
+                self._send_batch(batch)
+            except OSError:
+                break
+            self.last_flush = time.monotonic()
+        self._shutdown()
+
+    def _send_batch(self, batch):
+        """Write a batch with one sendmsg, looping only if the kernel takes part of it."""
+        if not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b"".join(batch))
+            return
+        while batch:
+            sent = self.sock.sendmsg(batch)
+            done = 0
+            while done < len(batch) and sent >= len(batch[done]):
+                sent -= len(batch[done])
+                done += 1
+            batch = batch[done:]
+            if sent:
+                batch[0] = memoryview(batch[0])[sent:]
+
+    def _shutdown(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def abort(self):
+        """Drop the connection now without flushing; wakes the reader with EOF."""
+        with self.cond:
+            self.closing = True
+            self.queue.clear()
+            self.queued_bytes = 0
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        """Flush whatever is queued, then close the socket."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+
+class AsyncConnection(Connection):
+    """asyncio stream drained by a writer task on the event loop."""
+
+    def __init__(self, writer, **limits):
+        super().__init__(**limits)
+        self.writer = writer
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            set_nodelay(sock)
+        self.ready = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def sendall(self, data):
+        if self._enqueue(data):
+            self.ready.set()
+        else:
+            self.abort()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                loop = asyncio.get_running_loop()
+                while self.queue:
+                    if self.bursting(loop.time()):
+                        # Let handlers on this loop iteration add to the batch.
+                        await asyncio.sleep(0)
+                    self.writer.writelines(self._take_batch())
+                    await self.writer.drain()
+                    self.last_flush = loop.time()
+                self.ready.clear()
+                if self.closing:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        self.closed = True
+        self.writer.close()
+
+    def abort(self):
+        self.closing = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.ready.set()
+        self.writer.transport.abort()
+
+    def close(self):
+        self.closing = True
+        self.ready.set()
+
+def outbound_metrics(connections):
+    """Queue depth summary plus the drop counters, for logging or /stats."""
+    depths = [conn.depth() for conn in connections]
+    metrics = dict(outbound_stats)
+    metrics.update({
+        "connections": len(depths),
+        "queued_frames": sum(depths),
+        "max_queue_depth": max(depths, default=0),
+        "queued_bytes": sum(conn.queued_bytes for conn in connections),
+    })
+    return metrics
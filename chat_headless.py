@@ -0,0 +1,192 @@
+"""Headless chat client and server-process helpers for scripts and benchmarks.
+
+    client = await HeadlessClient.connect("127.0.0.1", 12345)
+    await client.command("/create room", "Channel")
+    await client.command("/join room", "Joined channel")
+    client.send("hello")
+    print(await client.recv())
+
+HeadlessClient speaks the framed protocol over asyncio streams, so a single
+process can drive thousands of simulated users. spawn_server starts
+chat_server.py in a subprocess and ProcessStats samples its memory and CPU,
+including any cluster workers it started.
+"""
+import asyncio, collections, os, socket, subprocess, sys, time
+from chat_protocol import (CAP_RESUME, FLAG_ID, HELLO, FrameDecoder, decode_hello, encode_frame, encode_hello,
+                           split_id_frame)
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_server.py")
+
+# Benchmarks and load runs push connections far past the default rate limits on purpose.
+UNLIMITED = ["--frame-rate", "0", "--byte-rate", "0", "--channel-rate", "0", "--max-connections", "0",
+             "--media-byte-rate", "0"]
+
+class HeadlessClient:
+    """A chat connection driven from asyncio code."""
+
+    def __init__(self, reader, writer, caps=0):
+        self.reader = reader
+        self.writer = writer
+        self.caps = caps
+        self.decoder = FrameDecoder()
+        self.frames = collections.deque()
+        self.token = None      # Session token when CAP_RESUME was agreed.
+        self.last_id = 0       # Newest channel message id seen (CAP_RESUME).
+
+    @classmethod
+    async def connect(cls, host, port, caps=0, timeout=10):
+        """Open a connection, handshake and consume the welcome line."""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        writer.write(encode_hello(caps=caps))
+        version, agreed = decode_hello(await asyncio.wait_for(reader.readexactly(HELLO.size), timeout))
+        client = cls(reader, writer, agreed)
+        # The welcome line proves the server is actually servicing the connection.
+        await client.recv(timeout)
+        if agreed & CAP_RESUME:
+            client.token = (await client.recv(timeout)).rsplit(" ", 1)[-1]
+        return client
+
+    async def recv_frame(self, timeout=None):
+        """Next (flags, payload) from the server."""
+        while not self.frames:
+            data = await asyncio.wait_for(self.reader.read(65536), timeout)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.frames.extend(self.decoder.feed(data))
+        return self.frames.popleft()
+
+    async def recv(self, timeout=None):
+        """Next server message as text. Message ids go to last_id; frames holding only an id are consumed."""
+        while True:
+            flags, payload = await self.recv_frame(timeout)
+            if not flags & FLAG_ID:
+                return payload.decode("utf-8", errors="replace")
+            msg_id, text = split_id_frame(payload)
+            self.last_id = max(self.last_id, msg_id)
+            if text:
+                return text
+
+    def send(self, text):
+        self.writer.write(encode_frame(text))
+
+    async def command(self, text, expect, timeout=5):
+        """Send a command and wait for the reply starting with expect, skipping anything else."""
+        self.send(text)
+        await self.writer.drain()
+        while True:
+            reply = await self.recv(timeout)
+            if reply.startswith(expect):
+                return reply
+
+    def close(self):
+        self.writer.close()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def spawn_server(port, args=(), host="127.0.0.1", timeout=10, stdout=subprocess.DEVNULL):
+    """Start chat_server.py on host:port and wait until it accepts connections."""
+    proc = subprocess.Popen([sys.executable, SERVER, "--host", host, "--port", str(port)] + list(args),
+                            stdout=stdout, stderr=subprocess.STDOUT)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"server did not start on port {port}")
+
+def rss_mb(pid):
+    """Resident set size of a process in MiB (Linux only, None elsewhere)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def cpu_seconds(pid):
+    """User plus system CPU time of a process (Linux only, None elsewhere)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def child_pids(pid):
+    """Direct children of a process, found by scanning /proc."""
+    children = []
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return children
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            pass
+    return children
+
+class ProcessStats:
+    """Memory and CPU of a server process and its workers."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.reset()
+
+    def reset(self):
+        """Start a new measurement window."""
+        self.started = time.perf_counter()
+        self.cpu_start = self.cpu()
+        self.rss_start = self.rss()
+        self.rss_peak = self.rss_start
+
+    def pids(self):
+        return [self.pid] + child_pids(self.pid)
+
+    def rss(self):
+        values = [rss_mb(pid) for pid in self.pids()]
+        return sum(v for v in values if v is not None) if any(v is not None for v in values) else None
+
+    def cpu(self):
+        values = [cpu_seconds(pid) for pid in self.pids()]
+        return sum(v for v in values if v is not None) if any(v is not None for v in values) else None
+
+    def sample(self):
+        rss = self.rss()
+        if rss is not None and (self.rss_peak is None or rss > self.rss_peak):
+            self.rss_peak = rss
+        return rss
+
+    def summary(self):
+        """RSS at the start of the window, its peak and now, and CPU used in the window."""
+        elapsed = time.perf_counter() - self.started
+        cpu = self.cpu()
+        used = cpu - self.cpu_start if cpu is not None and self.cpu_start is not None else None
+        return {
+            "rss_mb_start": self.rss_start,
+            "rss_mb_peak": self.rss_peak,
+            "rss_mb_end": self.sample(),
+            "cpu_seconds": used,
+            "cpu_percent": 100 * used / elapsed if used is not None and elapsed else None,
+        }
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
@@ -0,0 +1,489 @@
+"""Channel history backends.
+
+Every stored message gets a per-channel id, counting up from 1, and a
+timestamp. Both backends keep the most recent messages of each channel in an
+in-memory ring so joins never touch the disk.
+
+Both apply retention by message count, bytes and age, oldest first.
+
+MemoryHistory   ring buffer only; history is gone on restart.
+SegmentHistory  append-only segment files per channel under a directory,
+                retention removing whole segments. Survives
+                restarts: only the newest segment of each channel is read
+                back at startup.
+
+Records are returned as (id, timestamp, text) tuples, oldest first.
+"""
+import collections, os, struct, threading, time
+from urllib.parse import quote, unquote
+
+RECORD = struct.Struct("!QdI")   # id, unix timestamp, text length
+SEGMENT_SUFFIX = ".log"
+# One file offset is indexed for every INDEX_STRIDE records, so a page read
+# seeks close to its first id instead of scanning the segment.
+INDEX_STRIDE = 128
+
+def record_bytes(record):
+    return RECORD.size + len(record[2].encode("utf-8"))
+
+class MemoryHistory:
+    """Bounded in-memory history: the last tail_size messages per channel, fewer
+    if max_messages, max_bytes (as SegmentHistory counts them) or max_age say so.
+    The newest message of a channel is always kept."""
+
+    def __init__(self, tail_size=1000, max_messages=None, max_bytes=None, max_age=None):
+        self.tail_size = min(tail_size, max_messages) if max_messages else tail_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.tails = {}
+        self.next_ids = {}
+        self.sizes = {}   # channel -> bytes held, kept only with max_bytes
+
+    def __contains__(self, channel):
+        return channel in self.tails
+
+    def channels(self):
+        return list(self.tails)
+
+    def create(self, channel):
+        with self.lock:
+            if channel in self.tails:
+                return False
+            self.tails[channel] = collections.deque(maxlen=self.tail_size)
+            self.next_ids[channel] = 1
+            return True
+
+    def append(self, channel, text, timestamp=None, msg_id=None):
+        """Store a message and return its id.
+
+        A cluster worker passes the id the broker assigned: one it already has
+        returns None, and one past a gap restarts the channel there.
+        """
+        with self.lock:
+            if channel not in self.tails:
+                self.tails[channel] = collections.deque(maxlen=self.tail_size)
+                self.next_ids[channel] = 1
+            if msg_id is None:
+                msg_id = self.next_ids[channel]
+            elif msg_id < self.next_ids[channel]:
+                return None
+            elif msg_id > self.next_ids[channel]:
+                self.tails[channel].clear()
+                self.sizes[channel] = 0
+            self.next_ids[channel] = msg_id + 1
+            tail = self.tails[channel]
+            record = (msg_id, timestamp or time.time(), text)
+            if self.max_bytes:
+                if len(tail) == tail.maxlen:
+                    self.sizes[channel] -= record_bytes(tail[0])
+                self.sizes[channel] = self.sizes.get(channel, 0) + record_bytes(record)
+            tail.append(record)
+            self._trim(channel, tail, time.time())
+            return msg_id
+
+    def _trim(self, channel, tail, now):
+        """Drop the oldest records past max_bytes or max_age."""
+        cutoff = now - self.max_age if self.max_age else None
+        while len(tail) > 1 and ((self.max_bytes and self.sizes[channel] > self.max_bytes)
+                                 or (cutoff and tail[0][1] < cutoff)):
+            record = tail.popleft()
+            if self.max_bytes:
+                self.sizes[channel] -= record_bytes(record)
+
+    def expire(self):
+        """Apply max_age to channels nobody has posted to lately."""
+        if not self.max_age:
+            return
+        now = time.time()
+        with self.lock:
+            for channel, tail in self.tails.items():
+                self._trim(channel, tail, now)
+
+    def restore(self, channel, next_id, records):
+        """Load a channel's history from a snapshot. Records that carry on from the
+        newest stored message (a handoff's delta) are added; others replace it."""
+        with self.lock:
+            tail = self.tails.get(channel)
+            if tail is None or (records and records[0][0] != self.next_ids[channel]):
+                tail = self.tails[channel] = collections.deque(maxlen=self.tail_size)
+            tail.extend(records)
+            self.next_ids[channel] = next_id
+            if self.max_bytes:
+                self.sizes[channel] = sum(map(record_bytes, tail))
+            self._trim(channel, tail, time.time())
+
+    def last(self, channel, count):
+        with self.lock:
+            tail = self.tails.get(channel)
+            if not tail or count <= 0:
+                return []
+            start = max(0, len(tail) - count)
+            return [tail[i] for i in range(start, len(tail))]
+
+    def before(self, channel, before_id, count):
+        """Up to count messages with ids below before_id."""
+        with self.lock:
+            if count <= 0:
+                return []
+            return _tail_before(self.tails.get(channel), before_id, count)
+
+    def latest_id(self, channel):
+        return self.next_ids.get(channel, 1) - 1
+
+    def first_id(self, channel):
+        """Oldest id still stored for a channel."""
+        tail = self.tails.get(channel)
+        return tail[0][0] if tail else self.next_ids.get(channel, 1)
+
+    def records(self, channel):
+        """Every stored record of a channel, oldest first."""
+        with self.lock:
+            return list(self.tails.get(channel, ()))
+
+    def stats(self):
+        with self.lock:
+            return {channel: {"messages": len(tail)} for channel, tail in self.tails.items()}
+
+    def close(self):
+        pass
+
+def _tail_before(tail, before_id, count, older_elsewhere=False):
+    """Serve a page of ids below before_id from a ring.
+
+    Returns None when older_elsewhere is set and the ring does not hold the
+    whole page, so the caller can go to disk instead.
+    """
+    if not tail:
+        return None if older_elsewhere else []
+    first_id = tail[0][0]
+    end = min(before_id, tail[-1][0] + 1) - first_id   # index of before_id in the ring
+    start = end - count
+    if start < 0:
+        if older_elsewhere:
+            return None
+        start = 0
+    return [tail[i] for i in range(start, max(end, 0))]
+
+class Segment:
+    """Metadata for one segment file; records themselves stay on disk."""
+
+    def __init__(self, path, first_id, last_id, size, last_ts):
+        self.path = path
+        self.first_id = first_id
+        self.last_id = last_id
+        self.size = size
+        self.last_ts = last_ts
+        self.index = []        # offsets of records first_id, first_id + INDEX_STRIDE, ...
+        self.indexed_size = 0  # bytes of the file covered by index
+
+    def note_append(self, msg_id, offset, length):
+        if self.indexed_size == offset:
+            if (msg_id - self.first_id) % INDEX_STRIDE == 0:
+                self.index.append(offset)
+            self.indexed_size = offset + RECORD.size + length
+
+    def offset_of(self, msg_id):
+        """File offset at or before the record msg_id, building the index on first use."""
+        if self.indexed_size < self.size:
+            with open(self.path, "rb") as f:
+                offset = self.indexed_size
+                f.seek(offset)
+                while offset + RECORD.size <= self.size:
+                    rec_id, ts, length = RECORD.unpack(f.read(RECORD.size))
+                    self.note_append(rec_id, offset, length)
+                    offset += RECORD.size + length
+                    f.seek(offset)
+        slot = (msg_id - self.first_id) // INDEX_STRIDE
+        if slot < 0 or not self.index:
+            return 0
+        return self.index[min(slot, len(self.index) - 1)]
+
+def read_records(path):
+    """Yield (id, timestamp, text, end offset) from a segment file, stopping at a torn tail."""
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        msg_id, ts, length = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        if start + length > len(data):
+            break
+        yield msg_id, ts, data[start:start + length].decode("utf-8", errors="replace"), start + length
+        offset = start + length
+
+class ChannelLog:
+    """Segments, active file handle and tail ring for one channel."""
+
+    def __init__(self, directory, tail_size):
+        self.directory = directory
+        self.segments = []
+        self.tail = collections.deque(maxlen=tail_size)
+        self.next_id = 1
+        self.file = None
+
+    def total_bytes(self):
+        return sum(seg.size for seg in self.segments)
+
+    def total_messages(self):
+        if not self.segments:
+            return 0
+        return self.segments[-1].last_id - self.segments[0].first_id + 1
+
+def channel_dirname(channel):
+    """The directory name of a channel: percent-quoted, with a leading dot escaped
+    too, so "." and ".." stay inside the history directory."""
+    name = quote(channel, safe="")
+    if name.startswith("."):
+        name = "%2E" + name[1:]
+    return name
+
+class SegmentHistory:
+    """Persistent history in segmented append-only logs.
+
+    Layout: <directory>/<channel_dirname>/<first id>.log. A segment is closed
+    once it passes segment_bytes; retention then removes whole segments from
+    the old end, so the newest messages are always kept.
+    """
+
+    def __init__(self, directory, tail_size=1000, segment_bytes=4 * 1024 * 1024,
+                 max_messages=None, max_bytes=None, max_age=None, fsync=False):
+        self.directory = directory
+        self.tail_size = tail_size
+        self.segment_bytes = segment_bytes
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.logs = {}
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def __contains__(self, channel):
+        return channel in self.logs
+
+    def channels(self):
+        return list(self.logs)
+
+    def recover(self):
+        """Rebuild segment metadata and tail rings from disk."""
+        for entry in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, entry)
+            if not os.path.isdir(path):
+                continue
+            if channel_dirname(unquote(entry)) != entry:
+                print("History error: skipping unknown directory", path)
+                continue
+            self.logs[unquote(entry)] = self._recover_channel(path)
+
+    def _recover_channel(self, path):
+        log = ChannelLog(path, self.tail_size)
+        names = sorted(n for n in os.listdir(path) if n.endswith(SEGMENT_SUFFIX))
+        first_ids = [int(n[:-len(SEGMENT_SUFFIX)]) for n in names]
+        for i, (name, first_id) in enumerate(zip(names, first_ids)):
+            seg_path = os.path.join(path, name)
+            st = os.stat(seg_path)
+            # Sealed segments end right before the next one starts; mtime is their newest write.
+            last_id = first_ids[i + 1] - 1 if i + 1 < len(first_ids) else first_id - 1
+            log.segments.append(Segment(seg_path, first_id, last_id, st.st_size, st.st_mtime))
+        if log.segments:
+            active = log.segments[-1]
+            good = 0
+            for msg_id, ts, text, end in read_records(active.path):
+                active.last_id = msg_id
+                active.last_ts = ts
+                good = end
+            if good != active.size:
+                # Drop a record torn by a crash mid-write.
+                with open(active.path, "r+b") as f:
+                    f.truncate(good)
+                active.size = good
+            log.next_id = active.last_id + 1
+            self._fill_tail(log)
+            self._enforce_retention(log)
+        return log
+
+    def _fill_tail(self, log):
+        records = []
+        for seg in reversed(log.segments):
+            records[:0] = [r[:3] for r in read_records(seg.path)]
+            if len(records) >= self.tail_size:
+                break
+        log.tail.extend(records[-self.tail_size:])
+
+    def create(self, channel):
+        with self.lock:
+            if channel in self.logs:
+                return False
+            self._create(channel)
+            return True
+
+    def _create(self, channel):
+        name = channel_dirname(channel)
+        if not channel or unquote(name) != channel:
+            raise ValueError(f"channel name {channel!r} cannot be stored")
+        path = os.path.join(self.directory, name)
+        os.makedirs(path, exist_ok=True)
+        log = self.logs[channel] = ChannelLog(path, self.tail_size)
+        return log
+
+    def append(self, channel, text, timestamp=None, msg_id=None):
+        """Store a message and return its id.
+
+        A cluster worker passes the id the broker assigned: one it already has
+        returns None, and one past a gap restarts the channel there, since
+        segments and the ring only hold consecutive ids.
+        """
+        timestamp = timestamp or time.time()
+        data = text.encode("utf-8")
+        with self.lock:
+            log = self.logs.get(channel) or self._create(channel)
+            if msg_id is None:
+                msg_id = log.next_id
+            elif msg_id < log.next_id:
+                return None
+            elif msg_id > log.next_id:
+                self._reset(log, msg_id)
+            if log.file is None or log.segments[-1].size >= self.segment_bytes:
+                self._roll(log, msg_id)
+            seg = log.segments[-1]
+            log.file.write(RECORD.pack(msg_id, timestamp, len(data)) + data)
+            log.file.flush()
+            if self.fsync:
+                os.fsync(log.file.fileno())
+            seg.note_append(msg_id, seg.size, len(data))
+            seg.last_id = msg_id
+            seg.last_ts = timestamp
+            seg.size += RECORD.size + len(data)
+            log.next_id = msg_id + 1
+            log.tail.append((msg_id, timestamp, text))
+            return msg_id
+
+    def _reset(self, log, next_id):
+        if log.file is not None:
+            log.file.close()
+            log.file = None
+        for seg in log.segments:
+            os.remove(seg.path)
+        log.segments.clear()
+        log.tail.clear()
+        log.next_id = next_id
+
+    def _roll(self, log, first_id):
+        if log.file is not None:
+            log.file.close()
+        if not log.segments or log.segments[-1].size >= self.segment_bytes:
+            path = os.path.join(log.directory, f"{first_id:020d}{SEGMENT_SUFFIX}")
+            log.segments.append(Segment(path, first_id, first_id - 1, 0, time.time()))
+            self._enforce_retention(log)
+        log.file = open(log.segments[-1].path, "ab")
+
+    def _enforce_retention(self, log):
+        """Delete whole sealed segments from the old end until every limit is met."""
+        now = time.time()
+        while len(log.segments) > 1:
+            oldest = log.segments[0]
+            over = ((self.max_messages and log.total_messages() - (oldest.last_id - oldest.first_id + 1) >= self.max_messages)
+                    or (self.max_bytes and log.total_bytes() > self.max_bytes)
+                    or (self.max_age and now - oldest.last_ts > self.max_age))
+            if not over:
+                break
+            os.remove(oldest.path)
+            log.segments.pop(0)
+
+    def expire(self):
+        """Apply max_age to every channel, including quiet ones.
+
+        Retention otherwise only runs when a segment is rolled, so the server
+        calls this periodically. A channel whose newest segment has aged out
+        starts an empty one at its next id: the old one can then be removed
+        and the id counter still survives a restart.
+        """
+        if not self.max_age:
+            return
+        cutoff = time.time() - self.max_age
+        with self.lock:
+            for log in self.logs.values():
+                newest = log.segments[-1] if log.segments else None
+                if newest and newest.size and newest.last_ts < cutoff:
+                    if log.file is not None:
+                        log.file.close()
+                    path = os.path.join(log.directory, f"{log.next_id:020d}{SEGMENT_SUFFIX}")
+                    log.segments.append(Segment(path, log.next_id, log.next_id - 1, 0, time.time()))
+                    log.file = open(path, "ab")
+                self._enforce_retention(log)
+                while log.tail and log.tail[0][1] < cutoff:
+                    log.tail.popleft()
+
+    def last(self, channel, count):
+        return self.before(channel, self.latest_id(channel) + 1, count)
+
+    def before(self, channel, before_id, count):
+        """Up to count messages with ids below before_id, from the ring when possible."""
+        with self.lock:
+            log = self.logs.get(channel)
+            if not log or count <= 0:
+                return []
+            # Disk only matters when it still holds ids older than the ring.
+            older_on_disk = bool(log.segments) and (not log.tail or log.segments[0].first_id < log.tail[0][0])
+            page = _tail_before(log.tail, before_id, count, older_on_disk)
+            if page is not None:
+                return page
+            return self._read_range(log, before_id - count, before_id)
+
+    def _read_range(self, log, start_id, end_id):
+        records = []
+        for seg in log.segments:
+            if seg.last_id < start_id or seg.first_id >= end_id:
+                continue
+            offset = seg.offset_of(start_id)
+            with open(seg.path, "rb") as f:
+                f.seek(offset)
+                while offset + RECORD.size <= seg.size:
+                    msg_id, ts, length = RECORD.unpack(f.read(RECORD.size))
+                    if msg_id >= end_id:
+                        break
+                    if msg_id >= start_id:
+                        records.append((msg_id, ts, f.read(length).decode("utf-8", errors="replace")))
+                    else:
+                        f.seek(length, os.SEEK_CUR)
+                    offset += RECORD.size + length
+        return records
+
+    def latest_id(self, channel):
+        log = self.logs.get(channel)
+        return log.next_id - 1 if log else 0
+
+    def first_id(self, channel):
+        """Oldest id still stored for a channel."""
+        log = self.logs.get(channel)
+        if not log:
+            return 1
+        return log.segments[0].first_id if log.segments else log.next_id
+
+    def records(self, channel):
+        """Every stored record of a channel, oldest first, read one segment at a time."""
+        with self.lock:
+            log = self.logs.get(channel)
+            segments = list(log.segments) if log else []
+        for seg in segments:
+            try:
+                for msg_id, ts, text, end in read_records(seg.path):
+                    yield msg_id, ts, text
+            except FileNotFoundError:
+                # Retention removed it while we were reading older ones.
+                continue
+
+    def stats(self):
+        with self.lock:
+            return {channel: {"messages": log.total_messages(), "bytes": log.total_bytes(),
+                              "segments": len(log.segments), "tail": len(log.tail)}
+                    for channel, log in self.logs.items()}
+
+    def close(self):
+        with self.lock:
+            for log in self.logs.values():
+                if log.file is not None:
+                    log.file.close()
+                    log.file = None
@@ -0,0 +1,127 @@
+"""Rate limits, frame size and admission control for client connections.
+
+Every chat connection has two token buckets, one counting frames and one
+counting payload bytes, and every channel has one counting the messages
+posted to it. A bucket never refuses: taking tokens can put it into debt,
+and the reader then sleeps until the debt is paid before it handles the
+frame. While it sleeps nothing is read from the socket, so a flooding client
+fills its TCP window and the kernel stops it; the server buffers at most one
+read of its data.
+
+Channel buckets are per process; with --workers each worker enforces the
+channel rate on its own senders. Media connections have one byte bucket of
+their own, sized for image uploads, besides admission; the media store's
+quota bounds what their uploads can leave on disk.
+
+Chat frames larger than max_frame_bytes end the connection, as does any
+other frame the decoder refuses. Connections accepted past max_connections
+are closed straight away, and one that holds a slot but sends no hello
+within handshake_timeout seconds is closed to free it.
+"""
+import threading, time
+
+# A rate of 0 turns that limit off, as does max_connections = 0.
+limit_config = {
+    "frame_rate": 20,                  # frames per second per connection
+    "frame_burst": 50,
+    "byte_rate": 256 * 1024,           # payload bytes per second per connection
+    "byte_burst": 2 * 1024 * 1024,
+    "channel_rate": 200,               # messages per second per channel
+    "channel_burst": 500,
+    "max_frame_bytes": 1024 * 1024,    # largest frame on a chat connection
+    "media_byte_rate": 4 * 1024 * 1024,  # payload bytes per second per media connection
+    "media_byte_burst": 16 * 1024 * 1024,
+    "max_connections": 10000,
+    "handshake_timeout": 10,           # seconds to wait for a new connection's hello
+}
+
+# Counters since startup, shown with --stats-interval and in the metrics.
+limit_stats = {"throttled_frames": 0, "throttled_seconds": 0.0, "rejected_frames": 0, "refused_connections": 0}
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, amount=1, now=None):
+        """Spend amount tokens. Returns the seconds until the bucket is out of debt, 0 if it is not in debt."""
+        now = now or time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+def bucket(rate_key, burst_key):
+    rate = limit_config[rate_key]
+    return TokenBucket(rate, max(1, limit_config[burst_key])) if rate else None
+
+# Channel -> TokenBucket. Buckets are shared by the threads posting to a channel;
+# an unlucky interleaving can only let the odd extra message through.
+channel_buckets = {}
+
+def channel_bucket(channel):
+    found = channel_buckets.get(channel)
+    if found is None and limit_config["channel_rate"]:
+        found = channel_buckets.setdefault(channel, bucket("channel_rate", "channel_burst"))
+    return found
+
+def is_post(payload):
+    """Frames that are posted to the current channel: chat text and images."""
+    return not payload.startswith(b"/") or payload.startswith(b"/img ")
+
+class ConnectionLimits:
+    """The buckets of one chat connection, or the byte bucket of a media connection."""
+
+    def __init__(self, media=False):
+        if media:
+            self.frames = None
+            self.bytes = bucket("media_byte_rate", "media_byte_burst")
+        else:
+            self.frames = bucket("frame_rate", "frame_burst")
+            self.bytes = bucket("byte_rate", "byte_burst")
+
+    def delay(self, session, payload):
+        """Charge a frame to the connection's buckets and, for a post, its channel's.
+        session is None on a media connection. Returns how long the reader must
+        wait before handling the frame."""
+        now = time.monotonic()
+        wait = 0
+        if self.frames:
+            wait = self.frames.take(1, now)
+        if self.bytes:
+            wait = max(wait, self.bytes.take(len(payload), now))
+        if session and session.channel and is_post(payload):
+            channel = channel_bucket(session.channel)
+            if channel:
+                wait = max(wait, channel.take(1, now))
+        if wait:
+            limit_stats["throttled_frames"] += 1
+            limit_stats["throttled_seconds"] += wait
+        return wait
+
+class Admission:
+    """Counts open connections against max_connections."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def enter(self):
+        """Take a connection slot; False (and counted as refused) when the server is full."""
+        with self.lock:
+            limit = limit_config["max_connections"]
+            if limit and self.active >= limit:
+                limit_stats["refused_connections"] += 1
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+admission = Admission()
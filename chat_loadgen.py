@@ -0,0 +1,304 @@
+"""Load generator: simulated users against a chat server, with JSON results.
+
+    python chat_loadgen.py --users 500 --channels 20 --rate 0.5 --duration 30 --output run.json
+    python chat_loadgen.py --engine asyncio --server-arg=--slow-policy=coalesce
+    python chat_loadgen.py --connect 127.0.0.1:12345 --users 100
+
+Without --connect it starts chat_server.py itself, so the server's RSS and
+CPU can be reported. Its rate and connection limits are off, as in
+chat_bench; --server-arg passes extra flags through, and the JSON records the
+server's full command line. Each user sets
+a nickname, joins one of the channels and then acts at --rate times per
+second with Poisson arrivals. An action is a move to another channel with
+probability --churn, a DM to a random user with --dm-ratio, an image with
+--img-ratio, and otherwise a channel message padded to --size bytes.
+
+Text messages carry their send time, so receivers measure end-to-end latency
+for channel messages and DMs. Counters and latencies cover only the
+--duration window after --warmup. Runs with the same --seed make the same
+choices, and the JSON includes the commit, so runs can be compared across
+commits.
+"""
+import argparse, asyncio, base64, collections, datetime, json, os, random, re, shutil, struct
+import subprocess, sys, tempfile, time, zlib
+from chat_headless import UNLIMITED, HeadlessClient, ProcessStats, free_port, percentile, spawn_server
+from chat_media import MediaClient, media_ref
+from chat_protocol import CAP_COMPRESS, CAP_MEDIA
+
+LOAD_RE = re.compile(r"lg:(\d+):")
+HISTORY_RE = re.compile(r"^History for '.*' from #\d+: (\d+) messages$")
+
+def make_png(size, seed=0):
+    """A valid RGB PNG of random pixels, roughly size bytes (noise does not compress)."""
+    rng = random.Random(seed)
+    side = max(1, int((size / 3) ** 0.5))
+    rows = b"".join(b"\x00" + rng.randbytes(side * 3) for _ in range(side))
+
+    def chunk(kind, data):
+        return struct.pack("!I", len(data)) + kind + data + struct.pack("!I", zlib.crc32(kind + data))
+
+    header = struct.pack("!IIBBBBB", side, side, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+class LoadStats:
+    def __init__(self):
+        self.measuring = False
+        self.sent = collections.Counter()
+        self.received = collections.Counter()
+        self.latencies = {"message": [], "dm": []}
+        self.errors = 0
+
+class LoadUser:
+    def __init__(self, index, client, nickname, channel):
+        self.index = index
+        self.client = client
+        self.nickname = nickname
+        self.channel = channel
+
+async def read_loop(user, stats):
+    """Count what a user receives and time the messages that carry a send time."""
+    skip = 0
+    try:
+        while True:
+            text = await user.client.recv()
+            now = time.perf_counter_ns()
+            if skip:
+                # History replayed by /join is old traffic, not a delivery.
+                skip -= 1
+                continue
+            match = HISTORY_RE.match(text)
+            if match:
+                skip = int(match.group(1))
+                continue
+            if not stats.measuring:
+                continue
+            if text.startswith("/img "):
+                stats.received["img"] += 1
+                continue
+            match = LOAD_RE.search(text)
+            if not match:
+                stats.received["other"] += 1
+                continue
+            kind = "dm" if text.startswith("DM from ") else "message"
+            stats.received[kind] += 1
+            stats.latencies[kind].append((now - int(match.group(1))) / 1e6)
+    except (ConnectionError, OSError):
+        stats.errors += 1
+
+async def send_loop(user, users, channels, image_ref, args, stats, rng, stop):
+    padding = "x" * max(0, args.size - 30)
+    try:
+        while not stop.is_set():
+            await asyncio.sleep(rng.expovariate(args.rate))
+            roll = rng.random()
+            stamp = time.perf_counter_ns()
+            if roll < args.churn:
+                channel = rng.choice(channels)
+                if channel == user.channel:
+                    continue
+                user.client.send(f"/join {channel}")
+                user.channel = channel
+                kind = "join"
+            elif roll < args.churn + args.dm_ratio:
+                target = rng.choice(users)
+                user.client.send(f"/dm {target.nickname} lg:{stamp}:{padding}")
+                kind = "dm"
+            elif roll < args.churn + args.dm_ratio + args.img_ratio:
+                user.client.send(f"/img {user.nickname} {datetime.datetime.now():%H:%M} {image_ref}")
+                kind = "img"
+            else:
+                user.client.send(f"lg:{stamp}:{padding}")
+                kind = "message"
+            await user.client.writer.drain()
+            if stats.measuring:
+                stats.sent[kind] += 1
+    except (ConnectionError, OSError):
+        stats.errors += 1
+
+async def connect_user(index, host, port, channels, args):
+    caps = CAP_MEDIA | CAP_COMPRESS if args.compress else CAP_MEDIA
+    client = await HeadlessClient.connect(host, port, caps, args.timeout)
+    nickname = f"{args.nick_prefix}{index}"
+    reply = await client.command(f"/nick {nickname}", "Nickname", args.timeout)
+    if not reply.startswith("Nickname changed"):
+        raise RuntimeError(reply)
+    channel = channels[index % len(channels)]
+    await client.command(f"/join {channel}", "Joined channel", args.timeout)
+    return LoadUser(index, client, nickname, channel)
+
+def prepare_image(host, port, caps, size, seed):
+    """Upload a test image if the server has a media store; returns what /img should carry."""
+    data = make_png(size, seed)
+    if caps & CAP_MEDIA:
+        media = MediaClient(host, port)
+        try:
+            return media_ref(media.upload(data))
+        finally:
+            media.close()
+    return base64.b64encode(data).decode("ascii")
+
+async def run_load(host, port, args, server_stats=None):
+    rng = random.Random(args.seed)
+    channels = [f"load{i}" for i in range(args.channels)]
+    setup = await HeadlessClient.connect(host, port, CAP_MEDIA, args.timeout)
+    for channel in channels:
+        await setup.command(f"/create {channel}", "Channel", args.timeout)
+    loop = asyncio.get_running_loop()
+    image_ref = await loop.run_in_executor(None, prepare_image, host, port, setup.caps, args.img_bytes, args.seed)
+    # Give cluster workers time to see the new channels on the bus.
+    await asyncio.sleep(0.2)
+
+    users = []
+    for start in range(0, args.users, args.connect_batch):
+        batch = range(start, min(args.users, start + args.connect_batch))
+        results = await asyncio.gather(*(connect_user(i, host, port, channels, args) for i in batch),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                print("Connect error:", result)
+            else:
+                users.append(result)
+    if not users:
+        raise RuntimeError("no users connected")
+    rss_idle = server_stats.sample() if server_stats else None
+
+    stats = LoadStats()
+    stop = asyncio.Event()
+    readers = [asyncio.create_task(read_loop(user, stats)) for user in users]
+    senders = [asyncio.create_task(send_loop(user, users, channels, image_ref, args, stats,
+                                             random.Random(rng.random()), stop))
+               for user in users]
+    await asyncio.sleep(args.warmup)
+
+    if server_stats:
+        server_stats.reset()
+    own_cpu = sum(os.times()[:2])
+    stats.measuring = True
+    started = time.perf_counter()
+    deadline = started + args.duration
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(min(0.5, max(0, deadline - time.perf_counter())))
+        if server_stats:
+            server_stats.sample()
+    stop.set()
+    elapsed = time.perf_counter() - started
+    server = server_stats.summary() if server_stats else {}
+    # Let messages already sent arrive before closing.
+    await asyncio.sleep(args.drain)
+    stats.measuring = False
+    own_cpu = sum(os.times()[:2]) - own_cpu
+    for task in senders + readers:
+        task.cancel()
+    for user in users:
+        user.client.close()
+    setup.close()
+
+    delivered = stats.received["message"] + stats.received["dm"] + stats.received["img"]
+    return {
+        "users": len(users),
+        "seconds": elapsed,
+        "sent": dict(stats.sent),
+        "received": dict(stats.received),
+        "errors": stats.errors,
+        "throughput": {
+            "sent_per_sec": sum(stats.sent.values()) / elapsed,
+            "delivered_per_sec": delivered / elapsed,
+        },
+        "latency_ms": {kind: {"count": len(values),
+                              "p50": percentile(values, 50),
+                              "p90": percentile(values, 90),
+                              "p99": percentile(values, 99),
+                              "max": max(values, default=None)}
+                       for kind, values in stats.latencies.items()},
+        "server": dict(server, rss_mb_idle=rss_idle) if server_stats else None,
+        "loadgen_cpu_percent": 100 * own_cpu / elapsed,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def print_summary(result):
+    print(f"users {result['users']}  seconds {result['seconds']:.1f}  errors {result['errors']}")
+    print("sent     ", " ".join(f"{k}={v}" for k, v in sorted(result["sent"].items())))
+    print("received ", " ".join(f"{k}={v}" for k, v in sorted(result["received"].items())))
+    print(f"throughput  sent {result['throughput']['sent_per_sec']:.0f}/s"
+          f"  delivered {result['throughput']['delivered_per_sec']:.0f}/s")
+    for kind, lat in result["latency_ms"].items():
+        if lat["count"]:
+            print(f"latency {kind:8} p50 {lat['p50']:.2f} ms  p90 {lat['p90']:.2f} ms"
+                  f"  p99 {lat['p99']:.2f} ms  max {lat['max']:.2f} ms  (n={lat['count']})")
+    server = result["server"]
+    if server and server["rss_mb_peak"] is not None:
+        print(f"server   rss idle {server['rss_mb_idle']:.1f} MiB  peak {server['rss_mb_peak']:.1f} MiB"
+              f"  cpu {server['cpu_percent']:.0f}%")
+    print(f"loadgen  cpu {result['loadgen_cpu_percent']:.0f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connect", help="host:port of a running server (default: start one)")
+    parser.add_argument("--engine", default="asyncio", help="engine for the server this starts")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes for the server this starts")
+    parser.add_argument("--server-arg", action="append", default=[], help="extra flag for the server this starts")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=1.0, help="actions per user per second")
+    parser.add_argument("--size", type=int, default=100, help="bytes per text message")
+    parser.add_argument("--img-ratio", type=float, default=0.02)
+    parser.add_argument("--img-bytes", type=int, default=32 * 1024)
+    parser.add_argument("--dm-ratio", type=float, default=0.1)
+    parser.add_argument("--churn", type=float, default=0.02, help="share of actions that switch channel")
+    parser.add_argument("--compress", action="store_true", help="users ask for compressed frames")
+    parser.add_argument("--duration", type=float, default=20, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for in-flight messages")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--connect-batch", type=int, default=200)
+    parser.add_argument("--nick-prefix", default="lg")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", help="free-form name stored in the results")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+    if args.rate <= 0 or args.users < 1 or args.channels < 1:
+        parser.error("--rate, --users and --channels must be positive")
+
+    started = datetime.datetime.now().isoformat(timespec="seconds")
+    proc = media_dir = server_args = None
+    if args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", free_port()
+        media_dir = tempfile.mkdtemp(prefix="chat-loadgen-media-")
+        # Rate limits off like chat_bench; --server-arg can turn them back on.
+        server_args = ["--engine", args.engine, "--media-dir", media_dir] + UNLIMITED
+        if args.workers:
+            server_args += ["--workers", str(args.workers)]
+        server_args += args.server_arg
+        proc = spawn_server(port, server_args)
+    try:
+        result = asyncio.run(run_load(host, port, args, ProcessStats(proc.pid) if proc else None))
+    finally:
+        if proc:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if media_dir:
+            shutil.rmtree(media_dir, ignore_errors=True)
+
+    result = {"label": args.label, "commit": git_commit(), "python": sys.version.split()[0],
+              "started": started,
+              "config": vars(args), "server_args": server_args, **result}
+    print_summary(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print("Wrote", args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+"""Out-of-band image transfer.
+
+Images no longer travel inline as base64 in /img. A client uploads the raw
+bytes over a separate media connection (hello with MEDIA_CONNECTION), and the
+chat message only carries a reference, "sha256:<hex digest>". Blobs are
+content addressed, so an image shared many times is stored once.
+
+Media connection commands (text frames):
+
+    /upload <digest> <size>   server answers "Upload <digest> at <offset>" to
+                              resume a partial upload, or "Stored <digest>" if
+                              the blob is already there
+    /fetch <digest> [thumb]   server answers "Media <digest> <kind> <size>"
+                              followed by the bytes, or "Media <digest> missing"
+
+Bytes move in FLAG_BINARY frames that start with a CHUNK header (raw digest,
+offset). The server hashes each chunk as it arrives; when an upload
+completes it checks the digest, answers "Stored <digest>" and renders a
+thumbnail if Pillow is installed and the image has at most THUMB_MAX_PIXELS
+pixels. Fetches are read and sent a chunk at a time.
+
+The store holds at most quota bytes of blobs, thumbnails and partial
+uploads. An upload that does not fit is refused, or fails mid-way, with
+"media store is full". Partial uploads untouched for part_ttl seconds are
+deleted by sweep(), which gives their space back.
+"""
+import collections, hashlib, os, re, socket, struct, threading, time, warnings
+from concurrent.futures import ThreadPoolExecutor
+from chat_protocol import (FLAG_BINARY, MEDIA_CONNECTION, FrameDecoder, ProtocolError,
+                           client_handshake, encode_frame)
+
+try:
+    from PIL import Image
+    # Pillow only warns between MAX_IMAGE_PIXELS and twice that; refuse those too.
+    warnings.simplefilter("error", Image.DecompressionBombWarning)
+except ImportError:  # Thumbnails are optional; full images are served instead.
+    Image = None
+
+CHUNK = struct.Struct("!32sQ")   # sha256 digest, offset
+CHUNK_SIZE = 256 * 1024
+MEDIA_REF_PREFIX = "sha256:"
+THUMB_WIDTH = 200
+THUMB_MAX_PIXELS = 50_000_000    # larger images are served without a thumbnail
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+class MediaError(Exception):
+    """An upload or fetch that cannot be completed."""
+
+def media_ref(hexdigest):
+    return MEDIA_REF_PREFIX + hexdigest
+
+def parse_media_ref(ref):
+    """Return the hex digest of a media reference, or None for inline data."""
+    if ref.startswith(MEDIA_REF_PREFIX):
+        digest = ref[len(MEDIA_REF_PREFIX):]
+        if DIGEST_RE.match(digest):
+            return digest
+    return None
+
+def chunk_frames(hexdigest, data, start=0):
+    """Frame data as binary chunks, beginning at offset start."""
+    raw = bytes.fromhex(hexdigest)
+    view = memoryview(data)
+    return [encode_frame(CHUNK.pack(raw, offset) + view[offset:offset + CHUNK_SIZE], FLAG_BINARY)
+            for offset in range(start, len(data), CHUNK_SIZE)]
+
+class Upload:
+    """An upload in progress: its declared size and the hash of the bytes written so far."""
+
+    def __init__(self, size, sha, offset):
+        self.size = size
+        self.sha = sha
+        self.offset = offset
+        self.stamp = time.time()   # last activity, for sweep()
+
+def hash_file(path, length):
+    """sha256 of the first length bytes of a file."""
+    sha = hashlib.sha256()
+    if not length:
+        return sha
+    with open(path, "rb") as f:
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            sha.update(data)
+            length -= len(data)
+    return sha
+
+class MediaStore:
+    """Content-addressed blob store: <directory>/<first 2 hex>/<digest>."""
+
+    def __init__(self, directory, max_size=16 * 1024 * 1024, quota=None, part_ttl=24 * 3600):
+        self.directory = directory
+        self.max_size = max_size
+        self.quota = quota
+        self.part_ttl = part_ttl
+        self.lock = threading.Lock()
+        self.uploads = {}   # digest -> Upload
+        self.thumbnailer = ThreadPoolExecutor(max_workers=1) if Image else None
+        os.makedirs(directory, exist_ok=True)
+        self.used = 0       # bytes on disk
+        self.sweep()
+
+    def path(self, hexdigest, suffix=""):
+        return os.path.join(self.directory, hexdigest[:2], hexdigest + suffix)
+
+    def has(self, hexdigest):
+        return bool(DIGEST_RE.match(hexdigest)) and os.path.exists(self.path(hexdigest))
+
+    def begin_upload(self, hexdigest, size):
+        """Declare an upload; returns the offset to resume from."""
+        if not DIGEST_RE.match(hexdigest):
+            raise MediaError("bad digest")
+        if not 0 < size <= self.max_size:
+            raise MediaError(f"size must be between 1 and {self.max_size} bytes")
+        with self.lock:
+            if os.path.exists(self.path(hexdigest)):
+                return size
+            os.makedirs(os.path.dirname(self.path(hexdigest)), exist_ok=True)
+            part = self.path(hexdigest, ".part")
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset > size:
+                os.remove(part)
+                offset = 0
+            if self.quota and self.used + size - offset > self.quota:
+                raise MediaError("media store is full")
+            upload = self.uploads.get(hexdigest)
+            if upload is None or upload.offset != offset:
+                # Resuming an upload left by an earlier connection or process.
+                upload = self.uploads[hexdigest] = Upload(size, hash_file(part, offset), offset)
+            upload.size = size
+            upload.stamp = time.time()
+            return offset
+
+    def sweep(self):
+        """Delete partial uploads idle for part_ttl seconds and recount the bytes on disk."""
+        cutoff = time.time() - self.part_ttl
+        with self.lock:
+            for hexdigest, upload in list(self.uploads.items()):
+                if upload.stamp < cutoff:
+                    del self.uploads[hexdigest]
+            used = 0
+            for root, dirs, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                        if (name.endswith((".part", ".tmp")) and st.st_mtime < cutoff
+                                and name.split(".", 1)[0] not in self.uploads):
+                            os.remove(path)
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    used += st.st_size
+            self.used = used
+
+    def write_chunk(self, hexdigest, offset, data):
+        """Append a chunk at offset. Returns True once the blob is complete and verified."""
+        with self.lock:
+            upload = self.uploads.get(hexdigest)
+            if upload is None:
+                raise MediaError("no upload in progress")
+            if offset != upload.offset:
+                raise MediaError(f"expected offset {upload.offset}")
+            if offset + len(data) > upload.size:
+                raise MediaError("more data than declared")
+            if self.quota and self.used + len(data) > self.quota:
+                raise MediaError("media store is full")
+            part = self.path(hexdigest, ".part")
+            with open(part, "ab") as f:
+                f.write(data)
+            upload.sha.update(data)
+            upload.offset += len(data)
+            upload.stamp = time.time()
+            self.used += len(data)
+            if upload.offset < upload.size:
+                return False
+            del self.uploads[hexdigest]
+            if upload.sha.hexdigest() != hexdigest:
+                os.remove(part)
+                self.used -= upload.size
+                raise MediaError("content does not match digest")
+            os.replace(part, self.path(hexdigest))
+        if self.thumbnailer:
+            self.thumbnailer.submit(self.make_thumbnail, hexdigest)
+        return True
+
+    def make_thumbnail(self, hexdigest):
+        try:
+            with Image.open(self.path(hexdigest)) as image:
+                # open() only reads the header; check the size before decoding anything.
+                if image.width * image.height > THUMB_MAX_PIXELS:
+                    raise MediaError(f"{image.width}x{image.height} image is too large")
+                if image.width <= THUMB_WIDTH:
+                    return
+                height = max(1, int(image.height * THUMB_WIDTH / image.width))
+                image.draft("RGB", (THUMB_WIDTH, height))   # JPEG: decode at reduced scale
+                image.thumbnail((THUMB_WIDTH, height), Image.LANCZOS)
+                thumb = image.convert("RGBA")
+            tmp = self.path(hexdigest, ".thumb.tmp")
+            thumb.save(tmp, format="PNG")
+            size = os.path.getsize(tmp)
+            os.replace(tmp, self.path(hexdigest, ".thumb"))
+            with self.lock:
+                self.used += size
+        except Exception as e:
+            print("Thumbnail error:", e)
+
+    def open(self, hexdigest, thumb=False):
+        """Return (kind, size, open file) for a blob, preferring the thumbnail if asked; None if unknown."""
+        if not DIGEST_RE.match(hexdigest):
+            return None
+        for kind, suffix in ((("thumb", ".thumb"),) if thumb else ()) + (("full", ""),):
+            try:
+                f = open(self.path(hexdigest, suffix), "rb")
+            except FileNotFoundError:
+                continue
+            return kind, os.fstat(f.fileno()).st_size, f
+        return None
+
+class MediaClient:
+    """Blocking client for a media connection. Calls are serialised by a lock."""
+
+    def __init__(self, host, port, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.decoder = None
+        self.frames = collections.deque()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        version, caps = client_handshake(sock, MEDIA_CONNECTION)
+        if not caps & MEDIA_CONNECTION:
+            sock.close()
+            raise MediaError("server does not accept media connections")
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.frames.clear()
+
+    def _recv(self):
+        while not self.frames:
+            data = self.sock.recv(CHUNK_SIZE)
+            if not data:
+                raise ConnectionError("media connection closed")
+            self.frames.extend(self.decoder.feed(data))
+        return self.frames.popleft()
+
+    def _recv_text(self):
+        flags, payload = self._recv()
+        if flags & FLAG_BINARY:
+            raise ProtocolError("unexpected binary frame")
+        return payload.decode("utf-8", errors="replace")
+
+    def _call(self, fn, *args):
+        """Run fn over the connection, reconnecting once if it dropped."""
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    return fn(*args)
+                except (OSError, ProtocolError):
+                    self.close_locked()
+                    if attempt:
+                        raise
+
+    def upload(self, data):
+        """Upload bytes, resuming a partial upload; returns the hex digest."""
+        return self._call(self._upload, hashlib.sha256(data).hexdigest(), data)
+
+    def _upload(self, hexdigest, data):
+        self.sock.sendall(encode_frame(f"/upload {hexdigest} {len(data)}"))
+        reply = self._recv_text()
+        if reply != f"Stored {hexdigest}":
+            match = re.match(rf"^Upload {hexdigest} at (\d+)$", reply)
+            if not match:
+                raise MediaError(reply)
+            for frame in chunk_frames(hexdigest, data, int(match.group(1))):
+                self.sock.sendall(frame)
+            reply = self._recv_text()
+            if reply != f"Stored {hexdigest}":
+                raise MediaError(reply)
+        return hexdigest
+
+    def fetch(self, hexdigest, thumb=False):
+        """Return (kind, bytes) for a blob, or None if the server does not have it."""
+        return self._call(self._fetch, hexdigest, thumb)
+
+    def _fetch(self, hexdigest, thumb):
+        self.sock.sendall(encode_frame(f"/fetch {hexdigest}" + (" thumb" if thumb else "")))
+        parts = self._recv_text().split()
+        if len(parts) == 3 and parts[2] == "missing":
+            return None
+        if len(parts) != 4 or parts[:2] != ["Media", hexdigest]:
+            raise MediaError(" ".join(parts))
+        kind, size = parts[2], int(parts[3])
+        buf = bytearray()
+        while len(buf) < size:
+            flags, payload = self._recv()
+            buf += memoryview(payload)[CHUNK.size:]
+        return kind, bytes(buf)
+
+    def close_locked(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def close(self):
+        with self.lock:
+            self.close_locked()
+
+class CacheBudget:
+    """Keeps the files in a cache directory within max_bytes, least recently used first out.
+
+    Writers charge() each file they add; once the total passes max_bytes the
+    oldest files (by mtime, which readers refresh on a hit) are deleted until
+    three quarters of the budget is left, so a full cache is not rescanned on
+    every write.
+    """
+
+    def __init__(self, directory, max_bytes, suffix=""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.used = None   # Unknown until the first scan.
+        self.lock = threading.Lock()
+
+    def entries(self):
+        try:
+            return [entry for entry in os.scandir(self.directory)
+                    if entry.name.endswith(self.suffix) and not entry.name.endswith(".tmp")]
+        except OSError:
+            return []
+
+    def charge(self, size):
+        with self.lock:
+            if self.used is None:
+                self.prune_locked()
+                return
+            self.used += size
+            if self.used > self.max_bytes:
+                self.prune_locked(self.max_bytes * 3 // 4)
+
+    def prune(self):
+        with self.lock:
+            self.prune_locked()
+
+    def prune_locked(self, target=None):
+        target = self.max_bytes if target is None else target
+        entries = []
+        for entry in self.entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort(reverse=True)
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            total = 0
+            for _, size, path in entries:
+                if total + size > target:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                else:
+                    total += size
+        self.used = total
+
+class MediaCache:
+    """On-disk cache of fetched media, keyed by digest and kind, holding at most max_bytes."""
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.budget = CacheBudget(directory, max_bytes)
+
+    def path(self, hexdigest, kind):
+        return os.path.join(self.directory, f"{hexdigest}.{kind}")
+
+    def get(self, hexdigest, thumb=True):
+        for kind in (("thumb", "full") if thumb else ("full",)):
+            try:
+                with open(self.path(hexdigest, kind), "rb") as f:
+                    data = f.read()
+                os.utime(self.path(hexdigest, kind))
+                return data
+            except OSError:
+                pass
+        return None
+
+    def put(self, hexdigest, kind, data):
+        tmp = self.path(hexdigest, kind) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path(hexdigest, kind))
+        self.budget.charge(len(data))
@@ -0,0 +1,148 @@
+"""Server metrics in the Prometheus text format.
+
+The server keeps one Metrics object, `metrics`, which is disabled unless the
+server runs with --metrics or --metrics-port. Hot paths check
+metrics.enabled before doing any work, so a disabled server pays one
+attribute test per instrumented call.
+
+Counters and histograms are updated as things happen. Gauges that describe
+current state (sessions, history size, threads, queue depths) come from
+collectors, functions called only when the metrics are rendered. Output is
+served by the /stats admin command and, with --metrics-port, over HTTP at
+http://127.0.0.1:<port>/metrics.
+"""
+import bisect, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds; the last bucket is +Inf.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Commands timed under their own label; anything else is "other".
+COMMANDS = ("/nick", "/create", "/join", "/rejoin", "/resume", "/list", "/dm", "/history", "/status", "/img", "/search", "/quit", "/stats", "/snapshot")
+
+HELP = {
+    "chat_connections_total": ("counter", "Connections accepted, by kind."),
+    "chat_bytes_in_total": ("counter", "Bytes read from client sockets."),
+    "chat_bytes_out_total": ("counter", "Bytes written to client sockets."),
+    "chat_channel_messages_total": ("counter", "Messages posted to each channel by this process."),
+    "chat_deliveries_total": ("counter", "Frames queued to channel members by broadcasts."),
+    "chat_command_seconds": ("histogram", "Time to handle one client frame, by command."),
+    "chat_fanout_seconds": ("histogram", "Time to queue one broadcast for every channel member."),
+}
+
+def command_label(payload):
+    """Histogram label for a client frame: its command, or "message" for chat text."""
+    if not payload.startswith(b"/"):
+        return "message"
+    command = payload.split(b" ", 1)[0].strip().decode("utf-8", errors="replace")
+    return command if command in COMMANDS else "other"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {total}")
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum:.6f}")
+        lines.append(f"{name}_count{format_labels(labels)} {total}")
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}     # (name, labels) -> value
+        self.histograms = {}   # (name, labels) -> Histogram
+        self.collectors = []   # functions returning [(name, type, help, labels, value)]
+
+    # Label keys keep call order; every call site passes the same labels in the same order.
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        families = {}   # name -> (type, help, lines)
+
+        def family(name, kind=None, text=None):
+            if name not in families:
+                kind, text = HELP.get(name, (kind, text))
+                families[name] = (kind, text, [])
+            return families[name][2]
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                family(name).append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                family(name).extend(histogram.render(name, labels))
+        for collector in self.collectors:
+            try:
+                samples = collector()
+            except Exception as e:
+                print("Metrics collector error:", e)
+                continue
+            for name, kind, text, labels, value in samples:
+                family(name, kind, text).append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+
+        out = []
+        for name, (kind, text, lines) in families.items():
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(port, host="127.0.0.1"):
+    """Serve /metrics over HTTP on a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
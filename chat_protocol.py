@@ -0,0 +1,216 @@
+"""Wire protocol shared by chat_server.py and chat_client.py.
+
+A connection starts with a hello in each direction: the magic bytes b"BORG",
+a protocol version and a capability byte. The client sends the highest version
+it speaks, the server answers with the version both sides will use.
+
+After the hello every message is a frame: a 4-byte big-endian payload length,
+one flags byte, then the payload. Text payloads are UTF-8; frames flagged
+FLAG_BINARY carry raw bytes (image chunks on media connections).
+
+When both sides set CAP_COMPRESS, the sender may wrap one or more complete
+frames in a FLAG_COMPRESSED frame, whose payload is a raw deflate stream
+primed with COMPRESS_DICT. Each compressed frame is self-contained, so a
+server compresses a broadcast once and sends the same bytes to every
+member, and a history page shares one compressed frame per
+COMPRESS_RUN_MAX bytes of messages. FrameDecoder
+unwraps them, so readers only ever see the inner frames.
+
+When both sides set CAP_RESUME, channel messages that are stored in the
+history arrive as FLAG_ID frames: an 8-byte message id, then the text. The
+sender of a message gets a FLAG_ID frame holding only the id. A client that
+remembers the last id it saw per channel can ask for just what it missed
+after a reconnect.
+"""
+import struct, zlib
+
+MAGIC = b"BORG"
+PROTOCOL_VERSION = 1
+MIN_PROTOCOL_VERSION = 1
+
+HELLO = struct.Struct("!4sBB")   # magic, version, capabilities
+HEADER = struct.Struct("!IB")    # payload length, flags
+
+# Capability bits exchanged in the hello.
+CAP_MEDIA = 0x01          # chat connection: images are sent as media references
+CAP_COMPRESS = 0x02       # frames may be wrapped in FLAG_COMPRESSED frames
+CAP_RESUME = 0x04         # session tokens, and message ids on channel messages
+MEDIA_CONNECTION = 0x80   # this connection carries media uploads and fetches
+
+# Frame flags.
+FLAG_BINARY = 0x01
+FLAG_COMPRESSED = 0x02
+FLAG_ID = 0x04
+
+MESSAGE_ID = struct.Struct("!Q")   # prefix of FLAG_ID payloads
+
+# Largest payload a decoder will accept before treating the stream as corrupt.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Preset dictionary for compressed frames: text both ends expect to see often,
+# most frequent last. Changing it breaks CAP_COMPRESS peers, so a new
+# dictionary needs a new capability bit.
+COMPRESS_DICT = (
+    b"Available channels: Channel already exists. Unknown command. User not found. Status updated. "
+    b"Usage: /nick /create /join /list /dm /history /status /quit /img sha256: "
+    b"Nickname changed from  to  is already taken. DM from : "
+    b" has disconnected. has left the channel. has joined the channel. Joined channel '"
+    b"' from #History for ' messages "
+    b"the and you that is it to of in for on with this have be are was not what just like "
+    b"0123456789 [00:00 : User] [12:3 : User] [1 : User] [2 : User] [0 : User"
+)
+COMPRESS_LEVEL = 6
+COMPRESS_MIN = 32   # Frames shorter than this are never worth compressing.
+# Inflated bytes per compressed frame, so neither it nor what it inflates to
+# comes near MAX_FRAME_SIZE however many frames a page holds.
+COMPRESS_RUN_MAX = 1024 * 1024
+
+# Loading the dictionary costs more than compressing a chat line, so every
+# compressor is a copy of this primed one. A 4 KiB window (wbits -12) copies
+# fast and still covers a /join page; inflating with wbits -15 reads any window.
+_primed = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -12, 4, zdict=COMPRESS_DICT)
+
+class ProtocolError(Exception):
+    """Raised when the peer sends something that is not valid protocol."""
+
+def encode_hello(version=PROTOCOL_VERSION, caps=0):
+    return HELLO.pack(MAGIC, version, caps)
+
+def decode_hello(data):
+    """Return (version, caps) from a hello, raising ProtocolError on garbage."""
+    if len(data) != HELLO.size:
+        raise ProtocolError("Truncated hello")
+    magic, version, caps = HELLO.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("Not a chat protocol stream")
+    return version, caps
+
+def negotiate(version, caps, server_caps=0):
+    """Pick the version and capabilities to use for a client hello."""
+    version = min(version, PROTOCOL_VERSION)
+    if version < MIN_PROTOCOL_VERSION:
+        raise ProtocolError(f"Protocol version {version} is no longer supported")
+    return version, caps & server_caps
+
+def encode_frame(payload, flags=0):
+    """Frame a payload. Strings are encoded as UTF-8."""
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return HEADER.pack(len(payload), flags) + payload
+
+def encode_id_frame(msg_id, text=""):
+    """A channel message tagged with its id; without text it only reports the id."""
+    return encode_frame(MESSAGE_ID.pack(msg_id) + text.encode("utf-8"), FLAG_ID)
+
+def split_id_frame(payload):
+    """(id, text) from a FLAG_ID payload."""
+    if len(payload) < MESSAGE_ID.size:
+        raise ProtocolError("Truncated message id")
+    return MESSAGE_ID.unpack_from(payload)[0], payload[MESSAGE_ID.size:].decode("utf-8", errors="replace")
+
+def recv_exact(sock, size):
+    """Read exactly size bytes from a blocking socket."""
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ProtocolError("Connection closed during handshake")
+        buf += chunk
+    return bytes(buf)
+
+def client_handshake(sock, caps=0):
+    """Send our hello on a connected socket and return the server's (version, caps)."""
+    sock.sendall(encode_hello(PROTOCOL_VERSION, caps))
+    return decode_hello(recv_exact(sock, HELLO.size))
+
+def compress_frames(data):
+    """Wrap encoded frames in one FLAG_COMPRESSED frame, or return data unchanged if that saves nothing."""
+    if len(data) < COMPRESS_MIN:
+        return data
+    compressor = _primed.copy()
+    packed = compressor.compress(data) + compressor.flush()
+    if len(packed) + HEADER.size >= len(data):
+        return data
+    return HEADER.pack(len(packed), FLAG_COMPRESSED) + packed
+
+def compress_runs(frames):
+    """Compress a list of encoded frames, starting a new compressed frame
+    before one would inflate past COMPRESS_RUN_MAX."""
+    out = []
+    run = []
+    size = 0
+    for frame in frames:
+        if run and size + len(frame) > COMPRESS_RUN_MAX:
+            out.append(compress_frames(b"".join(run)))
+            run = []
+            size = 0
+        run.append(frame)
+        size += len(frame)
+    if run:
+        out.append(compress_frames(b"".join(run)))
+    return b"".join(out)
+
+def inflate_frames(payload, max_size=MAX_FRAME_SIZE):
+    """Undo compress_frames: the encoded frames inside a FLAG_COMPRESSED payload."""
+    inflater = zlib.decompressobj(-15, zdict=COMPRESS_DICT)
+    try:
+        data = inflater.decompress(payload, max_size)
+    except zlib.error as e:
+        raise ProtocolError(f"Bad compressed frame: {e}")
+    if inflater.unconsumed_tail:
+        raise ProtocolError(f"Compressed frame inflates past {max_size} bytes")
+    return data
+
+class FrameDecoder:
+    """Incremental frame reassembly.
+
+    Feed it whatever recv() returned; it hands back every complete frame as a
+    (flags, payload) tuple and keeps any partial frame until more data arrives.
+    Compressed frames are inflated and their inner frames returned in order;
+    with compressed=False, for a peer that did not agree to CAP_COMPRESS, one
+    is a ProtocolError.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, compressed=True):
+        self.max_frame_size = max_frame_size
+        self.compressed = compressed
+        self.buffer = bytearray()
+        self.nested = False   # Inside a compressed frame, where another one is not allowed.
+
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        frames = []
+        offset = 0
+        end = len(buf)
+        while end - offset >= HEADER.size:
+            length, flags = HEADER.unpack_from(buf, offset)
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            start = offset + HEADER.size
+            if end - start < length:
+                break
+            if flags & FLAG_COMPRESSED:
+                if not self.compressed:
+                    raise ProtocolError("Compressed frame without CAP_COMPRESS")
+                if self.nested:
+                    raise ProtocolError("Compressed frame inside a compressed frame")
+                frames.extend(self._unwrap(bytes(buf[start:start + length])))
+            else:
+                frames.append((flags, bytes(buf[start:start + length])))
+            offset = start + length
+        if offset:
+            del buf[:offset]
+        return frames
+
+    def _unwrap(self, payload):
+        inner = FrameDecoder(self.max_frame_size)
+        inner.nested = True
+        frames = inner.feed(inflate_frames(payload, self.max_frame_size))
+        if inner.pending():
+            raise ProtocolError("Compressed frame ends inside a frame")
+        return frames
+
+    def pending(self):
+        """Number of buffered bytes that do not yet form a complete frame."""
+        return len(self.buffer)
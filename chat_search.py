@@ -0,0 +1,387 @@
+"""Full-text search over channel history.
+
+    /search general deploy failed from:alice since:2d page:2
+
+The server keeps one SearchIndex. Every message stored in the history is
+added to it as it is appended, so queries never read the history itself;
+only the page of results is fetched from it afterwards.
+
+Each channel's index is a list of blocks covering consecutive message ids.
+A block maps every term (lowercased word) and the author, as "from:<nick>",
+to a sorted array of message ids, and keeps one timestamp per message so a
+time range turns into an id range with a binary search. Memory is bounded
+by max_bytes: once the estimate passes it, the oldest block of any channel
+is dropped, so the newest messages always stay searchable.
+
+Ranking: messages containing every term come first, newest first. Messages
+containing only some of the terms follow, weighted by how rare each term is;
+only the newest MAX_SCORED postings of each term are scored for those.
+"""
+import bisect, datetime, heapq, itertools, math, re, threading, time
+from array import array
+
+TOKEN_RE = re.compile(r"\w+")
+TEXT_RE = re.compile(r"^\[\d\d:\d\d : (\S+)\] (.*)$", re.S)
+DURATION_RE = re.compile(r"^(\d+)([smhdw])$")
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+TIME_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S")
+
+MIN_TOKEN, MAX_TOKEN = 2, 32
+BLOCK_MESSAGES = 65536   # messages per block; eviction drops a whole block
+MAX_SCORED = 5000        # postings per term scored for partial matches
+# Size estimate used for the memory bound: a new term in a block costs a dict
+# slot, its key string and an array (less once the block is sealed); each
+# posting and message a 4-byte slot.
+TERM_BYTES = 180
+SEALED_TERM_BYTES = 100   # a dict slot, its key string and a start offset
+POSTING_BYTES = 4
+MESSAGE_BYTES = 4
+
+def parse_message(text):
+    """(author, searchable text) of a stored history line; image messages have no text."""
+    match = TEXT_RE.match(text)
+    if match:
+        return match.group(1), match.group(2)
+    if text.startswith("/img "):
+        parts = text.split(" ", 2)
+        return (parts[1] if len(parts) > 2 else None), ""
+    return None, text
+
+def tokenize(text):
+    """Distinct search terms in text, in order of first appearance."""
+    return list(dict.fromkeys(t for t in TOKEN_RE.findall(text.lower()) if MIN_TOKEN <= len(t) <= MAX_TOKEN))
+
+def parse_time(value, now=None):
+    """Unix time for a relative age (30m, 2h, 7d, 1w) or a local date/time (2024-05-01, 2024-05-01T09:30)."""
+    match = DURATION_RE.match(value)
+    if match:
+        return (now or time.time()) - int(match.group(1)) * UNITS[match.group(2)]
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f"bad time {value!r}")
+
+def parse_query(text):
+    """Split a query into terms and filters: from:<nick>, since:<time>, until:<time>, page:<n>.
+
+    Raises ValueError for a malformed filter."""
+    query = {"terms": [], "author": None, "since": None, "until": None, "page": 1}
+    words = []
+    for word in text.split():
+        key, sep, value = word.partition(":")
+        if sep and value and key in ("from", "since", "until", "page"):
+            if key == "from":
+                query["author"] = value
+            elif key == "page":
+                query["page"] = int(value)
+                if query["page"] < 1:
+                    raise ValueError("page must be at least 1")
+            else:
+                query[key] = parse_time(value)
+        else:
+            words.append(word)
+    query["terms"] = tokenize(" ".join(words))
+    return query
+
+def _slice(postings, lo, hi):
+    return postings[bisect.bisect_left(postings, lo):bisect.bisect_left(postings, hi)]
+
+class Block:
+    """Postings and timestamps for a run of consecutive message ids.
+
+    While a block is filling, each term has its own array of ids. Once full it
+    is sealed: every id goes into one array, term k owning
+    ids[starts[k]:starts[k + 1]], which drops the per-term arrays and lets a
+    snapshot write or load the block without touching each term.
+    """
+
+    def __init__(self, first_id):
+        self.first_id = first_id
+        self.next_id = first_id
+        self.times = array("I")   # whole seconds, never decreasing
+        self.postings = {}        # term -> array of message ids; None once sealed
+        self.terms = None         # sealed: term -> k
+        self.starts = None
+        self.ids = None
+        self.size = 0
+
+    def add(self, msg_id, timestamp, keys):
+        """Index one message; returns the bytes it added to the estimate."""
+        added = self.unseal() if self.postings is None else 0
+        added += MESSAGE_BYTES
+        # A clock step backwards must not break the binary search over times.
+        self.times.append(max(int(timestamp), self.times[-1] if self.times else 0))
+        for key in keys:
+            postings = self.postings.get(key)
+            if postings is None:
+                postings = self.postings[key] = array("I")
+                added += TERM_BYTES
+            postings.append(msg_id)
+            added += POSTING_BYTES
+        self.next_id = msg_id + 1
+        self.size += added
+        return added
+
+    def find(self, key, lo, hi):
+        """The sorted ids in [lo, hi) carrying key, or None if no message in the block has it."""
+        if self.postings is not None:
+            postings = self.postings.get(key)
+            return None if postings is None else _slice(postings, lo, hi)
+        k = self.terms.get(key)
+        if k is None:
+            return None
+        ids, start, end = self.ids, self.starts[k], self.starts[k + 1]
+        return ids[bisect.bisect_left(ids, lo, start, end):bisect.bisect_left(ids, hi, start, end)]
+
+    def seal(self):
+        """Pack the postings into one array; returns the change to the size estimate.
+
+        Ids from next_id up are left out: a cut shares arrays that the index
+        may have appended to since.
+        """
+        if self.postings is None:
+            return 0
+        next_id = self.next_id
+        postings = {}
+        for term, ids in self.postings.items():
+            if ids[-1] >= next_id:
+                ids = _slice(ids, 0, next_id)
+            if ids:
+                postings[term] = ids
+        self.terms = dict(zip(postings, itertools.count()))
+        self.starts = array("I", itertools.accumulate(map(len, postings.values()), initial=0))
+        self.ids = array("I", b"".join(map(array.tobytes, postings.values())))
+        self.postings = None
+        return self._resize()
+
+    def unseal(self):
+        """Back to one array per term, so ids can be added again."""
+        if self.postings is not None:
+            return 0
+        starts, ids = self.starts, self.ids
+        self.postings = {term: ids[starts[k]:starts[k + 1]] for term, k in self.terms.items()}
+        self.terms = self.starts = self.ids = None
+        return self._resize()
+
+    def _resize(self):
+        old = self.size
+        if self.postings is None:
+            self.size = MESSAGE_BYTES * len(self.times) + SEALED_TERM_BYTES * len(self.terms) + POSTING_BYTES * len(self.ids)
+        else:
+            self.size = (MESSAGE_BYTES * len(self.times) + TERM_BYTES * len(self.postings)
+                         + POSTING_BYTES * sum(map(len, self.postings.values())))
+        return self.size - old
+
+    def cut(self):
+        """A copy of the block as it stands, cheap enough to take under the index lock.
+
+        An unsealed cut shares the postings arrays with this block; seal() it
+        before reading them.
+        """
+        block = Block(self.first_id)
+        block.next_id = self.next_id
+        block.times = array("I", self.times)
+        block.size = self.size
+        if self.postings is None:
+            block.postings = None
+            block.terms, block.starts, block.ids = self.terms, self.starts, self.ids
+        else:
+            block.postings = dict(self.postings)
+        return block
+
+    def id_range(self, since, until, first_id):
+        """The ids in this block inside [since, until) and not below first_id, as (lo, hi)."""
+        lo = max(self.first_id, first_id)
+        hi = self.next_id
+        if since is not None:
+            lo = max(lo, self.first_id + bisect.bisect_left(self.times, math.ceil(since)))
+        if until is not None:
+            hi = min(hi, self.first_id + bisect.bisect_left(self.times, math.ceil(until)))
+        return lo, hi
+
+    def match(self, keys, lo, hi):
+        """Sorted ids in [lo, hi) that carry every key."""
+        if not keys:
+            return range(lo, hi)
+        lists = []
+        for key in keys:
+            postings = self.find(key, lo, hi)
+            if postings is None:
+                return ()
+            lists.append(postings)
+        lists.sort(key=len)
+        if len(lists) == 1:
+            return lists[0]
+        found = set(lists[0])
+        for postings in lists[1:]:
+            if not found:
+                break
+            found.intersection_update(postings)
+        return sorted(found)
+
+class SearchIndex:
+    """Bounded inverted index over every channel's history."""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, block_messages=BLOCK_MESSAGES):
+        self.max_bytes = max_bytes
+        self.block_messages = block_messages
+        self.lock = threading.Lock()
+        self.channels = {}   # channel -> [Block], oldest first
+        self.size = 0
+        self.evicted = 0
+
+    def add(self, channel, msg_id, timestamp, text, first_id=1):
+        """Index a message just appended to the history.
+
+        first_id is the oldest id the history still holds; blocks wholly below
+        it can never be returned and are dropped when a new block starts.
+        """
+        author, body = parse_message(text)
+        keys = tokenize(body)
+        if author:
+            keys.append("from:" + author)
+        with self.lock:
+            blocks = self.channels.setdefault(channel, [])
+            block = blocks[-1] if blocks else None
+            if block is None or block.next_id != msg_id or len(block.times) >= self.block_messages:
+                while blocks and blocks[0].next_id <= first_id:
+                    self._drop(blocks, 0)
+                if blocks:
+                    self.size += blocks[-1].seal()
+                block = Block(msg_id)
+                blocks.append(block)
+            self.size += block.add(msg_id, timestamp, keys)
+            while self.size > self.max_bytes and self._evict_oldest():
+                pass
+
+    def _drop(self, blocks, index):
+        self.size -= blocks.pop(index).size
+        self.evicted += 1
+
+    def _evict_oldest(self):
+        oldest = None
+        for blocks in self.channels.values():
+            if blocks and (oldest is None or blocks[0].times[-1] < oldest[0].times[-1]):
+                oldest = blocks
+        if oldest is None:
+            return False
+        self._drop(oldest, 0)
+        return True
+
+    def search(self, channel, terms, author=None, since=None, until=None, first_id=1, offset=0, limit=20):
+        """Ranked ids of matching messages. Returns (ids for [offset, offset + limit), total matches)."""
+        required = list(terms) + (["from:" + author] if author else [])
+        if not required and since is None and until is None:
+            return [], 0
+        need = offset + limit
+        with self.lock:
+            ranges = []
+            for block in reversed(self.channels.get(channel, ())):
+                lo, hi = block.id_range(since, until, first_id)
+                if lo < hi:
+                    ranges.append((block, lo, hi))
+            full = []
+            total = 0
+            for block, lo, hi in ranges:
+                matches = block.match(required, lo, hi)
+                total += len(matches)
+                if len(full) < need:
+                    full.extend(reversed(matches[max(0, len(matches) - need + len(full)):]))
+            partial, others = self._partial(ranges, terms, author, need - len(full)) if len(terms) > 1 else ([], 0)
+        ranked = full + partial
+        return ranked[offset:need], total + others
+
+    def _partial(self, ranges, terms, author, count):
+        """The best count ids with some but not all of terms, and how many such messages there are.
+
+        Each term contributes at most its MAX_SCORED newest postings; only ids
+        newer than every term's cutoff are considered, so a message is never
+        mistaken for a partial match because one of its terms ran out of budget.
+        Candidates are grouped by which terms they contain; every message in a
+        group has the same score.
+        """
+        messages = sum(hi - lo for block, lo, hi in ranges)
+        weights = []
+        scored = []
+        cutoff = 0
+        for term in terms:
+            slices = [(block, block.find(term, lo, hi) or ()) for block, lo, hi in ranges]
+            found = sum(len(ids) for block, ids in slices)
+            weights.append(math.log(1 + messages / found) if found else 0)
+            budget = MAX_SCORED
+            kept = []
+            for block, ids in slices:
+                if budget <= 0:
+                    break
+                if len(ids) > budget:
+                    ids = ids[-budget:]
+                    cutoff = max(cutoff, ids[0])
+                budget -= len(ids)
+                kept.append((block, ids))
+            scored.append(kept)
+        groups = {}   # mask of terms contained -> ids
+        for bit, kept in enumerate(scored):
+            found = set()
+            for block, ids in kept:
+                ids = ids[bisect.bisect_left(ids, cutoff):]
+                if author and ids:
+                    found.update(set(block.find("from:" + author, ids[0], ids[-1] + 1) or ())
+                                 .intersection(ids))
+                else:
+                    found.update(ids)
+            for mask, group in list(groups.items()):
+                both = group & found
+                if both:
+                    group -= both
+                    found -= both
+                    groups[mask | 1 << bit] = both
+            groups[1 << bit] = found
+        every = (1 << len(terms)) - 1
+        ranked = sorted(((sum(w for bit, w in enumerate(weights) if mask >> bit & 1), mask)
+                         for mask, group in groups.items() if group and mask != every), reverse=True)
+        ids = []
+        for score, mask in ranked:
+            if len(ids) >= count:
+                break
+            ids.extend(heapq.nlargest(count - len(ids), groups[mask]))
+        return ids, sum(len(groups[mask]) for score, mask in ranked)
+
+    def snapshot(self):
+        """Channel -> blocks, oldest first, safe to read while messages are added.
+
+        Only the newest block of a channel is ever appended to, so that one is
+        cut and the others, already sealed, are shared. The cuts are sealed by
+        whoever writes them out, after the lock is released.
+        """
+        with self.lock:
+            return {channel: blocks[:-1] + [blocks[-1].cut()]
+                    for channel, blocks in self.channels.items() if blocks}
+
+    def restore(self, channels):
+        """Replace the index with blocks from snapshot()."""
+        with self.lock:
+            self.channels = {channel: list(blocks) for channel, blocks in channels.items()}
+            self.size = sum(b.size for blocks in self.channels.values() for b in blocks)
+            while self.size > self.max_bytes and self._evict_oldest():
+                pass
+
+    def unseal_newest(self):
+        """Unseal the newest block of every channel now rather than on the next message added to it."""
+        with self.lock:
+            for blocks in self.channels.values():
+                if blocks:
+                    self.size += blocks[-1].unseal()
+
+    def next_id(self, channel):
+        """The id after the newest message indexed for channel, or None."""
+        blocks = self.channels.get(channel)
+        return blocks[-1].next_id if blocks else None
+
+    def stats(self):
+        with self.lock:
+            return {"bytes": self.size, "channels": len(self.channels),
+                    "blocks": sum(len(blocks) for blocks in self.channels.values()),
+                    "messages": sum(len(b.times) for blocks in self.channels.values() for b in blocks),
+                    "evicted_blocks": self.evicted}
@@ -1,158 +1,1384 @@
-import socket, threading, datetime
+import socket, threading, datetime, asyncio, argparse, ipaddress, secrets, selectors, time, os, sys
+from concurrent.futures import ThreadPoolExecutor
+from chat_cluster import ClusterBus, run_cluster
+from chat_history import MemoryHistory, SegmentHistory
+from chat_limits import ConnectionLimits, admission, limit_config, limit_stats
+from chat_sessions import Registry
+from chat_connection import (POLICIES, AsyncConnection, ThreadedConnection, outbound_config, outbound_metrics,
+                             outbound_stats)
+from chat_media import CHUNK, CHUNK_SIZE, MediaError, MediaStore, parse_media_ref
+from chat_metrics import command_label, metrics, serve_metrics
+from chat_protocol import (CAP_COMPRESS, CAP_MEDIA, CAP_RESUME, FLAG_BINARY, HELLO, MEDIA_CONNECTION,
+                           FrameDecoder, ProtocolError, compress_frames, compress_runs, decode_hello,
+                           encode_frame, encode_hello, encode_id_frame, negotiate, recv_exact)
+from chat_search import SearchIndex, parse_query
+from chat_snapshot import SnapshotError, read_snapshot, write_snapshot
 
-# Dictionary mapping channel names to lists of client sockets.
-channels = {}  
-# Dictionary mapping client sockets to their metadata (nickname, channel).
-clients = {}   
-# Persistent chat history for each channel.
-chat_history = {}  
+# Sessions, nicknames and channel membership.
+registry = Registry()
+# Chat history for each channel; replaced by a SegmentHistory when --history-dir is given.
+chat_history = MemoryHistory()
+
+# Bus to the other workers when running with --workers; None in single-process mode.
+cluster = None
+
+# Image blobs uploaded over media connections; None disables the media path.
+media_store = None
+# The asyncio engine runs media transfers on a pool of their own, so stuck ones
+# cannot starve other executor work. A fetch whose reader takes nothing for
+# send_timeout seconds is cut off.
+media_config = {"workers": 8, "send_timeout": 30}
+media_pool = None
+
+# Messages replayed on /join, and the default and largest /history page.
+history_config = {"join": 50, "page": 50, "max_page": 500}
+
+# Full-text index over the history; None with --no-search.
+search_index = SearchIndex()
+# Results per /search page.
+search_config = {"page": 20}
+# Keeps history ids and index order in step when several threads post to a channel.
+store_lock = threading.Lock()
+
+# Offer CAP_COMPRESS to clients that ask for it; --no-compression turns it off.
+compression = True
+
+# Seconds a CAP_RESUME session that dropped without /quit keeps its nickname and
+# can be resumed; 0 (--resume-ttl 0) stops offering CAP_RESUME.
+resume_ttl = 120
+# Parked sessions by token: (session, channel it was in, deadline).
+parked_sessions = {}
+# Connected CAP_RESUME sessions by token, for a client that is back before its old connection is seen to drop.
+attached_sessions = {}
+# Resumes waiting for another worker to hand the session over, by request id:
+# (session, last id, channel, deadline).
+pending_resumes = {}
+RESUME_WAIT = 5
+
+# Snapshots of channels, resumable sessions, in-memory history and the search
+# index (see chat_snapshot). No path turns them off; interval 0 writes them
+# only on /snapshot and when handing off to a successor.
+snapshot_config = {"path": None, "interval": 0}
+snapshot_stats = {"snapshots": 0, "last_bytes": 0, "last_seconds": 0.0}
+# /snapshot and the periodic writer share one temporary file, so one writes at a time.
+snapshot_lock = threading.Lock()
+# Unix socket on which a successor can ask for the listening socket (--handoff).
+handoff_path = None
+
+# Runs a function where client connections may be written to. Any thread will
+# do for the threaded engine; serve_async points it at the event loop.
+call_soon = lambda fn, *args: fn(*args)
+
+# Server engines selectable at startup.
+ENGINES = ("threaded", "asyncio")
+
+def send_text(client_socket, text):
+    """Send one message to a client as a single frame."""
+    client_socket.sendall(pack_frames(client_socket, [text]))
+
+def is_media_text(text):
+    """Image messages carry already-compressed data (or a short reference); deflate cannot help."""
+    return text.startswith("/img ")
+
+def pack_frames(client_socket, texts):
+    """Frame messages for one write. On connections that negotiated compression, each run of
+    text messages shares one compressed frame; image messages go out as they are."""
+    if not client_socket.compress:
+        return b"".join(encode_frame(text) for text in texts)
+    out = []
+    run = []
+    for text in texts:
+        if is_media_text(text):
+            if run:
+                out.append(compress_runs(run))
+                run = []
+            out.append(encode_frame(text))
+        else:
+            run.append(encode_frame(text))
+    if run:
+        out.append(compress_runs(run))
+    return b"".join(out)
 
 def broadcast(message, channel, sender_socket=None):
     """Broadcast a message to all clients in a channel except the sender (if provided)."""
-    if channel in channels:
-        for client in channels[channel]:
-            # Optionally, skip the sender if desired.
-            if client != sender_socket:
-                try:
-                    client.send(message.encode())
-                except Exception as e:
-                    print("Broadcast error:", e)
-
-def handle_client(client_socket, address):
-    # Set a default nickname.
-    nickname = f"User{address[1]}"
-    clients[client_socket] = {"nickname": nickname, "channel": None}
-    client_socket.send("Welcome! Use /nick <name> to set your nickname.\n".encode())
-    
+    if cluster:
+        cluster.publish({"op": "notice", "channel": channel, "text": message, "exclude": id(sender_socket)})
+    else:
+        deliver(message, channel, id(sender_socket))
+
+def post_message(message, channel, sender_socket):
+    """Store a chat message in the channel history and broadcast it."""
+    if cluster:
+        # The broker numbers it and every worker appends it with that id when relayed.
+        cluster.publish({"op": "message", "channel": channel, "text": message, "exclude": id(sender_socket)})
+    else:
+        store_message(channel, message, id(sender_socket))
+    if metrics.enabled:
+        metrics.inc("chat_channel_messages_total", channel=channel)
+
+def store_message(channel, message, exclude=None, msg_id=None, timestamp=None):
+    """Append a message to the channel history and the search index, then deliver it.
+
+    Delivery is queued before store_lock is released, so members get messages
+    in id order. In a cluster msg_id and timestamp come from the broker; a
+    replayed message this worker already has is neither stored nor delivered.
+    """
+    timestamp = timestamp or time.time()
+    with store_lock:
+        msg_id = chat_history.append(channel, message, timestamp, msg_id)
+        if msg_id is None:
+            return
+        if search_index:
+            search_index.add(channel, msg_id, timestamp, message, chat_history.first_id(channel))
+        deliver(message, channel, exclude, msg_id)
+
+def message_frame(message, msg_id, compress, tagged):
+    data = encode_id_frame(msg_id, message) if tagged else encode_frame(message)
+    return compress_frames(data) if compress else data
+
+def deliver(message, channel, exclude=None, msg_id=None):
+    """Queue a message for this process's members of a channel, skipping the connection whose id() is exclude.
+
+    msg_id is the history id of a stored message; CAP_RESUME members get it
+    with the message, and an excluded CAP_RESUME sender gets the id alone.
+    Only queues the frame on each recipient; their writers send it.
+    """
+    members = registry.channel_members(channel)
+    if members:
+        start = time.perf_counter() if metrics.enabled else 0
+        # Frame (and compress) each variant once; recipients of a variant queue the same bytes.
+        frames = {}
+        compressible = not is_media_text(message)
+        for member in members:
+            conn = member.conn
+            try:
+                if id(conn) == exclude:
+                    if msg_id and conn.resume:
+                        conn.sendall(encode_id_frame(msg_id))
+                    continue
+                variant = (conn.compress and compressible, bool(msg_id and conn.resume))
+                data = frames.get(variant)
+                if data is None:
+                    data = frames[variant] = message_frame(message, msg_id, *variant)
+                conn.sendall(data)
+            except Exception as e:
+                print("Broadcast error:", e)
+        if start:
+            metrics.observe("chat_fanout_seconds", time.perf_counter() - start)
+            metrics.inc("chat_deliveries_total", len(members))
+
+def history_texts(channel, records, next_id=0):
+    """A page of history: a header with the oldest id and count, then one message per record.
+
+    An empty page gives next_id as its oldest id; on a join that is the id the
+    channel's next message will get, so a client can tell an empty delta from
+    a channel that started again.
+    """
+    first_id = records[0][0] if records else next_id
+    texts = [f"History for '{channel}' from #{first_id}: {len(records)} messages"]
+    texts.extend(text for msg_id, timestamp, text in records)
+    return texts
+
+def search_texts(channel, query):
+    """A page of search results: a header with the page and match counts, then one "#<id> <message>" per hit."""
+    page_size = search_config["page"]
+    offset = (query["page"] - 1) * page_size
+    ids, total = search_index.search(channel, query["terms"], query["author"], query["since"], query["until"],
+                                     chat_history.first_id(channel), offset, page_size)
+    lines = []
+    for msg_id in ids:
+        records = chat_history.before(channel, msg_id + 1, 1)
+        if records and records[0][0] == msg_id:
+            lines.append(f"#{msg_id} {records[0][2]}")
+    pages = max(1, -(-total // page_size))
+    return [f"Search '{channel}' page {query['page']} of {pages}: {len(lines)} of {total} matches"] + lines
+
+def register_client(client_socket, address):
+    """Register a new connection with a default nickname and send the welcome line
+    (and, for CAP_RESUME clients, their session token)."""
+    if cluster:
+        # Worker-specific default names never collide across the cluster.
+        session = registry.add(client_socket, f"User{address[1]}w{cluster.worker_id}", address)
+        cluster.publish({"op": "nick", "nick": session.nickname, "old": None})
+    else:
+        session = registry.add(client_socket, f"User{address[1]}", address)
+    texts = ["Welcome! Use /nick <name> to set your nickname."]
+    if client_socket.resume:
+        session.token = new_token()
+        attached_sessions[session.token] = session
+        texts.append(f"Session token: {session.token}")
+    client_socket.sendall(pack_frames(client_socket, texts))
+    return session
+
+def new_token():
+    """A resume token; in a cluster it starts with the worker that holds the session."""
+    token = secrets.token_urlsafe(16)
+    return f"w{cluster.worker_id}.{token}" if cluster else token
+
+def token_worker(token):
+    """The worker a cluster token belongs to, or None."""
+    worker, dot, _ = token.partition(".")
+    if cluster and dot and worker[:1] == "w" and worker[1:].isdigit():
+        return int(worker[1:])
+    return None
+
+def join_channel(session, channel, after_id=None, announce=True):
+    """Move a session into channel and send it the channel's history, then the confirmation.
+
+    Without after_id that is the latest join page. With it, only the messages
+    after after_id when there are at most max_page of them, otherwise the
+    latest page; the header's first id tells the client which it got.
+    """
+    client_socket = session.conn
+    # No message can be stored between joining and queueing the page, so every
+    # later one reaches the client live and after the page. One stored just
+    # before may also arrive live; its id tells the client it is a repeat.
+    # The page comes from the in-memory tail, so holding the lock is cheap.
+    with store_lock:
+        old_channel = registry.join(session, channel)
+        latest = chat_history.latest_id(channel)
+        missed = latest - after_id if after_id is not None else -1
+        if 0 <= missed <= history_config["max_page"] and after_id >= chat_history.first_id(channel) - 1:
+            records = chat_history.before(channel, latest + 1, missed) if missed else []
+        else:
+            records = chat_history.before(channel, latest + 1, history_config["join"])
+        texts = history_texts(channel, records, latest + 1)
+        texts.append(f"Joined channel '{channel}'")
+        # One write for the history and the confirmation.
+        client_socket.sendall(pack_frames(client_socket, texts))
+    if old_channel and announce:
+        broadcast(f"{session.nickname} has left the channel.", old_channel, client_socket)
+    if announce:
+        broadcast(f"{session.nickname} has joined the channel.", channel, client_socket)
+
+def resume_session(session, token, after_id, channel):
+    """Give session the nickname and channel of the session token belongs to, quietly.
+
+    That is usually a parked session. A client can also be back before its old
+    connection is seen to drop: the old connection is then aborted and its
+    session taken over the same way. Returns False if token matches neither.
+    """
+    old = None
+    entry = parked_sessions.pop(token, None)
+    if entry is None:
+        old = attached_sessions.get(token)
+        if old is None or old is session:
+            return False
+        # Its reader's cleanup must neither park it again nor release the nickname.
+        old.token = None
+        entry = (old, old.channel, None)
+    parked, parked_channel, deadline = entry
+    default_nick = session.nickname
+    if not registry.take_over(session, parked):
+        if old:
+            old.token = token
+        return False
+    if old:
+        # The nickname has moved, so the old reader's cleanup is now harmless.
+        registry.park(old)
+        old.conn.abort()
+    if cluster:
+        cluster.publish({"op": "nick", "nick": session.nickname, "old": default_nick})
+    attached_sessions.pop(session.token, None)
+    session.token = token
+    attached_sessions[token] = session
+    channel = channel or parked_channel
+    if channel and registry.has_channel(channel):
+        join_channel(session, channel, after_id, announce=False)
+    return True
+
+def request_resume(session, token, after_id, channel):
+    """Ask the worker a token belongs to for its session; hand_over() answers there."""
+    pending_resumes[id(session)] = (session, after_id, channel, time.time() + RESUME_WAIT)
+    cluster.publish({"op": "resume", "token": token, "owner": token_worker(token), "request": id(session)})
+
+def hand_over(event):
+    """Detach the session a resume request names and send it to the requesting worker.
+
+    Like resume_session(), a session whose connection is still open is taken
+    over and its connection aborted. Either way it leaves this worker quietly.
+    """
+    token = event["token"]
+    nick = channel = None
+    entry = parked_sessions.pop(token, None)
+    if entry:
+        session, channel, deadline = entry
+        registry.remove(session)
+        nick = session.nickname
+    else:
+        session = attached_sessions.pop(token, None)
+        if session:
+            # Its reader's cleanup finds neither a token nor the nickname, so it stays quiet.
+            session.token = None
+            channel = session.channel
+            registry.remove(session)
+            session.conn.abort()
+            nick = session.nickname
+    cluster.publish({"op": "handover", "token": token, "to": event["worker"],
+                     "request": event["request"], "nick": nick, "channel": channel})
+
+def finish_resume(event):
+    """Take over the session another worker handed over for a pending /resume."""
+    nick = event["nick"]
+    pending = pending_resumes.pop(event["request"], None)
+    if pending is None:
+        # The client left or gave up waiting; the session ends here.
+        if nick:
+            if event["channel"]:
+                broadcast(f"{nick} has disconnected.", event["channel"])
+            cluster.publish({"op": "release", "nick": nick})
+        return
+    session, after_id, channel, deadline = pending
+    if not nick:
+        send_text(session.conn, "Resume failed: no such session.")
+        return
+    default_nick = session.nickname
+    if not registry.rename(session, nick):
+        cluster.publish({"op": "release", "nick": nick})
+        send_text(session.conn, "Resume failed: no such session.")
+        return
+    cluster.publish({"op": "nick", "nick": nick, "old": default_nick})
+    # The old token names the previous worker; later resumes must come here.
+    attached_sessions.pop(session.token, None)
+    session.token = new_token()
+    attached_sessions[session.token] = session
+    channel = channel or event["channel"]
+    if channel and registry.has_channel(channel):
+        join_channel(session, channel, after_id, announce=False)
+    send_text(session.conn, f"Resumed session as {nick}")
+    send_text(session.conn, f"Session token: {session.token}")
+
+def expire_parked_sessions():
+    """Release parked sessions whose clients did not come back in time."""
+    now = time.time()
+    for request, pending in list(pending_resumes.items()):
+        if pending[3] <= now and pending_resumes.pop(request, None):
+            send_text(pending[0].conn, "Resume failed: no such session.")
+    for token, (session, channel, deadline) in list(parked_sessions.items()):
+        if deadline <= now and parked_sessions.pop(token, None):
+            registry.remove(session)
+            if channel:
+                broadcast(f"{session.nickname} has disconnected.", channel)
+            if cluster:
+                cluster.publish({"op": "release", "nick": session.nickname})
+
+def sweep_history(interval):
+    """Enforce --history-max-age on channels that nobody posts to."""
     while True:
+        time.sleep(interval)
         try:
-            message = client_socket.recv(4096).decode()
-            if not message:
-                break
-            
-            # Process commands starting with '/'
-            if message.startswith("/"):
-                parts = message.strip().split(" ", 1)
-                command = parts[0]
-                args = parts[1] if len(parts) > 1 else ""
-                
-                if command == "/nick":
-                    old_nick = clients[client_socket]["nickname"]
-                    new_nick = args.strip()
-                    clients[client_socket]["nickname"] = new_nick
-                    client_socket.send(f"Nickname changed from {old_nick} to {new_nick}\n".encode())
-                
-                elif command == "/create":
-                    channel_name = args.strip()
-                    if channel_name in channels:
-                        client_socket.send("Channel already exists.\n".encode())
-                    else:
-                        channels[channel_name] = []
-                        chat_history[channel_name] = []  # Initialize history for the channel.
-                        client_socket.send(f"Channel '{channel_name}' created.\n".encode())
-                
-                elif command == "/join":
-                    channel_name = args.strip()
-                    if channel_name not in channels:
-                        client_socket.send("Channel does not exist. Create it with /create <channel>\n".encode())
-                    else:
-                        # If already in a channel, remove the client.
-                        old_channel = clients[client_socket]["channel"]
-                        if old_channel:
-                            if client_socket in channels[old_channel]:
-                                channels[old_channel].remove(client_socket)
-                                broadcast(f"{clients[client_socket]['nickname']} has left the channel.", old_channel, client_socket)
-                        channels[channel_name].append(client_socket)
-                        clients[client_socket]["channel"] = channel_name
-                        
-                        # Send existing chat history for the channel.
-                        if channel_name in chat_history:
-                            for line in chat_history[channel_name]:
-                                client_socket.send((line + "\n").encode())
-                        
-                        join_msg = f"Joined channel '{channel_name}'"
-                        client_socket.send(join_msg.encode())
-                        broadcast(f"{clients[client_socket]['nickname']} has joined the channel.", channel_name, client_socket)
-                
-                elif command == "/list":
-                    ch_list = ", ".join(channels.keys()) if channels else "No channels available."
-                    client_socket.send(f"Available channels: {ch_list}\n".encode())
-                
-                elif command == "/dm":
-                    try:
-                        target_nick, dm_message = args.split(" ", 1)
-                        target_socket = None
-                        for sock, info in clients.items():
-                            if info["nickname"] == target_nick:
-                                target_socket = sock
-                                break
-                        if target_socket:
-                            target_socket.send(f"DM from {clients[client_socket]['nickname']}: {dm_message}\n".encode())
-                        else:
-                            client_socket.send("User not found.\n".encode())
-                    except Exception:
-                        client_socket.send("Usage: /dm <nickname> <message>\n".encode())
-                
-                elif command == "/status":
-                    # This can be extended to update and broadcast user status.
-                    client_socket.send("Status updated.\n".encode())
-                
-                elif command == "/img":
-                    # Handle image command.
-                    channel = clients[client_socket]["channel"]
-                    if channel:
-                        # Broadcast the image command to all clients in the channel.
-                        broadcast(message, channel, sender_socket=client_socket)
-                        # Save the image command in the channel's history.
-                        if channel in chat_history:
-                            chat_history[channel].append(message)
-                        else:
-                            chat_history[channel] = [message]
-                    else:
-                        client_socket.send("Join a channel first using /join <channel>\n".encode())
-                
-                elif command == "/quit":
-                    client_socket.send("Goodbye!\n".encode())
-                    break
-                
+            chat_history.expire()
+        except OSError as e:
+            print("History error:", e)
+
+def sweep_media(interval):
+    """Delete partial uploads abandoned for --media-part-ttl."""
+    while True:
+        time.sleep(interval)
+        try:
+            media_store.sweep()
+        except OSError as e:
+            print("Media error:", e)
+
+def sweep_parked_sessions():
+    while True:
+        time.sleep(1)
+        call_soon(expire_parked_sessions)
+
+def handle_message(session, payload):
+    """Process one frame from a client. Returns False once the client has quit."""
+    client_socket = session.conn
+    message = payload.decode("utf-8", errors="replace")
+    # Process commands starting with '/'
+    if message.startswith("/"):
+        parts = message.strip().split(" ", 1)
+        command = parts[0]
+        args = parts[1] if len(parts) > 1 else ""
+
+        if command == "/nick":
+            old_nick = session.nickname
+            new_nick = args.strip()
+            if not new_nick or " " in new_nick:
+                send_text(client_socket, "Usage: /nick <name>")
+            elif (cluster and cluster.owner(new_nick) not in (None, cluster.worker_id)
+                  or not registry.rename(session, new_nick)):
+                send_text(client_socket, f"Nickname {new_nick} is already taken.")
+            else:
+                if cluster:
+                    cluster.publish({"op": "nick", "nick": new_nick, "old": old_nick})
+                send_text(client_socket, f"Nickname changed from {old_nick} to {new_nick}")
+
+        elif command == "/create":
+            channel_name = args.strip()
+            if not channel_name:
+                send_text(client_socket, "Usage: /create <channel>")
+            elif not registry.create_channel(channel_name):
+                send_text(client_socket, "Channel already exists.")
+            else:
+                chat_history.create(channel_name)  # Initialize history for the channel.
+                if cluster:
+                    cluster.publish({"op": "create", "channel": channel_name})
+                send_text(client_socket, f"Channel '{channel_name}' created.")
+
+        elif command in ("/join", "/rejoin"):
+            # /rejoin <last-id> <channel> joins like /join but only sends what came after last-id.
+            after_id = None
+            channel_name = args.strip()
+            if command == "/rejoin":
+                last_text, _, channel_name = channel_name.partition(" ")
+                after_id = int(last_text) if last_text.isdigit() else None
+            if command == "/rejoin" and after_id is None:
+                send_text(client_socket, "Usage: /rejoin <last-id> <channel>")
+            elif not registry.has_channel(channel_name):
+                send_text(client_socket, "Channel does not exist. Create it with /create <channel>")
+            else:
+                # If already in a channel, the registry moves the client out of it.
+                join_channel(session, channel_name, after_id)
+
+        elif command == "/resume":
+            # /resume <token> [<last-id> <channel>]
+            token, _, rest = args.strip().partition(" ")
+            last_text, _, channel_name = rest.partition(" ")
+            after_id = int(last_text) if last_text.isdigit() else None
+            owner = token_worker(token)
+            if owner is not None and owner != cluster.worker_id:
+                # The session is on another worker: the reply waits for its handover.
+                request_resume(session, token, after_id, channel_name)
+            elif not token or not resume_session(session, token, after_id, channel_name):
+                send_text(client_socket, "Resume failed: no such session.")
+            else:
+                send_text(client_socket, f"Resumed session as {session.nickname}")
+
+        elif command == "/list":
+            names = registry.channel_names()
+            ch_list = ", ".join(names) if names else "No channels available."
+            send_text(client_socket, f"Available channels: {ch_list}")
+
+        elif command == "/dm":
+            try:
+                target_nick, dm_message = args.split(" ", 1)
+                target = registry.find(target_nick)
+                if target and registry.get(target.conn) is not target:
+                    send_text(client_socket, f"{target_nick} is reconnecting. Try again shortly.")
+                elif target:
+                    send_text(target.conn, f"DM from {session.nickname}: {dm_message}")
+                elif cluster and cluster.owner(target_nick) is not None:
+                    cluster.publish({"op": "dm", "nick": target_nick,
+                                     "text": f"DM from {session.nickname}: {dm_message}"})
                 else:
-                    client_socket.send("Unknown command.\n".encode())
+                    send_text(client_socket, "User not found.")
+            except Exception:
+                send_text(client_socket, "Usage: /dm <nickname> <message>")
+
+        elif command == "/history":
+            channel = session.channel
+            try:
+                values = [int(v) for v in args.split()]
+                before_id = values[0] if values else chat_history.latest_id(channel) + 1
+                count = values[1] if len(values) > 1 else history_config["page"]
+                if len(values) > 2 or before_id < 1 or count < 1:
+                    raise ValueError
+            except ValueError:
+                send_text(client_socket, "Usage: /history [before-id] [count]")
             else:
-                # Normal text message: broadcast it and store in chat history.
-                channel = clients[client_socket]["channel"]
                 if channel:
-                    current_time = datetime.datetime.now().strftime('%H:%M')
-                    formatted_message = f"[{current_time} : {clients[client_socket]['nickname']}] {message}"
-                    if channel in chat_history:
-                        chat_history[channel].append(formatted_message)
-                    else:
-                        chat_history[channel] = [formatted_message]
-                    broadcast(formatted_message, channel, sender_socket=client_socket)
+                    count = min(count, history_config["max_page"])
+                    texts = history_texts(channel, chat_history.before(channel, before_id, count))
+                    client_socket.sendall(pack_frames(client_socket, texts))
                 else:
-                    client_socket.send("Join a channel first using /join <channel>\n".encode())
-                    
+                    send_text(client_socket, "Join a channel first using /join <channel>")
+
+        elif command == "/search":
+            channel_name, _, text = args.strip().partition(" ")
+            try:
+                query = parse_query(text)
+            except ValueError:
+                query = None
+            if not search_index:
+                send_text(client_socket, "Search is disabled on this server.")
+            elif query is None or not (query["terms"] or query["author"] or query["since"] or query["until"]):
+                send_text(client_socket, "Usage: /search <channel> <words> [from:nick] [since:time] [until:time] [page:n]")
+            elif not registry.has_channel(channel_name):
+                send_text(client_socket, "Channel does not exist.")
+            else:
+                client_socket.sendall(pack_frames(client_socket, search_texts(channel_name, query)))
+
+        elif command == "/status":
+            # This can be extended to update and broadcast user status.
+            send_text(client_socket, "Status updated.")
+
+        elif command == "/img":
+            # Handle image command.
+            channel = session.channel
+            parts = message.split(" ", 3)
+            digest = parse_media_ref(parts[3]) if len(parts) == 4 else None
+            if digest and not (media_store and media_store.has(digest)):
+                send_text(client_socket, "Unknown image. Upload it before sharing.")
+            elif channel:
+                # Broadcast the image command and save it in the channel's history. It
+                # carries either a media reference or, from older clients, inline base64.
+                post_message(message, channel, client_socket)
+            else:
+                send_text(client_socket, "Join a channel first using /join <channel>")
+
+        elif command == "/stats":
+            if not is_local(session.address):
+                send_text(client_socket, "/stats is only available from the server host.")
+            elif not metrics.enabled:
+                send_text(client_socket, "Metrics are disabled. Start the server with --metrics.")
+            else:
+                send_text(client_socket, metrics.render().rstrip("\n"))
+
+        elif command == "/snapshot":
+            if not is_local(session.address):
+                send_text(client_socket, "/snapshot is only available from the server host.")
+            elif not snapshot_config["path"]:
+                send_text(client_socket, "Snapshots are disabled. Start the server with --snapshot <path>.")
+            else:
+                # Written on a thread so the asyncio engine keeps serving meanwhile.
+                threading.Thread(target=snapshot_command, args=(client_socket,), daemon=True).start()
+
+        elif command == "/quit":
+            # Leaving on purpose: nothing to resume.
+            attached_sessions.pop(session.token, None)
+            session.token = None
+            send_text(client_socket, "Goodbye!")
+            return False
+
+        else:
+            send_text(client_socket, "Unknown command.")
+    else:
+        # Normal text message: broadcast it and store in chat history.
+        channel = session.channel
+        if channel:
+            current_time = datetime.datetime.now().strftime('%H:%M')
+            formatted_message = f"[{current_time} : {session.nickname}] {message}"
+            post_message(formatted_message, channel, client_socket)
+        else:
+            send_text(client_socket, "Join a channel first using /join <channel>")
+    return True
+
+def handle_media(client_socket, flags, payload):
+    """Process one frame on a media connection. Returns False once the client has quit.
+
+    Does file I/O, so the asyncio engine runs it on an executor thread; replies
+    go through call_soon.
+    """
+    if flags & FLAG_BINARY:
+        if len(payload) < CHUNK.size:
+            call_soon(send_text, client_socket, "Upload failed: truncated chunk")
+            return True
+        digest, offset = CHUNK.unpack_from(payload)
+        digest = digest.hex()
+        try:
+            if media_store.write_chunk(digest, offset, memoryview(payload)[CHUNK.size:]):
+                call_soon(send_text, client_socket, f"Stored {digest}")
+        except MediaError as e:
+            call_soon(send_text, client_socket, f"Upload failed {digest}: {e}")
+        return True
+
+    parts = payload.decode("utf-8", errors="replace").split()
+    command = parts[0] if parts else ""
+    if command == "/upload" and len(parts) == 3 and parts[2].isdigit():
+        digest, size = parts[1], int(parts[2])
+        try:
+            offset = media_store.begin_upload(digest, size)
+        except MediaError as e:
+            call_soon(send_text, client_socket, f"Upload failed {digest}: {e}")
+        else:
+            if offset == size:
+                call_soon(send_text, client_socket, f"Stored {digest}")
+            else:
+                call_soon(send_text, client_socket, f"Upload {digest} at {offset}")
+    elif command == "/fetch" and len(parts) in (2, 3):
+        digest = parts[1]
+        found = media_store.open(digest, thumb=parts[2:] == ["thumb"])
+        if found is None:
+            call_soon(send_text, client_socket, f"Media {digest} missing")
+        else:
+            kind, size, f = found
+            with f:
+                if not send_paced(client_socket, encode_frame(f"Media {digest} {kind} {size}")):
+                    return False
+                raw = bytes.fromhex(digest)
+                for offset in range(0, size, CHUNK_SIZE):
+                    data = f.read(CHUNK_SIZE)
+                    if not data or client_socket.closing or client_socket.closed:
+                        break
+                    if not send_paced(client_socket, encode_frame(CHUNK.pack(raw, offset) + data, FLAG_BINARY)):
+                        return False
+    elif command == "/quit":
+        return False
+    else:
+        call_soon(send_text, client_socket, "Usage: /upload <digest> <size> | /fetch <digest> [thumb]")
+    return True
+
+def send_paced(client_socket, frame):
+    """Queue a frame once the connection has drained to half its byte limit, so a large
+    reply waits for the client instead of overflowing the outbound queue.
+
+    Returns False, having aborted the connection, if it does not drain within
+    media_config["send_timeout"].
+    """
+    deadline = time.monotonic() + media_config["send_timeout"]
+    while (client_socket.queued_bytes and client_socket.queued_bytes + len(frame) > client_socket.max_bytes // 2
+           and not (client_socket.closing or client_socket.closed)):
+        if time.monotonic() > deadline:
+            print("Media fetch stalled; closing the connection")
+            call_soon(client_socket.abort)
+            return False
+        time.sleep(0.005)
+    queued = threading.Event()
+    call_soon(queue_frame, client_socket, frame, queued)
+    queued.wait()
+    return True
+
+def queue_frame(client_socket, frame, queued):
+    client_socket.sendall(frame)
+    queued.set()
+
+def handle_frame(client_socket, session, flags, payload):
+    """Route a frame to the chat or media handler. Returns False once the connection should end."""
+    if session is None:
+        return handle_media(client_socket, flags, payload)
+    if flags & FLAG_BINARY:
+        # Binary frames only belong on media connections.
+        return True
+    if metrics.enabled:
+        start = time.perf_counter()
+        running = handle_message(session, payload)
+        metrics.observe("chat_command_seconds", time.perf_counter() - start, command=command_label(payload))
+        return running
+    return handle_message(session, payload)
+
+def is_local(address):
+    """True for a peer connecting from the server host itself."""
+    try:
+        return ipaddress.ip_address(address[0]).is_loopback
+    except (TypeError, ValueError, IndexError):
+        return False
+
+def server_caps():
+    caps = (CAP_COMPRESS if compression else 0) | (CAP_RESUME if resume_ttl else 0)
+    return caps | CAP_MEDIA | MEDIA_CONNECTION if media_store else caps
+
+def remove_client(session):
+    """Drop a disconnected client from its channels and the registry.
+
+    A CAP_RESUME session is parked instead: it keeps its nickname, and its
+    channel only hears that it left if it is not resumed within resume_ttl.
+    """
+    pending_resumes.pop(id(session), None)
+    if session.token:
+        attached_sessions.pop(session.token, None)
+    if session.token and resume_ttl:
+        parked_sessions[session.token] = (session, session.channel, time.time() + resume_ttl)
+        registry.park(session)
+        session.conn.close()
+        return
+    # A session taken over by a resume has already handed its nickname on.
+    holds_nick = registry.find(session.nickname) is session
+    for channel in registry.remove(session):
+        broadcast(f"{session.nickname} has disconnected.", channel, session.conn)
+    if cluster and holds_nick:
+        cluster.publish({"op": "release", "nick": session.nickname})
+    session.conn.close()
+
+def apply_cluster_event(event):
+    """Apply an event the broker relayed; every worker sees the same events in the same order."""
+    op = event["op"]
+    mine = event["worker"] == cluster.worker_id
+    # Sender exclusion ids only mean something in the worker that published the event.
+    exclude = event.get("exclude") if mine else None
+    if op == "create":
+        if registry.create_channel(event["channel"]):
+            chat_history.create(event["channel"])
+    elif op == "message":
+        store_message(event["channel"], event["text"], exclude, event["id"], event["ts"])
+    elif op == "notice":
+        deliver(event["text"], event["channel"], exclude)
+    elif op == "dm":
+        target = registry.find(event["nick"])
+        if target and cluster.owner(event["nick"]) == cluster.worker_id:
+            send_text(target.conn, event["text"])
+    elif op == "resume" and event["owner"] == cluster.worker_id:
+        hand_over(event)
+    elif op == "handover" and event["to"] == cluster.worker_id:
+        finish_resume(event)
+    elif op == "nick" and mine and not event["accepted"]:
+        # Another worker claimed the name first; put ours back.
+        session = registry.find(event["nick"])
+        if session and event["old"] and registry.rename(session, event["old"]):
+            send_text(session.conn, f"Nickname {event['nick']} is already taken.")
+            send_text(session.conn, f"Nickname changed from {event['nick']} to {event['old']}")
+
+def join_cluster():
+    """Connect this worker to the broker and load the cluster's channels."""
+    cluster.connect(apply_cluster_event, {c: chat_history.latest_id(c) for c in chat_history.channels()})
+    for channel_name in cluster.state["channels"]:
+        if registry.create_channel(channel_name):
+            chat_history.create(channel_name)
+
+def server_handshake(client_socket):
+    """Read the client hello and answer with the negotiated version. Returns the agreed caps or None."""
+    try:
+        # A connection that never says hello would hold its admission slot forever.
+        client_socket.settimeout(limit_config["handshake_timeout"] or None)
+        version, caps = negotiate(*decode_hello(recv_exact(client_socket, HELLO.size)), server_caps())
+        client_socket.settimeout(None)
+    except (ProtocolError, OSError) as e:
+        print("Handshake failed:", e)
+        return None
+    client_socket.sendall(encode_hello(version, caps))
+    return caps
+
+def handle_client(sock, address):
+    caps = server_handshake(sock)
+    if caps is None:
+        sock.close()
+        return
+    if caps & MEDIA_CONNECTION:
+        # Media transfers are requested by the reader itself, so a backlog means it is stuck.
+        client_socket = ThreadedConnection(sock, policy="disconnect")
+        session = None
+        decoder = FrameDecoder(compressed=False)
+        limits = ConnectionLimits(media=True)
+    else:
+        client_socket = ThreadedConnection(sock)
+        client_socket.compress = bool(caps & CAP_COMPRESS)
+        client_socket.resume = bool(caps & CAP_RESUME)
+        session = register_client(client_socket, address)
+        decoder = FrameDecoder(limit_config["max_frame_bytes"], client_socket.compress)
+        limits = ConnectionLimits()
+    if metrics.enabled:
+        metrics.inc("chat_connections_total", kind="chat" if session else "media")
+
+    running = True
+    while running:
+        try:
+            data = client_socket.recv(65536)
+            if not data:
+                break
+            if metrics.enabled:
+                metrics.inc("chat_bytes_in_total", len(data))
+            for flags, payload in decoder.feed(data):
+                # Over the limits: stop reading until the client is back within them.
+                delay = limits.delay(session, payload)
+                if delay:
+                    time.sleep(delay)
+                if not handle_frame(client_socket, session, flags, payload):
+                    running = False
+                    break
+        except ProtocolError as e:
+            reject_frame(client_socket, e)
+            break
         except Exception as e:
             print("Client handling error:", e)
             break
-    
+
     # Cleanup on disconnect.
-    channel = clients[client_socket]["channel"]
-    if channel and client_socket in channels.get(channel, []):
-        channels[channel].remove(client_socket)
-        broadcast(f"{clients[client_socket]['nickname']} has disconnected.", channel, client_socket)
-    client_socket.close()
-    del clients[client_socket]
-
-def start_server(ip="0.0.0.0", port=12345):
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((ip, port))
-    server.listen(5)
+    if session:
+        remove_client(session)
+    else:
+        client_socket.close()
+
+async def handle_async_client(reader, writer):
+    address = writer.get_extra_info("peername")
+    print("New connection from", address)
+    try:
+        hello = await asyncio.wait_for(reader.readexactly(HELLO.size), limit_config["handshake_timeout"] or None)
+        version, caps = negotiate(*decode_hello(hello), server_caps())
+    except asyncio.TimeoutError:
+        print("Handshake failed: no hello from", address)
+        writer.close()
+        return
+    except (ProtocolError, asyncio.IncompleteReadError) as e:
+        print("Handshake failed:", e)
+        writer.close()
+        return
+    writer.write(encode_hello(version, caps))
+    if caps & MEDIA_CONNECTION:
+        client_socket = AsyncConnection(writer, policy="disconnect")
+        session = None
+        decoder = FrameDecoder(compressed=False)
+        limits = ConnectionLimits(media=True)
+    else:
+        client_socket = AsyncConnection(writer)
+        client_socket.compress = bool(caps & CAP_COMPRESS)
+        client_socket.resume = bool(caps & CAP_RESUME)
+        session = register_client(client_socket, address)
+        decoder = FrameDecoder(limit_config["max_frame_bytes"], client_socket.compress)
+        limits = ConnectionLimits()
+    if metrics.enabled:
+        metrics.inc("chat_connections_total", kind="chat" if session else "media")
+
+    running = True
+    while running:
+        try:
+            data = await reader.read(65536)
+            if not data:
+                break
+            if metrics.enabled:
+                metrics.inc("chat_bytes_in_total", len(data))
+            for flags, payload in decoder.feed(data):
+                delay = limits.delay(session, payload)
+                if delay:
+                    await asyncio.sleep(delay)
+                if session:
+                    handled = handle_frame(client_socket, session, flags, payload)
+                else:
+                    # Media frames read and write files: keep that off the event loop.
+                    handled = await asyncio.get_running_loop().run_in_executor(
+                        media_pool, handle_media, client_socket, flags, payload)
+                if not handled:
+                    running = False
+                    break
+        except ProtocolError as e:
+            reject_frame(client_socket, e)
+            break
+        except Exception as e:
+            print("Client handling error:", e)
+            break
+
+    if session:
+        remove_client(session)
+    else:
+        client_socket.close()
+
+def reject_frame(client_socket, error):
+    """Tell a client why its connection is being closed after a frame the decoder refused."""
+    limit_stats["rejected_frames"] += 1
+    print("Client protocol error:", error)
+    try:
+        send_text(client_socket, f"Closing connection: {error}")
+    except Exception:
+        pass
+
+def admitted_client(sock, address):
+    """Run a connection that already holds an admission slot, and give the slot back."""
+    try:
+        handle_client(sock, address)
+    finally:
+        admission.leave()
+
+async def admit_async_client(reader, writer):
+    if not admission.enter():
+        writer.close()
+        return
+    try:
+        await handle_async_client(reader, writer)
+    finally:
+        admission.leave()
+
+async def serve_async(ip, port, backlog=1024, listener=None):
+    global call_soon, media_pool
+    loop = asyncio.get_running_loop()
+    media_pool = ThreadPoolExecutor(media_config["workers"], thread_name_prefix="media")
+    # Parked sessions expire on a thread; their notices are sent from the loop.
+    call_soon = loop.call_soon_threadsafe
+    if cluster:
+        # Bus events are read on a thread; apply them on the event loop.
+        cluster.dispatch = lambda handler, event: loop.call_soon_threadsafe(handler, event)
+        join_cluster()
+    if metrics.enabled:
+        metrics.add_collector(lambda: [("chat_asyncio_tasks", "gauge", "Tasks on the event loop.",
+                                        {}, len(asyncio.all_tasks(loop)))])
+    if listener:
+        server = await asyncio.start_server(admit_async_client, sock=listener, backlog=backlog)
+    else:
+        server = await asyncio.start_server(admit_async_client, ip, port, backlog=backlog,
+                                            reuse_address=True, reuse_port=bool(cluster))
+    print(f"Chat server started on {ip}:{port} (asyncio engine)")
+    if handoff_path:
+        handoff = open_handoff_socket(handoff_path)
+        threading.Thread(target=wait_for_successor, args=(handoff, server.sockets[0], server.close),
+                         daemon=True).start()
+    async with server:
+        # Not serve_forever(): after a handoff closes the server, the loop still
+        # has to run until the open connections are drained.
+        await asyncio.Event().wait()
+
+def raise_fd_limit():
+    """Raise the open file limit to the hard maximum so one process can hold many sockets."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+def collect_server_metrics():
+    """Gauges for the current server state, computed when metrics are rendered."""
+    samples = [
+        ("chat_sessions", "gauge", "Connected chat sessions.", {}, len(registry)),
+        ("chat_parked_sessions", "gauge", "Dropped sessions waiting to be resumed.", {}, len(parked_sessions)),
+        ("chat_threads", "gauge", "Live threads in the server process.", {}, threading.active_count()),
+    ]
+    for channel in registry.channel_names():
+        samples.append(("chat_channel_members", "gauge", "Local members of each channel.",
+                        {"channel": channel}, len(registry.channel_members(channel))))
+    for channel, stats in chat_history.stats().items():
+        for key, value in stats.items():
+            samples.append((f"chat_history_{key}", "gauge", f"History {key} held for each channel.",
+                            {"channel": channel}, value))
+    for key, value in outbound_metrics(registry.connections()).items():
+        if key == "connections":
+            continue
+        if key in outbound_stats:
+            samples.append((f"chat_outbound_{key}_total", "counter", f"Outbound {key.replace('_', ' ')} so far.",
+                            {}, value))
+        else:
+            samples.append((f"chat_outbound_{key}", "gauge", f"Outbound {key.replace('_', ' ')}.", {}, value))
+    samples.append(("chat_connections_open", "gauge", "Connections holding an admission slot.", {}, admission.active))
+    for key, value in limit_stats.items():
+        samples.append((f"chat_limit_{key}_total", "counter", f"Limit {key.replace('_', ' ')} so far.", {}, value))
+    return samples
+
+def collect_snapshot_metrics():
+    return [("chat_snapshots_total", "counter", "Snapshots written so far.", {}, snapshot_stats["snapshots"]),
+            ("chat_snapshot_last_bytes", "gauge", "Size of the last snapshot.", {}, snapshot_stats["last_bytes"]),
+            ("chat_snapshot_last_seconds", "gauge", "Time taken to write the last snapshot.", {},
+             snapshot_stats["last_seconds"])]
+
+def collect_search_metrics():
+    return [(f"chat_search_index_{key}", "gauge", f"Search index {key.replace('_', ' ')}.", {}, value)
+            for key, value in search_index.stats().items()]
+
+def index_history():
+    """Index the history recovered from disk before serving, so search covers it."""
+    start = time.perf_counter()
+    count = 0
+    for channel in chat_history.channels():
+        first_id = chat_history.first_id(channel)
+        for msg_id, timestamp, text in chat_history.records(channel):
+            search_index.add(channel, msg_id, timestamp, text, first_id)
+            count += 1
+    if count:
+        print(f"Indexed {count} messages in {time.perf_counter() - start:.1f}s")
+
+def snapshot_state(since=None):
+    """What a snapshot holds: channels, resumable sessions, in-memory history and the search index.
+
+    Taken under store_lock, so the history and the index agree. Connected
+    CAP_RESUME sessions are saved as if they had just dropped, so their
+    clients can resume on a restarted server. since maps channels to the
+    first message id to include, for a delta; a delta has no index.
+    """
+    now = time.time()
+    with store_lock:
+        channels = registry.channel_names()
+        sessions = [(token, parked.nickname, channel, deadline)
+                    for token, (parked, channel, deadline) in list(parked_sessions.items())]
+        for conn in registry.connections():
+            session = registry.get(conn)
+            if session and session.token:
+                sessions.append((session.token, session.nickname, session.channel, now + resume_ttl))
+        histories = None
+        if isinstance(chat_history, MemoryHistory):
+            histories = {}
+            for channel in chat_history.channels():
+                next_id = chat_history.latest_id(channel) + 1
+                if since is None:
+                    records = chat_history.records(channel)
+                else:
+                    records = chat_history.before(channel, next_id, next_id - since.get(channel, 1))
+                histories[channel] = (next_id, records)
+        index = search_index.snapshot() if search_index and since is None else None
+    return channels, sessions, histories, index
+
+def save_snapshot(path=None):
+    """Write a snapshot to path (by default --snapshot). Returns (path, bytes, seconds)."""
+    path = path or snapshot_config["path"]
+    with snapshot_lock:
+        start = time.perf_counter()
+        size = write_snapshot(path, *snapshot_state())
+        elapsed = time.perf_counter() - start
+    snapshot_stats.update(snapshots=snapshot_stats["snapshots"] + 1, last_bytes=size, last_seconds=elapsed)
+    print(f"Snapshot {path}: {size / 1048576:.1f} MiB in {elapsed * 1000:.0f} ms")
+    return path, size, elapsed
+
+def snapshot_command(client_socket):
+    try:
+        path, size, elapsed = save_snapshot()
+        reply = f"Snapshot written to {path}: {size / 1048576:.1f} MiB in {elapsed * 1000:.0f} ms"
+    except OSError as e:
+        print("Snapshot error:", e)
+        reply = f"Snapshot failed: {e}"
+    call_soon(send_text, client_socket, reply)
+
+def snapshot_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            save_snapshot()
+        except OSError as e:
+            print("Snapshot error:", e)
+
+def restore_snapshot(path, indexed=False):
+    """Load channels, parked sessions, history and the search index from a snapshot.
+
+    indexed says the search index is already loaded (from a handoff's base
+    snapshot). Returns whether the index is in place; messages the history
+    holds past it are indexed here.
+    """
+    start = time.perf_counter()
+    try:
+        state = read_snapshot(path)
+    except (OSError, SnapshotError) as e:
+        print("Snapshot error:", e)
+        state = {"channels": [], "sessions": []}
+    for channel in state["channels"]:
+        registry.create_channel(channel)
+        chat_history.create(channel)
+    if "histories" in state and isinstance(chat_history, MemoryHistory):
+        for channel, (next_id, records) in state["histories"].items():
+            chat_history.restore(channel, next_id, records)
+    now = time.time()
+    for token, nickname, channel, deadline in state["sessions"]:
+        session = registry.reserve(nickname) if deadline > now else None
+        if session:
+            parked_sessions[token] = (session, channel, deadline)
+    if search_index and "index" in state:
+        search_index.restore(state["index"])
+        indexed = True
+    caught_up = index_new_messages() if indexed else 0
+    print(f"Restored snapshot {path}: {len(state['channels'])} channels, {len(parked_sessions)} sessions"
+          f"{f', {caught_up} messages indexed since' if caught_up else ''} in {(time.perf_counter() - start) * 1000:.0f} ms")
+    return indexed
+
+def index_new_messages():
+    """Index the messages the history holds past a restored index; returns how many there were."""
+    count = 0
+    for channel in chat_history.channels():
+        first_id = chat_history.first_id(channel)
+        after = max(search_index.next_id(channel) or 1, first_id)
+        latest = chat_history.latest_id(channel)
+        for msg_id, timestamp, text in chat_history.before(channel, latest + 1, latest - after + 1):
+            search_index.add(channel, msg_id, timestamp, text, first_id)
+            count += 1
+    return count
+
+def open_handoff_socket(path):
+    """Listen for a successor on a Unix socket, replacing one left behind by a crash."""
+    if os.path.exists(path):
+        os.unlink(path)
+    handoff = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    handoff.bind(path)
+    handoff.listen(1)
+    return handoff
+
+def recv_handoff(sock):
+    """The next frame from the other side of a handoff, as text, and any fds sent with it."""
+    decoder = FrameDecoder(4096)
+    fds = []
+    frames = []
+    while not frames:
+        data, received, flags, address = socket.recv_fds(sock, 4096, 1)
+        fds.extend(received)
+        if not data:
+            raise ConnectionError("the other side closed the handoff connection")
+        frames = decoder.feed(data)
+    return frames[0][1].decode(), fds
+
+def wait_for_successor(handoff, listener, stop_accepting):
+    while True:
+        conn, _ = handoff.accept()
+        conn.settimeout(2)
+        try:
+            if recv_handoff(conn)[0] == "takeover":
+                # Loading the base snapshot takes the successor as long as it takes.
+                conn.settimeout(None)
+                hand_off(conn, listener, stop_accepting)
+        except (OSError, ProtocolError) as e:
+            print("Handoff error:", e)
+        conn.close()
+
+def hand_off(conn, listener, stop_accepting):
+    """Hand the listening socket and this server's state to a successor, then exit.
+
+    The successor first loads a full snapshot taken while this server keeps
+    serving. When it is ready, this server stops accepting and closes its
+    chat connections, which parks every CAP_RESUME session, and sends the
+    socket with a delta: channels, sessions and the messages since the full
+    snapshot. Connections arriving meanwhile wait in the listen backlog, so
+    the pause lasts as long as the delta takes, whatever the history size.
+    If the successor goes away before it is ready, this server carries on.
+    """
+    start = time.perf_counter()
+    base = handoff_path + ".base"
+    state = snapshot_state()
+    write_snapshot(base, *state)
+    sent = {channel: next_id for channel, (next_id, records) in (state[2] or {}).items()}
+    conn.sendall(encode_frame(base))
+    if recv_handoff(conn)[0] != "ready":
+        raise ConnectionError("the successor is not ready")
+    paused = time.perf_counter()
+    fd = os.dup(listener.fileno())
+    call_soon(stop_accepting)
+    if os.path.exists(handoff_path):
+        os.unlink(handoff_path)
+    call_soon(close_connections, "Server restarting. Reconnect to continue.")
+    deadline = time.time() + 5
+    while len(registry) and time.time() < deadline:
+        time.sleep(0.005)
+    delta = handoff_path + ".delta"
+    write_snapshot(delta, *snapshot_state(sent))
+    # The successor opens segment history once this process has let go of it.
+    chat_history.close()
+    socket.send_fds(conn, [encode_frame(delta)], [fd])
+    end = time.perf_counter()
+    print(f"Handed off to successor: base snapshot sent after {(paused - start) * 1000:.0f} ms, "
+          f"then paused {(end - paused) * 1000:.0f} ms")
+    sys.stdout.flush()
+    os._exit(0)
+
+def close_connections(notice):
+    for conn in registry.connections():
+        try:
+            send_text(conn, notice)
+            conn.close()
+        except Exception as e:
+            print("Close error:", e)
+
+def take_over(path, open_history, timeout=60):
+    """Take over from the server handing off on path. Returns (listening socket, whether the index was restored).
+
+    The base snapshot is loaded while the old server still serves; once it
+    is in, the old server stops and sends its socket and a small delta.
+    """
+    global chat_history
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(path)
+    sock.sendall(encode_frame("takeover"))
+    base = recv_handoff(sock)[0]
+    indexed = load_base_snapshot(base)
+    sock.sendall(encode_frame("ready"))
+    delta, fds = recv_handoff(sock)
+    sock.close()
+    if not fds:
+        raise ConnectionError("the server sent no listening socket")
+    if chat_history is None:
+        chat_history = open_history()
+    indexed = restore_snapshot(delta, indexed)
+    os.unlink(base)
+    os.unlink(delta)
+    return socket.socket(fileno=fds[0]), indexed
+
+def load_base_snapshot(path):
+    """The part of a handoff loaded while the old server still serves: history and the search index.
+    Returns whether the index was in it."""
+    start = time.perf_counter()
+    state = read_snapshot(path)
+    if "histories" in state and isinstance(chat_history, MemoryHistory):
+        for channel, (next_id, records) in state["histories"].items():
+            chat_history.restore(channel, next_id, records)
+    indexed = bool(search_index) and "index" in state
+    if indexed:
+        search_index.restore(state["index"])
+        # Catching up on the delta would otherwise do this while connections wait.
+        search_index.unseal_newest()
+    print(f"Loaded base snapshot {path} in {(time.perf_counter() - start) * 1000:.0f} ms")
+    return indexed
+
+def report_stats(interval):
+    """Print outbound queue depths, slow-consumer drops and rate limiting every interval seconds."""
+    while True:
+        time.sleep(interval)
+        metrics = outbound_metrics(registry.connections())
+        print("Outbound:", " ".join(f"{k}={v}" for k, v in metrics.items()))
+        print(f"Limits: open={admission.active}", " ".join(f"{k}={v:g}" for k, v in limit_stats.items()))
+
+def start_server(ip="0.0.0.0", port=12345, engine="threaded", stats_interval=0, listener=None, indexed=False):
+    """Serve forever. listener is a listening socket taken over from a predecessor;
+    indexed says the search index was restored from a snapshot."""
+    # Channels recovered from persistent history come back empty.
+    for channel_name in chat_history.channels():
+        registry.create_channel(channel_name)
+    if search_index and not indexed:
+        index_history()
+    if resume_ttl:
+        threading.Thread(target=sweep_parked_sessions, daemon=True).start()
+    if chat_history.max_age:
+        threading.Thread(target=sweep_history, args=(min(60, chat_history.max_age / 10),), daemon=True).start()
+    if media_store:
+        threading.Thread(target=sweep_media, args=(min(3600, media_store.part_ttl / 10),), daemon=True).start()
+    if stats_interval:
+        threading.Thread(target=report_stats, args=(stats_interval,), daemon=True).start()
+    if snapshot_config["path"] and snapshot_config["interval"]:
+        threading.Thread(target=snapshot_loop, args=(snapshot_config["interval"],), daemon=True).start()
+    if engine == "asyncio":
+        raise_fd_limit()
+        asyncio.run(serve_async(ip, port, listener=listener))
+        return
+    if engine != "threaded":
+        raise ValueError(f"Unknown engine {engine!r}; expected one of {', '.join(ENGINES)}")
+
+    if listener:
+        server = listener
+        # The predecessor may have been the asyncio engine, which made the socket non-blocking.
+        server.setblocking(True)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if cluster:
+            join_cluster()
+            # Every worker binds the same port; the kernel spreads connections across them.
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.bind((ip, port))
+        # Refusals come from the admission limit, not from a listen queue that overflows on bursts.
+        server.listen(1024)
     print(f"Chat server started on {ip}:{port}")
-    
+
+    # A handoff takes this lock for good, leaving new connections in the backlog for the successor.
+    accepting = threading.Lock()
+    if handoff_path:
+        threading.Thread(target=wait_for_successor, args=(open_handoff_socket(handoff_path), server, accepting.acquire),
+                         daemon=True).start()
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
     while True:
-        client_socket, address = server.accept()
-        print("New connection from", address)
-        threading.Thread(target=handle_client, args=(client_socket, address)).start()
+        selector.select()
+        with accepting:
+            client_socket, address = server.accept()
+            # Refuse before spending a thread on a connection the server has no room for.
+            if not admission.enter():
+                client_socket.close()
+                continue
+            print("New connection from", address)
+            threading.Thread(target=admitted_client, args=(client_socket, address)).start()
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="Borg chat server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--engine", choices=ENGINES, default="threaded",
+                        help="threaded: two OS threads (reader and writer) per connection; "
+                             "asyncio: single event loop, for large numbers of clients")
+    parser.add_argument("--slow-policy", choices=POLICIES, default=outbound_config["policy"],
+                        help="what to do when a client's outbound queue is full")
+    parser.add_argument("--max-queue-frames", type=int, default=outbound_config["max_frames"])
+    parser.add_argument("--max-queue-bytes", type=int, default=outbound_config["max_bytes"])
+    parser.add_argument("--batch-window-us", type=int, default=outbound_config["batch_window_us"],
+                        help="during a burst, hold a client's writes this long to batch frames (0 = off)")
+    parser.add_argument("--batch-max-bytes", type=int, default=outbound_config["batch_max_bytes"])
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="print outbound queue and rate limit stats every N seconds (0 = off)")
+    parser.add_argument("--frame-rate", type=float, default=limit_config["frame_rate"],
+                        help="frames per second per connection before reads slow down (0 = unlimited)")
+    parser.add_argument("--frame-burst", type=int, default=limit_config["frame_burst"])
+    parser.add_argument("--byte-rate", type=float, default=limit_config["byte_rate"],
+                        help="payload bytes per second per connection (0 = unlimited)")
+    parser.add_argument("--byte-burst", type=int, default=limit_config["byte_burst"])
+    parser.add_argument("--channel-rate", type=float, default=limit_config["channel_rate"],
+                        help="messages per second per channel, per process (0 = unlimited)")
+    parser.add_argument("--channel-burst", type=int, default=limit_config["channel_burst"])
+    parser.add_argument("--max-frame-bytes", type=int, default=limit_config["max_frame_bytes"],
+                        help="close chat connections that send a larger frame")
+    parser.add_argument("--max-connections", type=int, default=limit_config["max_connections"],
+                        help="refuse connections past this many (0 = unlimited)")
+    parser.add_argument("--handshake-timeout", type=float, default=limit_config["handshake_timeout"],
+                        help="close connections that send no hello within this many seconds (0 = wait forever)")
+    parser.add_argument("--history-dir", help="keep channel history in segment files under this directory")
+    parser.add_argument("--history-tail", type=int, default=1000,
+                        help="recent messages per channel kept in memory")
+    parser.add_argument("--join-history", type=int, default=history_config["join"],
+                        help="messages replayed on /join")
+    parser.add_argument("--history-max-messages", type=int, help="retain at most this many messages per channel")
+    parser.add_argument("--history-max-bytes", type=int, help="retain at most this many bytes per channel")
+    parser.add_argument("--history-max-age", type=float, help="drop history older than this many seconds")
+    parser.add_argument("--segment-bytes", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--media-dir",
+                        help="content-addressed image store; enables media connections (off by default)")
+    parser.add_argument("--media-max-bytes", type=int, default=16 * 1024 * 1024)
+    parser.add_argument("--media-quota-bytes", type=int, default=1024 ** 3,
+                        help="refuse uploads once the media store holds this many bytes (0 = unlimited)")
+    parser.add_argument("--media-part-ttl", type=float, default=24 * 3600,
+                        help="delete partial uploads untouched for this many seconds")
+    parser.add_argument("--media-byte-rate", type=float, default=limit_config["media_byte_rate"],
+                        help="upload bytes per second per media connection (0 = unlimited)")
+    parser.add_argument("--media-byte-burst", type=int, default=limit_config["media_byte_burst"])
+    parser.add_argument("--media-send-timeout", type=float, default=media_config["send_timeout"],
+                        help="close media connections that take no fetched data for this many seconds")
+    parser.add_argument("--media-workers", type=int, default=media_config["workers"],
+                        help="threads for media transfers on the asyncio engine")
+    parser.add_argument("--metrics", action="store_true",
+                        help="collect metrics for /stats (local clients only)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="also serve metrics at http://127.0.0.1:PORT/metrics (workers use PORT + worker id)")
+    parser.add_argument("--search-max-bytes", type=int, default=search_index.max_bytes,
+                        help="memory for the /search index; the oldest messages drop out past it")
+    parser.add_argument("--no-search", action="store_true", help="disable /search and its index")
+    parser.add_argument("--resume-ttl", type=float, default=resume_ttl,
+                        help="seconds a dropped client can resume its session without a rejoin (0 = off)")
+    parser.add_argument("--snapshot", help="snapshot file: restored at startup if it exists, written on /snapshot")
+    parser.add_argument("--snapshot-interval", type=float, default=0,
+                        help="also write the snapshot every N seconds (0 = only on demand)")
+    parser.add_argument("--handoff", metavar="PATH",
+                        help="Unix socket where a successor started with --takeover PATH takes over this server")
+    parser.add_argument("--takeover", metavar="PATH",
+                        help="take the listening socket and state over from the server handing off on PATH")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="never offer compressed frames to clients")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run N worker processes sharing the port over a local bus (0 = single process)")
+    parser.add_argument("--worker-id", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--bus", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers and (args.snapshot or args.handoff or args.takeover):
+        parser.error("snapshots and handoff need a single-process server (no --workers)")
+    if args.workers:
+        run_cluster(os.path.abspath(__file__), sys.argv[1:], args.workers)
+        sys.exit(0)
+    if args.bus:
+        cluster = ClusterBus(args.bus, args.worker_id)
+        if args.history_dir:
+            # Each worker keeps its own replica of the history.
+            args.history_dir = os.path.join(args.history_dir, f"worker{args.worker_id}")
+    if args.media_dir:
+        media_store = MediaStore(args.media_dir, args.media_max_bytes, args.media_quota_bytes, args.media_part_ttl)
+    media_config.update(workers=args.media_workers, send_timeout=args.media_send_timeout)
+    history_config["join"] = args.join_history
+    compression = not args.no_compression
+    resume_ttl = args.resume_ttl
+    snapshot_config.update(path=args.snapshot, interval=args.snapshot_interval)
+    handoff_path = args.handoff
+    search_index = None if args.no_search else SearchIndex(args.search_max_bytes)
+    if args.history_dir:
+        open_history = lambda: SegmentHistory(args.history_dir, tail_size=args.history_tail,
+                                              segment_bytes=args.segment_bytes,
+                                              max_messages=args.history_max_messages,
+                                              max_bytes=args.history_max_bytes,
+                                              max_age=args.history_max_age)
+    else:
+        open_history = lambda: MemoryHistory(args.history_tail, max_messages=args.history_max_messages,
+                                             max_bytes=args.history_max_bytes, max_age=args.history_max_age)
+    # A successor opens segment history only once its predecessor has closed it.
+    chat_history = None if args.takeover and args.history_dir else open_history()
+    limit_config.update(frame_rate=args.frame_rate, frame_burst=args.frame_burst, byte_rate=args.byte_rate,
+                        byte_burst=args.byte_burst, channel_rate=args.channel_rate,
+                        channel_burst=args.channel_burst, max_frame_bytes=args.max_frame_bytes,
+                        max_connections=args.max_connections, handshake_timeout=args.handshake_timeout,
+                        media_byte_rate=args.media_byte_rate, media_byte_burst=args.media_byte_burst)
+    outbound_config.update(policy=args.slow_policy, max_frames=args.max_queue_frames,
+                           max_bytes=args.max_queue_bytes, batch_window_us=args.batch_window_us,
+                           batch_max_bytes=args.batch_max_bytes)
+    if args.metrics or args.metrics_port:
+        metrics.enabled = True
+        metrics.add_collector(collect_server_metrics)
+        if search_index:
+            metrics.add_collector(collect_search_metrics)
+        if args.snapshot:
+            metrics.add_collector(collect_snapshot_metrics)
+        if args.metrics_port:
+            serve_metrics(args.metrics_port + args.worker_id)
+    listener = None
+    indexed = False
+    if args.takeover:
+        listener, indexed = take_over(args.takeover, open_history)
+    elif args.snapshot and os.path.exists(args.snapshot):
+        indexed = restore_snapshot(args.snapshot)
+    start_server(args.host, args.port, args.engine, args.stats_interval, listener, indexed)
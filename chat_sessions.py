@@ -0,0 +1,158 @@
+"""Session registry for the chat server.
+
+Keeps every index the handlers need so nothing has to scan the client table:
+
+    sessions    connection -> Session
+    nicknames   nickname -> Session (nicknames are unique)
+    members     channel -> ordered set of sessions (a dict with None values)
+    Session.channels   the reverse index, session -> channels it is in
+
+A parked session is one that dropped but may be resumed: it has left the
+session table and its channels, but still holds its nickname.
+
+All mutations go through one re-entrant lock, so threaded handlers can call
+it concurrently; lookups, joins, leaves and disconnects are O(1) in the
+number of users.
+"""
+import threading
+
+class Session:
+    """One connected client."""
+
+    __slots__ = ("conn", "nickname", "channel", "channels", "address", "token")
+
+    def __init__(self, conn, nickname, address=None):
+        self.conn = conn
+        self.nickname = nickname
+        self.address = address
+        self.channel = None      # Channel messages go to.
+        self.channels = set()    # Every channel the session is a member of.
+        self.token = None        # Resume token, for clients that negotiated CAP_RESUME.
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.sessions = {}
+        self.nicknames = {}
+        self.members = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, conn, nickname, address=None):
+        """Register a connection under nickname, adding a suffix if it is taken."""
+        with self.lock:
+            unique = nickname
+            suffix = 2
+            while unique in self.nicknames:
+                unique = f"{nickname}-{suffix}"
+                suffix += 1
+            session = Session(conn, unique, address)
+            self.sessions[conn] = session
+            self.nicknames[unique] = session
+            return session
+
+    def remove(self, session):
+        """Forget a session; returns the channels it was removed from."""
+        with self.lock:
+            self.sessions.pop(session.conn, None)
+            if self.nicknames.get(session.nickname) is session:
+                del self.nicknames[session.nickname]
+            left = list(session.channels)
+            for channel in left:
+                self.members.get(channel, {}).pop(session, None)
+            session.channels.clear()
+            session.channel = None
+            return left
+
+    def park(self, session):
+        """Take a dropped session out of the table and its channels, keeping its nickname.
+
+        session.channel still names the channel it was in. Registry.remove()
+        releases the nickname for good.
+        """
+        with self.lock:
+            self.sessions.pop(session.conn, None)
+            for channel in session.channels:
+                self.members.get(channel, {}).pop(session, None)
+            session.channels.clear()
+
+    def reserve(self, nickname):
+        """A parked session holding nickname, e.g. one restored from a snapshot; None if the name is taken."""
+        with self.lock:
+            if nickname in self.nicknames:
+                return None
+            session = self.nicknames[nickname] = Session(None, nickname)
+            return session
+
+    def take_over(self, session, parked):
+        """Move a parked session's nickname to session. Returns False if it is no longer reserved."""
+        with self.lock:
+            if self.nicknames.get(parked.nickname) is not parked:
+                return False
+            del self.nicknames[parked.nickname]
+            return self.rename(session, parked.nickname)
+
+    def get(self, conn):
+        return self.sessions.get(conn)
+
+    def find(self, nickname):
+        return self.nicknames.get(nickname)
+
+    def rename(self, session, nickname):
+        """Claim a new nickname for session. Returns False if someone else holds it."""
+        with self.lock:
+            holder = self.nicknames.get(nickname)
+            if holder is not None and holder is not session:
+                return False
+            if self.nicknames.get(session.nickname) is session:
+                del self.nicknames[session.nickname]
+            session.nickname = nickname
+            self.nicknames[nickname] = session
+            return True
+
+    def create_channel(self, channel):
+        with self.lock:
+            if channel in self.members:
+                return False
+            self.members[channel] = {}
+            return True
+
+    def has_channel(self, channel):
+        return channel in self.members
+
+    def channel_names(self):
+        with self.lock:
+            return list(self.members)
+
+    def join(self, session, channel):
+        """Make channel the session's active channel, leaving the previous one.
+
+        Returns the channel that was left, or None.
+        """
+        with self.lock:
+            old = session.channel
+            if old == channel:
+                return None
+            if old is not None:
+                self.leave(session, old)
+            self.members[channel][session] = None
+            session.channels.add(channel)
+            session.channel = channel
+            return old
+
+    def leave(self, session, channel):
+        with self.lock:
+            self.members.get(channel, {}).pop(session, None)
+            session.channels.discard(channel)
+            if session.channel == channel:
+                session.channel = None
+
+    def channel_members(self, channel):
+        """Snapshot of a channel's members, safe to iterate without the lock."""
+        with self.lock:
+            return list(self.members.get(channel, ()))
+
+    def connections(self):
+        with self.lock:
+            return list(self.sessions)
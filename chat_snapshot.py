@@ -0,0 +1,180 @@
+"""Binary snapshots of server state, for restarts and handoffs.
+
+    python chat_server.py --snapshot state.snap --snapshot-interval 60
+
+A snapshot holds the channel list, the resumable sessions (token, nickname,
+channel and the deadline by which the client must come back), the in-memory
+history when the server runs without --history-dir, and the search index.
+Segment history is already on disk and recovers by itself; a snapshot taken
+with it only carries the index, which covers the ids below each block's
+next_id, so the server indexes whatever was appended after the snapshot.
+
+Layout: a header (magic, version, creation time), then tagged sections of
+(tag, length, payload). Unknown sections are skipped. Numbers inside
+sections are arrays in the writer's native byte order, so a snapshot is only
+meant to be read back on the machine that wrote it. Lists of strings are one
+NUL-separated UTF-8 blob, or a length array and a blob when a string
+contains NUL, so loading a million messages is a single decode and split.
+
+Files are written to a temporary name and renamed into place, so a crash
+mid-write leaves the previous snapshot intact.
+"""
+import itertools, os, struct, time
+from array import array
+from operator import itemgetter
+from chat_search import Block
+
+MAGIC = b"CHATSNAP"
+VERSION = 1
+HEADER = struct.Struct("!8sHd")      # magic, version, creation time
+SECTION = struct.Struct("!4sQ")      # tag, payload length
+STRINGS = struct.Struct("!BQQ")      # separated (1) or length-prefixed (0), count, blob length
+COUNT = struct.Struct("!Q")
+HISTORY = struct.Struct("!QQ")       # next id, records; ids run consecutively up to next id
+BLOCK = struct.Struct("!QQQ")        # first id, next id, size estimate
+
+class SnapshotError(Exception):
+    pass
+
+def pack_strings(strings):
+    joined = "\0".join(strings)
+    if joined.count("\0") == max(0, len(strings) - 1):
+        blob = joined.encode("utf-8")
+        return STRINGS.pack(1, len(strings), len(blob)) + blob
+    encoded = [s.encode("utf-8") for s in strings]
+    blob = b"".join(encoded)
+    return STRINGS.pack(0, len(strings), len(blob)) + pack_array(array("I", map(len, encoded))) + blob
+
+def pack_array(values):
+    data = values.tobytes()
+    return COUNT.pack(len(data)) + data
+
+class Reader:
+    """Walks a section payload."""
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def take(self, size):
+        if self.offset + size > len(self.data):
+            raise SnapshotError("truncated section")
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+    def unpack(self, fmt):
+        return fmt.unpack(self.take(fmt.size))
+
+    def array(self, typecode):
+        values = array(typecode)
+        values.frombytes(self.take(self.unpack(COUNT)[0]))
+        return values
+
+    def strings(self):
+        separated, count, size = self.unpack(STRINGS)
+        lengths = None if separated else self.array("I")
+        blob = self.take(size)
+        if not count:
+            return []
+        if separated:
+            return str(blob, "utf-8").split("\0")
+        strings = []
+        offset = 0
+        for length in lengths:
+            strings.append(str(blob[offset:offset + length], "utf-8"))
+            offset += length
+        return strings
+
+def write_snapshot(path, channels, sessions, histories=None, index=None):
+    """Write a snapshot atomically and return its size in bytes.
+
+    sessions is a list of (token, nickname, channel or None, deadline).
+    histories maps a channel to (next id, records), records as the history
+    backends return them. index maps a channel to its search blocks, oldest
+    first, as SearchIndex.snapshot() returns them; they are sealed here.
+    """
+    sections = [(b"CHAN", pack_strings(channels))]
+    tokens, nicknames, session_channels, deadlines = zip(*sessions) if sessions else ((), (), (), ())
+    sections.append((b"SESS", pack_strings(tokens) + pack_strings(nicknames) +
+                     pack_strings([c or "" for c in session_channels]) + pack_array(array("d", deadlines))))
+    if histories is not None:
+        parts = [pack_strings(list(histories))]
+        for next_id, records in histories.values():
+            parts.append(HISTORY.pack(next_id, len(records)))
+            parts.append(pack_array(array("d", map(itemgetter(1), records))))
+            parts.append(pack_strings(list(map(itemgetter(2), records))))
+        sections.append((b"HIST", b"".join(parts)))
+    if index is not None:
+        parts = [pack_strings(list(index))]
+        for blocks in index.values():
+            parts.append(COUNT.pack(len(blocks)))
+            for block in blocks:
+                block.seal()
+                parts.append(BLOCK.pack(block.first_id, block.next_id, block.size))
+                parts.append(pack_array(block.times))
+                parts.append(pack_strings(list(block.terms)))
+                parts.append(pack_array(block.starts))
+                parts.append(pack_array(block.ids))
+        sections.append((b"INDX", b"".join(parts)))
+    temp = path + ".tmp"
+    size = HEADER.size
+    with open(temp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        for tag, payload in sections:
+            f.write(SECTION.pack(tag, len(payload)))
+            f.write(payload)
+            size += SECTION.size + len(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+    return size
+
+def read_snapshot(path):
+    """Load a snapshot into a dict with created, channels, sessions and, when present, histories and index."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise SnapshotError("not a snapshot")
+    magic, version, created = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError("not a snapshot")
+    if version != VERSION:
+        raise SnapshotError(f"unsupported snapshot version {version}")
+    state = {"created": created, "channels": [], "sessions": []}
+    reader = Reader(data)
+    reader.offset = HEADER.size
+    while reader.offset < len(data):
+        tag, size = reader.unpack(SECTION)
+        section = Reader(reader.take(size))
+        if tag == b"CHAN":
+            state["channels"] = section.strings()
+        elif tag == b"SESS":
+            tokens, nicknames, channels = section.strings(), section.strings(), section.strings()
+            state["sessions"] = list(zip(tokens, nicknames, [c or None for c in channels], section.array("d")))
+        elif tag == b"HIST":
+            histories = state["histories"] = {}
+            for channel in section.strings():
+                next_id, count = section.unpack(HISTORY)
+                times = section.array("d")
+                texts = section.strings()
+                histories[channel] = (next_id, list(zip(range(next_id - count, next_id), times, texts)))
+        elif tag == b"INDX":
+            index = state["index"] = {}
+            for channel in section.strings():
+                blocks = index[channel] = []
+                for _ in range(section.unpack(COUNT)[0]):
+                    blocks.append(read_block(section))
+    return state
+
+def read_block(section):
+    first_id, next_id, size = section.unpack(BLOCK)
+    block = Block(first_id)
+    block.next_id = next_id
+    block.size = size
+    block.times = section.array("I")
+    block.postings = None
+    block.terms = dict(zip(section.strings(), itertools.count()))
+    block.starts = section.array("I")
+    block.ids = section.array("I")
+    return block
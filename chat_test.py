@@ -0,0 +1,136 @@
+"""Regression tests for bugs that once made it into a release.
+
+    python -m unittest chat_test      (or: python -m pytest chat_test.py)
+
+The resume tests start real servers on free ports through chat_headless,
+the same way chat_bench does; the rest run in-process.
+"""
+import asyncio, os, random, shutil, tempfile, unittest
+from chat_headless import UNLIMITED, HeadlessClient, free_port, spawn_server
+from chat_history import SegmentHistory, channel_dirname
+from chat_protocol import CAP_RESUME, HEADER, MAX_FRAME_SIZE, FrameDecoder, compress_runs, encode_frame
+
+class HistoryPathTest(unittest.TestCase):
+    """Channel names must never reach outside --history-dir."""
+
+    def setUp(self):
+        self.parent = tempfile.mkdtemp(prefix="chat-test-")
+        self.directory = os.path.join(self.parent, "history")
+
+    def tearDown(self):
+        shutil.rmtree(self.parent, ignore_errors=True)
+
+    def test_dot_names_stay_inside(self):
+        channels = [".", "..", "...", ".x", "a/b", "room"]
+        history = SegmentHistory(self.directory)
+        for channel in channels:
+            history.create(channel)
+            history.append(channel, f"hello {channel}")
+        history.close()
+        self.assertEqual(os.listdir(self.parent), ["history"])
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(channel_dirname(c) for c in channels))
+        history = SegmentHistory(self.directory)
+        self.assertEqual(sorted(history.channels()), sorted(channels))
+        for channel in channels:
+            self.assertEqual(history.last(channel, 1)[0][2], f"hello {channel}")
+        history.close()
+
+    def test_empty_name_refused(self):
+        history = SegmentHistory(self.directory)
+        with self.assertRaises(ValueError):
+            history.create("")
+        history.close()
+
+    def test_unknown_directory_skipped(self):
+        os.makedirs(os.path.join(self.directory, ".hidden"))
+        history = SegmentHistory(self.directory)
+        self.assertEqual(history.channels(), [])
+        history.close()
+
+class CompressedPageTest(unittest.TestCase):
+    """A history page of large messages must decode with a default FrameDecoder."""
+
+    def check_page(self, body):
+        payloads = [b"[12:00 : test] " + body for _ in range(50)]
+        stream = compress_runs([encode_frame(p) for p in payloads])
+        pos = 0
+        while pos < len(stream):
+            length, flags = HEADER.unpack_from(stream, pos)
+            self.assertLessEqual(length, MAX_FRAME_SIZE)
+            pos += HEADER.size + length
+        self.assertEqual([payload for _, payload in FrameDecoder().feed(stream)], payloads)
+
+    def test_compressible_page(self):
+        self.check_page(b"x" * 500000)
+
+    def test_random_page(self):
+        self.check_page(random.Random(1).randbytes(500000))
+
+async def read_until(client, expect, timeout=10):
+    """Messages up to and including the first one starting with expect."""
+    lines = []
+    while not lines or not lines[-1].startswith(expect):
+        lines.append(await client.recv(timeout))
+    return lines
+
+class ResumeTest(unittest.TestCase):
+    """A resumed session gets each message it missed exactly once."""
+
+    def run_server(self, args):
+        port = free_port()
+        proc = spawn_server(port, ["--engine", "asyncio"] + UNLIMITED + args)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.terminate)
+        return port
+
+    async def missed_after_resume(self, port, connect_back):
+        alice = await HeadlessClient.connect("127.0.0.1", port, CAP_RESUME)
+        await alice.command("/nick alice", "Nickname")
+        await alice.command("/create room", "Channel")
+        await alice.command("/join room", "Joined")
+        bob = await HeadlessClient.connect("127.0.0.1", port, CAP_RESUME)
+        await bob.command("/nick bob", "Nickname")
+        await bob.command("/join room", "Joined")
+        bob.send("one")
+        await read_until(alice, "[")
+        alice.writer.close()
+        await asyncio.sleep(0.3)
+        bob.send("two")
+        await bob.writer.drain()
+        await asyncio.sleep(0.3)
+        back = await connect_back(alice.token)
+        back.send(f"/resume {alice.token} {alice.last_id} room")
+        lines = await read_until(back, "Resume")
+        self.assertEqual(lines[-1], "Resumed session as alice")
+        bob.send("/dm alice three")
+        self.assertEqual((await read_until(back, "DM"))[-1], "DM from bob: three")
+        return [line for line in lines if line.startswith("[")]
+
+    def test_resume_same_server(self):
+        port = self.run_server([])
+
+        async def connect_back(token):
+            return await HeadlessClient.connect("127.0.0.1", port, CAP_RESUME)
+
+        missed = asyncio.run(self.missed_after_resume(port, connect_back))
+        self.assertEqual(len(missed), 1)
+        self.assertTrue(missed[0].endswith(" two"))
+
+    def test_resume_other_worker(self):
+        port = self.run_server(["--workers", "2"])
+
+        async def connect_back(token):
+            # Reconnect until the kernel picks the worker that did not issue the token.
+            while True:
+                client = await HeadlessClient.connect("127.0.0.1", port, CAP_RESUME)
+                if client.token.split(".")[0] != token.split(".")[0]:
+                    return client
+                await client.command("/quit", "Goodbye")
+                client.writer.close()
+
+        missed = asyncio.run(self.missed_after_resume(port, connect_back))
+        self.assertEqual(len(missed), 1)
+        self.assertTrue(missed[0].endswith(" two"))
+
+if __name__ == "__main__":
+    unittest.main()